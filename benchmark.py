@@ -0,0 +1,907 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------------------------------------------
+# Purpose: Benchmarks for EdgeNet and the PurdueShapes5 data pipeline
+# Description: Each benchmark is a subcommand, e.g.
+#       python benchmark.py cpu --threads 1 2 4 8 --batch-size 32
+# Timings use random 32x32 inputs so they can be run without the PurdueShapes5 archives. All numbers are printed
+# to stdout as simple tables.
+#-------------------------------------------------------------------------------------------------------------------
+import argparse
+import asyncio
+import contextlib
+import copy
+import gzip
+import io
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import numpy as np
+import torch
+from task3 import EdgeNet, PurdueShapes5DatasetNoise, BatchAugment, testSources, labelMapArchive
+from trainer import makeGradScaler, trainStep, trainEpochs, evaluate, train, makeLoader
+from deploy import freezeEdgeNet, exportEdgeNet, exportMethods
+from quantize import calibrationBatches, quantizeEdgeNet, reportQuantization
+from prune import pruneEdgeNet
+from distill import makeStudent, distillEpochs
+from server import startServer, runLoadGenerator
+from infer import runInference
+
+def synchronize():
+    #CUDA kernels run asynchronously, so wait for them before reading the clock
+    if torch.cuda.is_initialized():
+        torch.cuda.synchronize()
+
+def timeIt(fn,numIters = 10,numWarmup = 2):
+    #Returns the mean wall-clock seconds per call of fn, after a few untimed warmup calls
+    for ii in range(numWarmup):
+        fn()
+    synchronize()
+    start = time.perf_counter()
+    for ii in range(numIters):
+        fn()
+    synchronize()
+    return (time.perf_counter() - start)/numIters
+
+def randomImages(batchSize,device = 'cpu'):
+    #PurdueShapes5 images are 3x32x32 with pixel values in [0,255]
+    return torch.rand(batchSize,3,32,32,device = device)*255.
+
+def countParameters(model):
+    return sum(param.numel() for param in model.parameters())
+
+def countMacs(model,images):
+    #Multiply-accumulates of every Conv2d/Linear module for one forward pass over images, gathered with forward hooks.
+    #The functional Gauss/Sobel front-end is not a module and is left out (it is a few hundred MACs per pixel at most).
+    macs = [0]
+    def convHook(module,inputs,output):
+        macs[0] += output.numel()*(module.in_channels//module.groups)*module.kernel_size[0]*module.kernel_size[1]
+    def linearHook(module,inputs,output):
+        macs[0] += output.numel()*module.in_features
+    handles = []
+    for module in model.modules():
+        if isinstance(module,torch.nn.Conv2d):
+            handles.append(module.register_forward_hook(convHook))
+        elif isinstance(module,torch.nn.Linear):
+            handles.append(module.register_forward_hook(linearHook))
+    with torch.inference_mode():
+        model(images)
+    for handle in handles:
+        handle.remove()
+    return macs[0]
+
+def serializedBytes(stateDict):
+    buffer = io.BytesIO()
+    torch.save(stateDict,buffer)
+    return buffer.tell()
+
+def randomBatch(batchSize,numOutputs = 5,device = 'cpu'):
+    return {'image' : randomImages(batchSize,device),
+            'bbox' : torch.rand(batchSize,4,device = device)*32.,
+            'label' : torch.randint(0,numOutputs,(batchSize,),device = device)}
+
+def loadPurdueShapes5(dataroot):
+    #Train split comes from the torch-saved archives in the working directory, test split from the .gz files in dataroot
+    dls = types.SimpleNamespace(dataroot = dataroot)
+    return PurdueShapes5DatasetNoise(dls,'train',None),PurdueShapes5DatasetNoise(dls,'test',None)
+
+testArchives = [fileName for fileName,noiseLabel in testSources]
+labelMap = {'rectangle' : 0,'triangle' : 1,'disk' : 2,'oval' : 3,'star' : 4}
+
+def syntheticRecords(numSamples,rng):
+    #Random records in the DLStudio PurdueShapes5 layout, {idx: [R, G, B, bbox, label]}
+    pixels = rng.randint(0,256,(numSamples,3,1024))
+    bboxes = rng.randint(0,32,(numSamples,4))
+    labels = rng.randint(0,5,numSamples)
+    return {ii : [pixels[ii,0].tolist(),pixels[ii,1].tolist(),pixels[ii,2].tolist(),bboxes[ii].tolist(),int(labels[ii])]
+            for ii in range(numSamples)}
+
+def writeSyntheticPurdueShapes5(directory,numSamples = 1000,fileNames = testArchives,seed = 0):
+    #Writes gzipped pickles (or torch-saved copies plus the label map file, for .pt names) filled with random pixels, so
+    #data-pipeline benchmarks can run without the real archives
+    rng = np.random.RandomState(seed)
+    for fileName in fileNames:
+        records = syntheticRecords(numSamples,rng)
+        if fileName.endswith('.pt'):
+            torch.save(records,os.path.join(directory,fileName))
+            torch.save(labelMap,os.path.join(directory,labelMapArchive))
+            continue
+        with gzip.open(os.path.join(directory,fileName),'wb') as f:
+            f.write(pickle.dumps((records,labelMap)))
+
+def legacyGetItem(records,idx):
+    #The original per-sample __getitem__, kept here as the baseline for the dataset benchmark
+    r = np.array( records[idx][0] )
+    g = np.array( records[idx][1] )
+    b = np.array( records[idx][2] )
+    R,G,B = r.reshape(32,32), g.reshape(32,32), b.reshape(32,32)
+    im_tensor = torch.zeros(3,32,32, dtype=torch.float)
+    im_tensor[0,:,:] = torch.from_numpy(R)
+    im_tensor[1,:,:] = torch.from_numpy(G)
+    im_tensor[2,:,:] = torch.from_numpy(B)
+    bb_tensor = torch.tensor(records[idx][3], dtype=torch.float)
+    return {'image' : im_tensor,'bbox' : bb_tensor,'label' : records[idx][4]}
+
+def trainAndEvaluate(model,trainData,testData,epochs = 1,batchSize = 32,learningRate = 1e-4,device = 'cpu'):
+    #Short SGD run with DLStudio's momentum/learning rate, then (label accuracy, bbox MSE) on the test split
+    trainEpochs(model,trainData,epochs,batchSize,learningRate,device)
+    return evaluate(model,testData,device = device)
+
+def benchmarkCPUInference(threadCounts,batchSize = 32,numIters = 10):
+    model = EdgeNet(3,5,4,0).eval()
+    images = randomImages(batchSize)
+    print("threads  batch  ms/batch  images/sec")
+    for numThreads in threadCounts:
+        torch.set_num_threads(numThreads)
+        with torch.inference_mode():
+            secs = timeIt(lambda: model(images),numIters)
+        print("%7d  %5d  %8.2f  %10.1f" % (numThreads,batchSize,secs*1000.,batchSize/secs))
+
+def benchmarkFrontEnd(batchSizes,numIters = 50,device = 'cpu'):
+    #Per-batch latency of the Gauss/Sobel edge stack for each front-end mode, checked against the 'split' reference
+    model = EdgeNet(3,5,4,0).to(device).eval()
+    modes = ['split','fused','separable']
+    print("batch  " + "  ".join("%13s" % (mode + " ms") for mode in modes) + "  max|diff|")
+    for batchSize in batchSizes:
+        images = randomImages(batchSize,device)
+        times = []
+        outputs = []
+        with torch.inference_mode():
+            for mode in modes:
+                model.frontEnd = mode
+                times.append(timeIt(lambda: model.edgeFilters(images),numIters))
+                outputs.append(model.edgeFilters(images))
+        maxDiff = max((out - outputs[0]).abs().max().item() for out in outputs)
+        print("%5d  " % batchSize + "  ".join("%13.3f" % (secs*1000.) for secs in times) + "  %.2e" % maxDiff)
+
+def benchmarkColorModes(colorModes,batchSize = 32,numIters = 10,device = 'cpu',head = 'compact',dataroot = None,epochs = 1):
+    #Front-end latency, forward throughput and (with dataroot) accuracy for each edge-filter input: the red channel,
+    #the luminance, and the filter bank over all three channels as one grouped conv
+    datasets = loadPurdueShapes5(dataroot) if dataroot else None
+    images = randomImages(batchSize,device)
+    print("color mode  edge maps  front-end ms  images/sec  accuracy  bbox MSE")
+    for colorMode in colorModes:
+        model = EdgeNet(3,5,4,0,head = head,colorMode = colorMode).to(device).eval()
+        with torch.inference_mode():
+            frontEndSecs = timeIt(lambda: model.edgeFilters(images),numIters)
+            secs = timeIt(lambda: model(images),numIters)
+        accuracy,bboxMSE = float('nan'),float('nan')
+        if datasets:
+            accuracy,bboxMSE = trainAndEvaluate(model.train(),datasets[0],datasets[1],epochs,batchSize,device = device)
+        print("%-10s  %9d  %12.3f  %10.1f  %8.3f  %8.2f" % (colorMode,model.numEdgeChannels,frontEndSecs*1000.,batchSize/secs,
+              accuracy,bboxMSE))
+        del model
+
+def benchmarkSharedTrunk(sharedStageCounts,batchSize = 32,numIters = 10,device = 'cpu'):
+    #FLOPs (2*MACs), parameter count and forward latency for each shared-trunk setting
+    images = randomImages(batchSize,device)
+    print("shared  params(M)  GFLOPs/image  ms/batch  images/sec")
+    for sharedStages in sharedStageCounts:
+        model = EdgeNet(3,5,4,0,sharedStages = sharedStages).to(device).eval()
+        flops = 2.*countMacs(model,images[:1])
+        with torch.inference_mode():
+            secs = timeIt(lambda: model(images),numIters)
+        print("%6d  %9.1f  %12.3f  %8.2f  %10.1f" % (sharedStages,countParameters(model)/1e6,flops/1e9,secs*1000.,batchSize/secs))
+        del model
+
+def benchmarkHeads(headConfigs,batchSize = 32,numIters = 5,device = 'cpu',dataroot = None,epochs = 1):
+    #Model size, optimizer state, training step time and (with dataroot) accuracy for each head configuration
+    datasets = loadPurdueShapes5(dataroot) if dataroot else None
+    print("head             head(M)  params(M)  ckpt(MB)  optim(MB)  step ms  accuracy  bbox MSE")
+    for head,headPool in headConfigs:
+        model = EdgeNet(3,5,4,0,head = head,headPool = headPool).to(device)
+        optimizer = torch.optim.SGD(model.parameters(),lr = 1e-4,momentum = 0.9)
+        batch = randomBatch(batchSize,device = device)
+        model.train()
+        secs = timeIt(lambda: trainStep(model,optimizer,batch,device),numIters,numWarmup = 1)
+        accuracy,bboxMSE = float('nan'),float('nan')
+        if datasets:
+            model = EdgeNet(3,5,4,0,head = head,headPool = headPool).to(device)
+            accuracy,bboxMSE = trainAndEvaluate(model,datasets[0],datasets[1],epochs,batchSize,device = device)
+        name = head if head == 'vgg' else "%s pool=%d" % (head,headPool)
+        headParams = countParameters(model.fullConClass) + countParameters(model.fullConR)
+        print("%-15s  %7.2f  %9.1f  %8.1f  %9.1f  %7.1f  %8.3f  %8.2f" % (name,headParams/1e6,countParameters(model)/1e6,serializedBytes(model.state_dict())/2**20,
+              serializedBytes(optimizer.state_dict())/2**20,secs*1000.,accuracy,bboxMSE))
+        del model,optimizer
+
+def benchmarkDataset(numSamples = 1000,batchSize = 32):
+    #Samples/sec of the original list-of-lists __getitem__ against the packed tensor store, per sample and per batch
+    with tempfile.TemporaryDirectory() as directory:
+        writeSyntheticPurdueShapes5(directory,numSamples)
+        with gzip.open(os.path.join(directory,testArchives[0]),'rb') as f:
+            records = pickle.loads(f.read())[0]
+        dataset = PurdueShapes5DatasetNoise(types.SimpleNamespace(dataroot = directory + os.sep),'test',None)
+    numRecords = len(records)
+    legacySecs = timeIt(lambda: [legacyGetItem(records,idx) for idx in range(numRecords)],numIters = 3,numWarmup = 1)
+    packedSecs = timeIt(lambda: [dataset[idx] for idx in range(numRecords)],numIters = 3,numWarmup = 1)
+    batchSecs = timeIt(lambda: [batch for batch in dataset.batchLoader(batchSize,shuffle = True)],numIters = 3,numWarmup = 1)
+    loaderSecs = timeIt(lambda: [batch for batch in torch.utils.data.DataLoader(dataset,batch_size = batchSize,shuffle = True)],
+                        numIters = 3,numWarmup = 1)
+    print("path                          samples/sec")
+    print("legacy __getitem__            %11.0f" % (numRecords/legacySecs))
+    print("packed __getitem__            %11.0f" % (numRecords/packedSecs))
+    print("packed DataLoader (collate)   %11.0f" % (len(dataset)/loaderSecs))
+    print("packed batchLoader (gather)   %11.0f" % (len(dataset)/batchSecs))
+
+def legacyLoad(paths):
+    #The original constructor's train-split load: torch.load each archive, overwrite the labels with the noise level one
+    #record at a time and copy every field into a preallocated list of lists
+    numSamples = 10000
+    dataset = [[0 for i in range(5)] for j in range(len(paths)*numSamples)]
+    for noiseLabel,path in enumerate(paths):
+        records = torch.load(path,weights_only = False)
+        for ck in range(numSamples):
+            records[ck][4] = noiseLabel
+        for ii in range(numSamples):
+            for jj in range(5):
+                dataset[noiseLabel*numSamples + ii][jj] = records[ii][jj]
+    return dataset
+
+def benchmarkLoad(numSources = 4):
+    #Load time of a synthetic 10000-sample-per-source train split: the original constructor against the source builder,
+    #eager and lazy, decoded and memory-mapped from the per-archive cache
+    fileNames = ["train-noise-%d.pt" % ii for ii in range(numSources)]
+    with tempfile.TemporaryDirectory() as directory:
+        writeSyntheticPurdueShapes5(directory,10000,fileNames = fileNames)
+        paths = [os.path.join(directory,fileName) for fileName in fileNames]
+        sources = [(path,noiseLabel) for noiseLabel,path in enumerate(paths)]
+        cacheDir = os.path.join(directory,'cache')
+        def load(**kwargs):
+            start = time.perf_counter()
+            PurdueShapes5DatasetNoise(None,'train',None,sources = sources,**kwargs)
+            return time.perf_counter() - start
+        start = time.perf_counter()
+        legacyLoad(paths)
+        legacySecs = time.perf_counter() - start
+        print("%d x 10000 samples                 seconds" % numSources)
+        print("original constructor            %10.3f" % legacySecs)
+        print("builder, eager                  %10.3f" % load())
+        print("builder, lazy                   %10.3f" % load(lazy = True))
+        print("builder, eager, writing cache   %10.3f" % load(cache_dir = cacheDir))
+        print("builder, eager, cached          %10.3f" % load(cache_dir = cacheDir))
+        print("builder, lazy, cached           %10.3f" % load(cache_dir = cacheDir,lazy = True))
+
+def benchmarkParallelLoad(workerCounts,numSources = 4,numSamples = 10000):
+    #Wall-clock cold load of synthetic torch-saved sources with the decode spread over 1, 2, 4, 8 ... processes
+    fileNames = ["train-noise-%d.pt" % ii for ii in range(numSources)]
+    with tempfile.TemporaryDirectory() as directory:
+        writeSyntheticPurdueShapes5(directory,numSamples,fileNames = fileNames)
+        sources = [(os.path.join(directory,fileName),noiseLabel) for noiseLabel,fileName in enumerate(fileNames)]
+        print("%d x %d samples, %d cores" % (numSources,numSamples,os.cpu_count()))
+        print("workers  eager s   lazy s")
+        for numWorkers in workerCounts:
+            times = []
+            for lazy in (False,True):
+                start = time.perf_counter()
+                PurdueShapes5DatasetNoise(None,'train',None,sources = sources,lazy = lazy,decode_workers = numWorkers)
+                times.append(time.perf_counter() - start)
+            print("%7d  %7.2f  %7.2f" % ((numWorkers,) + tuple(times)))
+
+def benchmarkSyntheticNoise(numSamples = 2000,batchSize = 128,noiseLevels = (0,20,50,80)):
+    #Disk, load time and batch throughput of pre-rendered noise-level archives against the clean archive plus noise
+    #rendered on the fly
+    fileNames = ["train-noise-%d.pt" % level for level in noiseLevels]
+    with tempfile.TemporaryDirectory() as directory:
+        writeSyntheticPurdueShapes5(directory,numSamples,fileNames = fileNames)
+        paths = [os.path.join(directory,fileName) for fileName in fileNames]
+        print("mode          archives(MB)  load s  samples/sec")
+        for mode,sources,kwargs in (('pre-rendered',list(zip(paths,range(len(paths)))),{}),
+                                    ('synthetic',[(paths[0],0)],{'synthetic_noise' : noiseLevels})):
+            start = time.perf_counter()
+            dataset = PurdueShapes5DatasetNoise(None,'train',None,sources = sources,**kwargs)
+            loadSecs = time.perf_counter() - start
+            epochSecs = timeIt(lambda: [batch for batch in dataset.batchLoader(batchSize)],numIters = 2,numWarmup = 1)
+            archiveBytes = sum(os.path.getsize(path) for path,noiseLabel in sources)
+            print("%-12s  %12.1f  %6.2f  %11.0f" % (mode,archiveBytes/2**20,loadSecs,len(dataset)/epochSecs))
+
+def benchmarkCache(numSamples = 1000):
+    #Startup time of the test split decoded from the gzipped pickles against the memory-mapped cache, and a check that
+    #touching an archive keeps the cache while rewriting one invalidates it
+    with tempfile.TemporaryDirectory() as directory:
+        writeSyntheticPurdueShapes5(directory,numSamples)
+        dls = types.SimpleNamespace(dataroot = directory + os.sep)
+        cacheDir = os.path.join(directory,'cache')
+        def load():
+            start = time.perf_counter()
+            dataset = PurdueShapes5DatasetNoise(dls,'test',None,cache_dir = cacheDir)
+            return dataset,time.perf_counter() - start
+        reference,decodeSecs = load()
+        cached,cachedSecs = load()
+        assert torch.equal(reference.images,cached.images) and torch.equal(reference.labels,cached.labels)
+        os.utime(os.path.join(directory,testArchives[0]))
+        touched,touchedSecs = load()
+        writeSyntheticPurdueShapes5(directory,numSamples,fileNames = testArchives[:1],seed = 1)
+        rebuilt,rebuiltSecs = load()
+        print("load                                  seconds")
+        print("decode gz pickles + write cache    %10.3f" % decodeSecs)
+        print("memory-mapped cache                %10.3f" % cachedSecs)
+        print("after touch (re-hash, cache kept)  %10.3f" % touchedSecs)
+        print("after rewrite (cache rebuilt)      %10.3f" % rebuiltSecs)
+        assert not torch.equal(rebuilt.images,reference.images),"rewritten archive was served from a stale cache"
+
+def benchmarkAugment(batchSize = 128,numIters = 20,device = 'cpu'):
+    #Images/sec of the same augmentation applied one sample at a time (as a per-sample transform) and to whole batches
+    augment = BatchAugment(hflip = 0.5,vflip = 0.5,maxShift = 4,noiseLevels = [0.,20.,50.,80.],gray = 0.2)
+    batch = randomBatch(batchSize,device = device)
+    samples = [{'image' : batch['image'][ii],'bbox' : batch['bbox'][ii],'label' : batch['label'][ii]} for ii in range(batchSize)]
+    perSampleSecs = timeIt(lambda: [augment(sample) for sample in samples],numIters)
+    batchedSecs = timeIt(lambda: augment(batch),numIters)
+    print("path          images/sec")
+    print("per sample   %11.0f" % (batchSize/perSampleSecs))
+    print("per batch    %11.0f" % (batchSize/batchedSecs))
+
+def benchmarkPrecision(configs,batchSize = 32,numIters = 5,device = 'cpu',head = 'vgg',dataroot = None,epochs = 1):
+    #Training/inference throughput and (with dataroot) accuracy and bbox MSE for each precision/memory-format setting
+    datasets = loadPurdueShapes5(dataroot) if dataroot else None
+    images = randomImages(batchSize,device)
+    batch = randomBatch(batchSize,device = device)
+    print("precision  layout  train img/s  infer img/s  accuracy  bbox MSE")
+    for precision,channelsLast in configs:
+        model = EdgeNet(3,5,4,0,head = head,precision = precision,channelsLast = channelsLast).to(device)
+        optimizer = torch.optim.SGD(model.parameters(),lr = 1e-4,momentum = 0.9)
+        scaler = makeGradScaler(model,device)
+        model.train()
+        trainSecs = timeIt(lambda: trainStep(model,optimizer,batch,device,scaler),numIters,numWarmup = 1)
+        model.eval()
+        with torch.inference_mode():
+            inferSecs = timeIt(lambda: model(images),numIters)
+        accuracy,bboxMSE = float('nan'),float('nan')
+        if datasets:
+            model = EdgeNet(3,5,4,0,head = head,precision = precision,channelsLast = channelsLast).to(device)
+            accuracy,bboxMSE = trainAndEvaluate(model,datasets[0],datasets[1],epochs,batchSize,device = device)
+        print("%-9s  %-6s  %11.1f  %11.1f  %8.3f  %8.2f" % (precision,'NHWC' if channelsLast else 'NCHW',batchSize/trainSecs,
+              batchSize/inferSecs,accuracy,bboxMSE))
+        del model,optimizer
+
+def benchmarkFreeze(batchSizes,numIters = 20,device = 'cpu',head = 'vgg'):
+    #Eval-mode EdgeNet against its BatchNorm-folded FrozenEdgeNet: max output difference and per-image latency
+    model = EdgeNet(3,5,4,0,head = head).to(device)
+    #Non-trivial running statistics, so the folding is actually exercised
+    for module in model.modules():
+        if isinstance(module,torch.nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.5,0.5)
+            module.running_var.uniform_(0.5,2.)
+    model.eval()
+    frozen = freezeEdgeNet(model)
+    print("batch  max |diff|  eager ms/img  frozen ms/img  speedup")
+    for batchSize in batchSizes:
+        images = randomImages(batchSize,device)
+        with torch.inference_mode():
+            diff = max((a - b).abs().max().item() for a,b in zip(model(images),frozen(images)))
+            eagerSecs = timeIt(lambda: model(images),numIters)
+            frozenSecs = timeIt(lambda: frozen(images),numIters)
+        print("%5d  %10.2e  %12.3f  %13.3f  %6.2fx" % (batchSize,diff,1000*eagerSecs/batchSize,1000*frozenSecs/batchSize,
+              eagerSecs/frozenSecs))
+
+#Cold-start scripts run in a fresh interpreter; each prints the seconds from after 'import torch' to the first output
+eagerStartup = """import time, torch
+start = time.perf_counter()
+from task3 import EdgeNet
+model = EdgeNet(3,5,4,0,head = %r)
+model.load_state_dict(torch.load(%r,weights_only = True))
+model.eval()
+with torch.no_grad():
+    model(torch.rand(1,3,32,32)*255.)
+print(time.perf_counter() - start)
+"""
+artifactStartup = """import time, torch
+start = time.perf_counter()
+model = torch.export.load(%r).module() if %r.endswith('.pt2') else torch.jit.load(%r)
+with torch.no_grad():
+    model(torch.rand(1,3,32,32)*255.)
+print(time.perf_counter() - start)
+"""
+
+def coldStartSecs(script):
+    #Runs script in a new python process, from the repo directory so task3 imports
+    output = subprocess.run([sys.executable,'-c',script],check = True,capture_output = True,text = True,
+                            cwd = os.path.dirname(os.path.abspath(__file__)))
+    return float(output.stdout.split()[-1])
+
+def benchmarkExport(methods,batchSize = 8,numIters = 20,head = 'vgg',useCompile = False):
+    #Cold start (load + first image, fresh process) and steady-state latency of the eager model against each exported
+    #artifact, and optionally against torch.compile of the frozen model in this process
+    model = EdgeNet(3,5,4,0,head = head).eval()
+    images = randomImages(batchSize)
+    print("model         export s  size MB  cold start s  ms/batch  max |diff|")
+    with tempfile.TemporaryDirectory() as tmpDir:
+        checkpoint = os.path.join(tmpDir,'edgenet.pt')
+        torch.save(model.state_dict(),checkpoint)
+        with torch.inference_mode():
+            reference = model(images)
+            eagerSecs = timeIt(lambda: model(images),numIters)
+        print("%-12s  %8s  %7.1f  %12.2f  %8.2f  %10s" % ('eager','-',os.path.getsize(checkpoint)/2**20,
+              coldStartSecs(eagerStartup % (head,checkpoint)),1000*eagerSecs,'-'))
+        for method in methods:
+            path = os.path.join(tmpDir,'edgenet.pt2' if method == 'export' else 'edgenet-%s.ts' % method)
+            start = time.perf_counter()
+            exportEdgeNet(model,path,method)
+            exportSecs = time.perf_counter() - start
+            artifact = torch.export.load(path).module() if method == 'export' else torch.jit.load(path)
+            with torch.inference_mode():
+                diff = max((a - b).abs().max().item() for a,b in zip(reference,artifact(images)))
+                artifactSecs = timeIt(lambda: artifact(images),numIters)
+            print("%-12s  %8.2f  %7.1f  %12.2f  %8.2f  %10.2e" % (method,exportSecs,os.path.getsize(path)/2**20,
+                  coldStartSecs(artifactStartup % (path,path,path)),1000*artifactSecs,diff))
+            del artifact
+    if useCompile:
+        #torch.compile output lives in the compiling process, so its 'cold start' is the compile plus first call
+        compiled = torch.compile(freezeEdgeNet(model))
+        with torch.inference_mode():
+            start = time.perf_counter()
+            outputs = compiled(images)
+            compileSecs = time.perf_counter() - start
+            diff = max((a - b).abs().max().item() for a,b in zip(reference,outputs))
+            compiledSecs = timeIt(lambda: compiled(images),numIters)
+        print("%-12s  %8s  %7s  %12.2f  %8.2f  %10.2e" % ('compile','-','-',compileSecs,1000*compiledSecs,diff))
+
+def benchmarkQuantize(numSamples = 500,calibrationSamples = 256,batchSize = 64,head = 'vgg',backend = 'x86'):
+    #fp32 against int8 on synthetic test archives with random weights: size and latency are representative, the
+    #accuracy columns only check that the int8 predictions follow fp32 (quantize.py reports them for a real checkpoint)
+    model = EdgeNet(3,5,4,0,head = head).eval()
+    with tempfile.TemporaryDirectory() as directory:
+        writeSyntheticPurdueShapes5(directory,numSamples)
+        testData = PurdueShapes5DatasetNoise(types.SimpleNamespace(dataroot = directory + os.sep),'test',None)
+        start = time.perf_counter()
+        quantized = quantizeEdgeNet(model,calibrationBatches(testData,calibrationSamples,batchSize),backend)
+        print("calibrate + convert: %.1f s on %d images" % (time.perf_counter() - start,calibrationSamples))
+        reportQuantization(model,quantized,testData,batchSize)
+
+def benchmarkPrune(sparsities,criterion = 'bn',batchSize = 32,numIters = 5,head = 'vgg',dataroot = None,epochs = 1):
+    #Params, MACs and latency at each channel sparsity and, with dataroot, accuracy/bbox MSE straight after pruning and
+    #after fine-tuning. The base model is trained for epochs first, so pruning ranks learned rather than initial scales
+    datasets = loadPurdueShapes5(dataroot) if dataroot else None
+    base = EdgeNet(3,5,4,0,head = head)
+    if datasets:
+        trainEpochs(base,datasets[0],epochs,batchSize)
+    images = randomImages(batchSize)
+    batches = [randomImages(64)] if not datasets else calibrationBatches(datasets[0],256)
+    print("sparsity  params M  MMACs/img  ms/batch  pruned acc  tuned acc  tuned bbox MSE")
+    for sparsity in sparsities:
+        model = pruneEdgeNet(copy.deepcopy(base),sparsity,criterion,batches).eval()
+        with torch.inference_mode():
+            batchSecs = timeIt(lambda: model(images),numIters)
+        prunedAccuracy,tunedAccuracy,tunedMSE = float('nan'),float('nan'),float('nan')
+        if datasets:
+            prunedAccuracy = evaluate(model,datasets[1])[0]
+            tunedAccuracy,tunedMSE = trainAndEvaluate(model,datasets[0],datasets[1],epochs,batchSize)
+        print("%8.2f  %8.1f  %9.1f  %8.1f  %10.3f  %9.3f  %14.2f" % (sparsity,countParameters(model)/1e6,
+              countMacs(model,images[:1])/1e6,1000*batchSecs,prunedAccuracy,tunedAccuracy,tunedMSE))
+        del model
+
+def benchmarkDistill(widths,batchSize = 32,numIters = 5,head = 'vgg',dataroot = None,epochs = 1):
+    #Teacher against students of several trunk widths: params, MACs, images/sec and, with dataroot, accuracy/bbox MSE
+    #of each student distilled from the (briefly trained) teacher
+    datasets = loadPurdueShapes5(dataroot) if dataroot else None
+    teacher = EdgeNet(3,5,4,0,head = head)
+    if datasets:
+        trainEpochs(teacher,datasets[0],epochs,batchSize)
+    images = randomImages(batchSize)
+    print("model          params M  MMACs/img  images/s  accuracy  bbox MSE")
+    for width in [None] + list(widths):
+        model = teacher if width is None else makeStudent(width,headPool = 2,headWidth = 256)
+        if datasets and width is not None:
+            distillEpochs(model,teacher,datasets[0],epochs,batchSize)
+        model.eval()
+        with torch.inference_mode():
+            batchSecs = timeIt(lambda: model(images),numIters)
+        accuracy,bboxMSE = evaluate(model,datasets[1]) if datasets else (float('nan'),float('nan'))
+        print("%-13s  %8.1f  %9.1f  %8.1f  %8.3f  %8.2f" % ('teacher' if width is None else 'student x%.3g' % width,
+              countParameters(model)/1e6,countMacs(model,images[:1])/1e6,batchSize/batchSecs,accuracy,bboxMSE))
+
+def benchmarkTrain(configs,numSamples = 64,head = 'compact',device = 'cpu'):
+    #Training samples/sec of trainer.train for each (micro-batch size, accumulation steps) pair on synthetic archives
+    with tempfile.TemporaryDirectory() as directory:
+        writeSyntheticPurdueShapes5(directory,numSamples)
+        trainData = PurdueShapes5DatasetNoise(types.SimpleNamespace(dataroot = directory + os.sep),'test',None)
+        print("micro-batch  accumulation  effective batch  samples/s")
+        for batchSize,accumulationSteps in configs:
+            model = EdgeNet(3,5,4,0,head = head).to(device)
+            #The first optimizer step is warmup (allocator, kernel selection), the rest are timed
+            with contextlib.redirect_stdout(io.StringIO()):
+                history = train(model,trainData,1,batchSize,accumulationSteps,device = device,logEvery = 1)
+            samplesPerSec = sum(entry[3] for entry in history[1:])/max(1,len(history) - 1)
+            print("%11d  %12d  %15d  %9.1f" % (batchSize,accumulationSteps,batchSize*accumulationSteps,samplesPerSec))
+            del model
+
+def benchmarkEdgeCache(numSamples = 500,batchSize = 32,epochs = 2,head = 'compact',syntheticNoise = None,device = 'cpu'):
+    #Seconds per training epoch on raw images (edge filters run in every forward) against the memory-mapped edge cache
+    #with a preFiltered EdgeNet, plus the one-time cost of building the cache and of mapping it on a later run.
+    #syntheticNoise renders the noise levels from the clean archive, whose per-batch noise the cache also saves
+    with tempfile.TemporaryDirectory() as directory:
+        writeSyntheticPurdueShapes5(directory,numSamples)
+        dls = types.SimpleNamespace(dataroot = directory + os.sep)
+        def epochSecs(model,trainData):
+            torch.manual_seed(0)
+            start = time.perf_counter()
+            train(model,trainData,epochs,batchSize,device = device,logEvery = 0)
+            return (time.perf_counter() - start)/epochs
+        trainData = PurdueShapes5DatasetNoise(dls,'test',None,synthetic_noise = syntheticNoise)
+        torch.manual_seed(0)
+        model = EdgeNet(3,5,4,0,head = head).to(device)
+        rawSecs = epochSecs(model,trainData)
+        cacheDir = os.path.join(directory,'edges')
+        start = time.perf_counter()
+        trainData.edgeCache(model,cacheDir)
+        buildSecs = time.perf_counter() - start
+        trainData = PurdueShapes5DatasetNoise(dls,'test',None,synthetic_noise = syntheticNoise)
+        start = time.perf_counter()
+        trainData.edgeCache(model,cacheDir)
+        mapSecs = time.perf_counter() - start
+        torch.manual_seed(0)
+        model = EdgeNet(3,5,4,0,head = head,preFiltered = True).to(device)
+        cachedSecs = epochSecs(model,trainData)
+    #Building the cache is one pass of the front-end (and noise rendering) over the data, the most an epoch can save
+    print("samples %d  build cache %.2f s (%.2f%% of an epoch)  map cache %.3f s" % (len(trainData),buildSecs,
+          100.*buildSecs/rawSecs,mapSecs))
+    print("input       s/epoch  speedup")
+    print("images      %7.2f  %6.3fx" % (rawSecs,1.))
+    print("edge cache  %7.2f  %6.3fx" % (cachedSecs,rawSecs/cachedSecs))
+
+def benchmarkDistributed(processCounts,numSamples = 256,batchSize = 16,head = 'compact',epochs = 1):
+    #Aggregate training samples/sec of distributed.py at each process count, on synthetic test-split archives. Each
+    #run is a fresh set of processes; scaling efficiency is relative to one process
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),'distributed.py')
+    with tempfile.TemporaryDirectory() as directory:
+        writeSyntheticPurdueShapes5(directory,numSamples)
+        print("processes  samples/s  speedup  efficiency")
+        baseline = None
+        for numProcesses in processCounts:
+            output = subprocess.run([sys.executable,script,'--nproc',str(numProcesses),'--dataroot',directory + os.sep,
+                                     '--split','test','--head',head,'--batch-size',str(batchSize),'--epochs',str(epochs),
+                                     '--log-every','0','--cache-dir',os.path.join(directory,'cache')],
+                                    check = True,capture_output = True,text = True)
+            samplesPerSec = float(output.stdout.split('samples/s')[-1].split()[0])
+            baseline = baseline or samplesPerSec
+            print("%9d  %9.1f  %6.2fx  %9.0f%%" % (numProcesses,samplesPerSec,samplesPerSec/baseline,
+                  100*samplesPerSec/baseline/numProcesses))
+
+def savedActivationBytes(model,batch,device = 'cpu'):
+    #Bytes autograd keeps for backward over one training forward, counted with saved-tensor hooks (parameters and tensors
+    #saved twice counted once). Works on any device; checkpointed stages only show up with their inputs
+    storages = {}
+    def pack(tensor):
+        if not isinstance(tensor,torch.nn.Parameter):
+            storage = tensor.untyped_storage()
+            storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+    model.train()
+    with torch.autograd.graph.saved_tensors_hooks(pack,lambda tensor: tensor):
+        outputsClass,outputsR = model(batch['image'].to(device))
+    (outputsClass.sum() + outputsR.sum()).backward()
+    model.zero_grad(set_to_none = True)
+    return sum(storages.values())
+
+def benchmarkCheckpoint(configs,batchSizes,numIters = 3,head = 'compact',device = 'cpu'):
+    #Activation memory and training step time for each set of checkpointed trunk stages, at each batch size
+    print("checkpointed stages  batch  activations MB  CUDA peak MB  ms/step")
+    for name,stages in configs:
+        model = EdgeNet(3,5,4,0,head = head,checkpointStages = stages).to(device)
+        optimizer = torch.optim.SGD(model.parameters(),lr = 1e-4,momentum = 0.9)
+        for batchSize in batchSizes:
+            batch = randomBatch(batchSize,device = device)
+            activationBytes = savedActivationBytes(model,batch,device)
+            if device != 'cpu':
+                torch.cuda.reset_peak_memory_stats()
+            stepSecs = timeIt(lambda: trainStep(model,optimizer,batch,device),numIters,numWarmup = 1)
+            peakMB = torch.cuda.max_memory_allocated()/2**20 if device != 'cpu' else float('nan')
+            print("%-19s  %5d  %14.1f  %12.1f  %7.1f" % (name,batchSize,activationBytes/2**20,peakMB,1000*stepSecs))
+        del model,optimizer
+
+class LegacyRecords(torch.utils.data.Dataset):
+    #The original list-of-lists dataset with the per-sample __getitem__, the baseline for the loader benchmark
+    def __init__(self,records):
+        self.records = records
+    def __len__(self):
+        return len(self.records)
+    def __getitem__(self,idx):
+        return legacyGetItem(self.records,idx)
+
+def processMemoryMB(pid):
+    #(RSS, private) MB of a process. Private pages are the ones it does not share with the parent or other workers,
+    #so for a forked worker they are its copy-on-write duplicates plus its own allocations
+    fields = {}
+    with open('/proc/%d/smaps_rollup' % pid) as f:
+        for line in f:
+            parts = line.split()
+            if parts[0] in ('Rss:','Private_Clean:','Private_Dirty:'):
+                fields[parts[0]] = int(parts[1])/1024.
+    return fields['Rss:'],fields['Private_Clean:'] + fields['Private_Dirty:']
+
+def benchmarkLoader(workerCounts,numSamples = 10000,batchSize = 128,numEpochs = 3,prefetchFactor = 2):
+    #Batches/sec and per-worker memory of the legacy list-of-lists dataset in a plain DataLoader against
+    #PurdueShapes5DatasetNoise through trainer.makeLoader (shared-memory stores, prefetch, persistent workers). Worker
+    #memory is read after the first epoch, once every worker has touched its share of the samples, and again after the
+    #last one, so copy-on-write growth across epochs shows up as a rising private size; rates are over epochs 2..N.
+    #The default is the real dataset size, 4 archives of 10000 samples
+    with tempfile.TemporaryDirectory() as directory:
+        writeSyntheticPurdueShapes5(directory,numSamples)
+        records = []
+        for fileName in testArchives:
+            with gzip.open(os.path.join(directory,fileName),'rb') as f:
+                records.extend([list(record) for record in pickle.loads(f.read())[0].values()])
+        dataset = PurdueShapes5DatasetNoise(types.SimpleNamespace(dataroot = directory + os.sep),'test',None)
+    def workerMemory(loader,numWorkers):
+        return [processMemoryMB(worker.pid) for worker in loader._iterator._workers] if numWorkers else [(0.,0.)]
+    print("samples %d, memory per worker after epoch 1 -> epoch %d" % (len(dataset),numEpochs))
+    print("dataset  workers  batches/s  main RSS MB  worker RSS MB      worker private MB")
+    for name in ('legacy','packed'):
+        for numWorkers in workerCounts:
+            if name == 'legacy':
+                kwargs = {'persistent_workers' : True,'prefetch_factor' : prefetchFactor} if numWorkers else {}
+                loader = torch.utils.data.DataLoader(LegacyRecords(records),batch_size = batchSize,shuffle = True,
+                                                     num_workers = numWorkers,**kwargs)
+            else:
+                loader = makeLoader(dataset,batchSize,numWorkers,prefetchFactor = prefetchFactor,pinMemory = False)
+            for batch in loader:
+                pass
+            firstMemory = workerMemory(loader,numWorkers)
+            start = time.perf_counter()
+            numBatches = 0
+            for epoch in range(numEpochs - 1):
+                for batch in loader:
+                    numBatches += 1
+            batchesPerSec = numBatches/(time.perf_counter() - start)
+            lastMemory = workerMemory(loader,numWorkers)
+            print("%-7s  %7d  %9.1f  %11.1f  %6.1f -> %6.1f  %7.1f -> %7.1f" % (name,numWorkers,batchesPerSec,
+                  processMemoryMB(os.getpid())[0],np.mean([rss for rss,private in firstMemory]),
+                  np.mean([rss for rss,private in lastMemory]),np.mean([private for rss,private in firstMemory]),
+                  np.mean([private for rss,private in lastMemory])))
+            del loader
+
+def benchmarkServer(maxBatches,concurrency = 32,numRequests = 500,maxDelay = 0.005,head = 'compact',numWorkers = 1):
+    #Client-side throughput and p50/p99 latency of the micro-batching server at each max batch size, with the server and
+    #the load generator sharing one event loop over a Unix socket
+    model = freezeEdgeNet(EdgeNet(3,5,4,0,head = head).eval())
+    async def run(maxBatch,socketPath):
+        server,batcher,batcherTask = await startServer(model,unixSocket = socketPath,maxBatch = maxBatch,maxDelay = maxDelay,
+                                                       numWorkers = numWorkers)
+        await runLoadGenerator(unixSocket = socketPath,concurrency = concurrency,numRequests = min(numRequests,2*concurrency))
+        results = await runLoadGenerator(unixSocket = socketPath,concurrency = concurrency,numRequests = numRequests)
+        stats = batcher.stats()
+        server.close()
+        await server.wait_closed()
+        batcherTask.cancel()
+        return results + (stats['mean_batch_size'],)
+    print("max batch  requests/s  p50 ms  p99 ms  mean batch")
+    with tempfile.TemporaryDirectory() as directory:
+        for maxBatch in maxBatches:
+            requestsPerSec,p50,p99,meanBatch = asyncio.run(run(maxBatch,os.path.join(directory,'edgenet-%d.sock' % maxBatch)))
+            print("%9d  %10.1f  %6.1f  %6.1f  %10.1f" % (maxBatch,requestsPerSec,p50,p99,meanBatch))
+
+def benchmarkInfer(prefetches,numSamples = 1000,batchSize = 256,head = 'compact'):
+    #Images/sec of the streaming inference CLI over the four synthetic test archives written to CSV, run sequentially in
+    #one thread and as the decode / front-end / model pipeline with each queue depth
+    model = freezeEdgeNet(EdgeNet(3,5,4,0,head = head).eval())
+    print("mode        prefetch  images/s")
+    with tempfile.TemporaryDirectory() as directory:
+        writeSyntheticPurdueShapes5(directory,numSamples)
+        inputs = [os.path.join(directory,fileName) for fileName in testArchives]
+        out = os.path.join(directory,'predictions.csv')
+        for pipelined,prefetch in [(False,1)] + [(True,prefetch) for prefetch in prefetches]:
+            numImages,seconds = runInference(model,inputs,out,batchSize,prefetch,pipelined)
+            print("%-10s  %8s  %8.1f" % ('pipelined' if pipelined else 'sequential',prefetch if pipelined else '-',numImages/seconds))
+
+def checkGaussEquivalence(gaussSize = 9,gaussSigma = 1.2):
+    #The Matlab matrix is a sigma 1.2 Gaussian with its corners cropped to zero (and one row shifted by a column), so the
+    #analytic separable kernel matches it to within a fraction of a percent rather than bit-exactly. Reports the gaps
+    #for any size/sigma; tests/test_frontend.py holds the default front-end to them
+    model = EdgeNet(3,5,4,0,frontEnd = 'separable',gaussSize = gaussSize,gaussSigma = gaussSigma).eval()
+    matlabKernel = model.gaussFilter[0,0]
+    gauss1d = model.makeGaussKernel1d(gaussSize,gaussSigma)
+    offset = (matlabKernel.shape[0] - gaussSize)//2
+    analyticKernel = torch.zeros_like(matlabKernel)
+    analyticKernel[offset:offset + gaussSize,offset:offset + gaussSize] = torch.outer(gauss1d,gauss1d)
+    kernelDiff = (analyticKernel - matlabKernel).abs().max().item()
+    images = randomImages(64)
+    with torch.inference_mode():
+        separable = model.edgeFilters(images)
+        model.frontEnd = 'split'
+        reference = model.edgeFilters(images)
+    #Relative error per channel: Gauss against the Matlab blur, the two Sobels should agree up to float rounding
+    responseDiff = ((separable - reference).abs().amax(dim = (0,2,3))/reference.abs().amax(dim = (0,2,3))).tolist()
+    print("max |kernel diff| = %.2e" % kernelDiff)
+    print("max relative response diff: gauss %.2e, sobelX %.2e, sobelY %.2e" % tuple(responseDiff))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "EdgeNet benchmarks")
+    subparsers = parser.add_subparsers(dest = 'benchmark',required = True)
+    cpuParser = subparsers.add_parser('cpu',help = "CPU inference images/sec at several thread counts")
+    cpuParser.add_argument('--threads',type = int,nargs = '+',default = [1,2,4,8,os.cpu_count()])
+    cpuParser.add_argument('--batch-size',type = int,default = 32)
+    cpuParser.add_argument('--iters',type = int,default = 10)
+    frontEndParser = subparsers.add_parser('frontend',help = "Per-batch latency of the Gauss/Sobel front-end modes")
+    frontEndParser.add_argument('--batch-sizes',type = int,nargs = '+',default = [1,8,32,128])
+    frontEndParser.add_argument('--iters',type = int,default = 50)
+    frontEndParser.add_argument('--device',default = 'cpu')
+    gaussParser = subparsers.add_parser('gauss',help = "Compare the analytic separable Gaussian against the Matlab kernel")
+    gaussParser.add_argument('--size',type = int,default = 9)
+    gaussParser.add_argument('--sigma',type = float,default = 1.2)
+    sharedParser = subparsers.add_parser('shared',help = "FLOPs/params/latency for shared-trunk settings")
+    sharedParser.add_argument('--shared-stages',type = int,nargs = '+',default = [0,2,4,6,8])
+    sharedParser.add_argument('--batch-size',type = int,default = 32)
+    sharedParser.add_argument('--iters',type = int,default = 10)
+    sharedParser.add_argument('--device',default = 'cpu')
+    headParser = subparsers.add_parser('head',help = "Checkpoint size, step time and accuracy for the head options")
+    headParser.add_argument('--heads',nargs = '+',default = ['vgg','compact:1','compact:2'],
+                            help = "'vgg' or 'compact:<pool size>'")
+    headParser.add_argument('--batch-size',type = int,default = 32)
+    headParser.add_argument('--iters',type = int,default = 5)
+    headParser.add_argument('--device',default = 'cpu')
+    headParser.add_argument('--dataroot',help = "PurdueShapes5 data directory, enables the accuracy columns")
+    headParser.add_argument('--epochs',type = int,default = 1)
+    datasetParser = subparsers.add_parser('dataset',help = "Samples/sec of the PurdueShapes5DatasetNoise access paths")
+    datasetParser.add_argument('--samples',type = int,default = 1000,help = "Synthetic samples per noise-level archive")
+    datasetParser.add_argument('--batch-size',type = int,default = 32)
+    cacheParser = subparsers.add_parser('cache',help = "Startup time with and without the memory-mapped dataset cache")
+    cacheParser.add_argument('--samples',type = int,default = 1000,help = "Synthetic samples per noise-level archive")
+    loadParser = subparsers.add_parser('load',help = "Train-split load time, original constructor against the source builder")
+    loadParser.add_argument('--sources',type = int,default = 4,help = "Number of synthetic 10000-sample noise-level archives")
+    parallelParser = subparsers.add_parser('parallel',help = "Cold load time with the source decode spread over worker processes")
+    parallelParser.add_argument('--workers',type = int,nargs = '+',default = [1,2,4,8])
+    parallelParser.add_argument('--sources',type = int,default = 8)
+    parallelParser.add_argument('--samples',type = int,default = 10000,help = "Synthetic samples per source")
+    augmentParser = subparsers.add_parser('augment',help = "Per-sample against per-batch augmentation throughput")
+    augmentParser.add_argument('--batch-size',type = int,default = 128)
+    augmentParser.add_argument('--iters',type = int,default = 20)
+    augmentParser.add_argument('--device',default = 'cpu')
+    syntheticParser = subparsers.add_parser('synthetic',help = "Pre-rendered noise archives against on-the-fly synthetic noise")
+    syntheticParser.add_argument('--samples',type = int,default = 2000,help = "Synthetic samples per noise level")
+    syntheticParser.add_argument('--batch-size',type = int,default = 128)
+    precisionParser = subparsers.add_parser('precision',help = "Throughput and accuracy per precision/memory-format setting")
+    precisionParser.add_argument('--configs',nargs = '+',default = ['fp32','fp32:nhwc','bf16','bf16:nhwc'],
+                                 help = "<fp32|bf16|fp16>[:nhwc]")
+    precisionParser.add_argument('--batch-size',type = int,default = 32)
+    precisionParser.add_argument('--iters',type = int,default = 5)
+    precisionParser.add_argument('--device',default = 'cpu')
+    precisionParser.add_argument('--head',default = 'vgg',choices = ['vgg','compact'])
+    precisionParser.add_argument('--dataroot',help = "PurdueShapes5 data directory, enables the accuracy columns")
+    precisionParser.add_argument('--epochs',type = int,default = 1)
+    freezeParser = subparsers.add_parser('freeze',help = "Eager eval latency against the BatchNorm-folded frozen model")
+    freezeParser.add_argument('--batch-sizes',type = int,nargs = '+',default = [1,8,32])
+    freezeParser.add_argument('--iters',type = int,default = 20)
+    freezeParser.add_argument('--device',default = 'cpu')
+    freezeParser.add_argument('--head',default = 'vgg',choices = ['vgg','compact'])
+    exportParser = subparsers.add_parser('export',help = "Cold start and latency of exported artifacts against eager mode")
+    exportParser.add_argument('--methods',nargs = '+',default = list(exportMethods),choices = exportMethods)
+    exportParser.add_argument('--batch-size',type = int,default = 8)
+    exportParser.add_argument('--iters',type = int,default = 20)
+    exportParser.add_argument('--head',default = 'vgg',choices = ['vgg','compact'])
+    exportParser.add_argument('--compile',action = 'store_true',help = "Also time torch.compile of the frozen model")
+    quantizeParser = subparsers.add_parser('quantize',help = "Size, latency and accuracy of the int8 model against fp32")
+    quantizeParser.add_argument('--samples',type = int,default = 500,help = "Synthetic samples per noise-level archive")
+    quantizeParser.add_argument('--calibration-samples',type = int,default = 256)
+    quantizeParser.add_argument('--batch-size',type = int,default = 64)
+    quantizeParser.add_argument('--head',default = 'vgg',choices = ['vgg','compact'])
+    quantizeParser.add_argument('--backend',default = 'x86',choices = ['x86','fbgemm','qnnpack','onednn'])
+    pruneParser = subparsers.add_parser('prune',help = "Params/latency/accuracy of the trunks at several channel sparsities")
+    pruneParser.add_argument('--sparsities',type = float,nargs = '+',default = [0.,0.25,0.5,0.75])
+    pruneParser.add_argument('--criterion',default = 'bn',choices = ['bn','activation'])
+    pruneParser.add_argument('--batch-size',type = int,default = 32)
+    pruneParser.add_argument('--iters',type = int,default = 5)
+    pruneParser.add_argument('--head',default = 'vgg',choices = ['vgg','compact'])
+    pruneParser.add_argument('--dataroot',help = "PurdueShapes5 data directory, enables the accuracy columns")
+    pruneParser.add_argument('--epochs',type = int,default = 1)
+    distillParser = subparsers.add_parser('distill',help = "Speed/accuracy of distilled students against the teacher")
+    distillParser.add_argument('--widths',type = float,nargs = '+',default = [0.5,0.25,0.125])
+    distillParser.add_argument('--batch-size',type = int,default = 32)
+    distillParser.add_argument('--iters',type = int,default = 5)
+    distillParser.add_argument('--head',default = 'vgg',choices = ['vgg','compact'],help = "Teacher head")
+    distillParser.add_argument('--dataroot',help = "PurdueShapes5 data directory, enables the accuracy columns")
+    distillParser.add_argument('--epochs',type = int,default = 1)
+    trainParser = subparsers.add_parser('train',help = "Training samples/sec per micro-batch size and accumulation")
+    trainParser.add_argument('--configs',nargs = '+',default = ['1:1','4:1','32:1','8:4'],
+                             help = "<micro-batch size>:<accumulation steps>")
+    trainParser.add_argument('--samples',type = int,default = 64,help = "Synthetic samples per noise-level archive")
+    trainParser.add_argument('--head',default = 'compact',choices = ['vgg','compact'])
+    trainParser.add_argument('--device',default = 'cpu')
+    distributedParser = subparsers.add_parser('distributed',help = "DDP training throughput at several process counts")
+    distributedParser.add_argument('--processes',type = int,nargs = '+',default = [1,2,4,8])
+    distributedParser.add_argument('--samples',type = int,default = 256,help = "Synthetic samples per noise-level archive")
+    distributedParser.add_argument('--batch-size',type = int,default = 16,help = "Micro-batch per process")
+    distributedParser.add_argument('--head',default = 'compact',choices = ['vgg','compact'])
+    distributedParser.add_argument('--epochs',type = int,default = 1)
+    checkpointParser = subparsers.add_parser('checkpoint',help = "Activation memory against step time per checkpointed stage set")
+    checkpointParser.add_argument('--configs',nargs = '+',default = ['none','0-3','4-7','all'],
+                                  help = "'none', 'all', a stage range like 4-7 or a comma list like 0,2,5")
+    checkpointParser.add_argument('--batch-sizes',type = int,nargs = '+',default = [8,32])
+    checkpointParser.add_argument('--iters',type = int,default = 3)
+    checkpointParser.add_argument('--head',default = 'compact',choices = ['vgg','compact'])
+    checkpointParser.add_argument('--device',default = 'cpu')
+    loaderParser = subparsers.add_parser('loader',help = "Batches/sec and per-worker RSS as DataLoader workers scale")
+    loaderParser.add_argument('--workers',type = int,nargs = '+',default = [0,1,2,4])
+    loaderParser.add_argument('--samples',type = int,default = 10000,help = "Synthetic samples per noise-level archive")
+    loaderParser.add_argument('--batch-size',type = int,default = 128)
+    loaderParser.add_argument('--epochs',type = int,default = 3)
+    loaderParser.add_argument('--prefetch',type = int,default = 2,help = "Batches in flight per worker")
+    serverParser = subparsers.add_parser('server',help = "Throughput and p50/p99 latency of the micro-batching server")
+    serverParser.add_argument('--max-batches',type = int,nargs = '+',default = [1,8,32])
+    serverParser.add_argument('--concurrency',type = int,default = 32)
+    serverParser.add_argument('--requests',type = int,default = 500)
+    serverParser.add_argument('--max-delay-ms',type = float,default = 5.)
+    serverParser.add_argument('--head',default = 'compact',choices = ['vgg','compact'])
+    serverParser.add_argument('--workers',type = int,default = 1)
+    inferParser = subparsers.add_parser('infer',help = "Images/sec of streaming inference, sequential against pipelined")
+    inferParser.add_argument('--prefetch',type = int,nargs = '+',default = [1,2,4],help = "Queue depths between stages")
+    inferParser.add_argument('--samples',type = int,default = 1000,help = "Synthetic samples per noise-level archive")
+    inferParser.add_argument('--batch-size',type = int,default = 256)
+    inferParser.add_argument('--head',default = 'compact',choices = ['vgg','compact'])
+    edgeCacheParser = subparsers.add_parser('edgecache',help = "Epoch time on raw images against the precomputed edge cache")
+    edgeCacheParser.add_argument('--samples',type = int,default = 500,help = "Synthetic samples per noise-level archive")
+    edgeCacheParser.add_argument('--batch-size',type = int,default = 32)
+    edgeCacheParser.add_argument('--epochs',type = int,default = 2)
+    edgeCacheParser.add_argument('--head',default = 'compact',choices = ['vgg','compact'])
+    edgeCacheParser.add_argument('--synthetic-noise',type = float,nargs = '+',help = "Render these noise levels from the clean archive")
+    edgeCacheParser.add_argument('--device',default = 'cpu')
+    colorParser = subparsers.add_parser('color',help = "Throughput and accuracy of the red, luminance and rgb edge inputs")
+    colorParser.add_argument('--modes',nargs = '+',default = ['red','luminance','rgb'],choices = ['red','luminance','rgb'])
+    colorParser.add_argument('--batch-size',type = int,default = 32)
+    colorParser.add_argument('--iters',type = int,default = 10)
+    colorParser.add_argument('--device',default = 'cpu')
+    colorParser.add_argument('--head',default = 'compact',choices = ['vgg','compact'])
+    colorParser.add_argument('--dataroot',help = "PurdueShapes5 data directory, enables the accuracy columns")
+    colorParser.add_argument('--epochs',type = int,default = 1)
+    args = parser.parse_args()
+    if args.benchmark == 'cpu':
+        benchmarkCPUInference(sorted(set(args.threads)),args.batch_size,args.iters)
+    elif args.benchmark == 'frontend':
+        benchmarkFrontEnd(args.batch_sizes,args.iters,args.device)
+    elif args.benchmark == 'gauss':
+        checkGaussEquivalence(args.size,args.sigma)
+    elif args.benchmark == 'shared':
+        benchmarkSharedTrunk(args.shared_stages,args.batch_size,args.iters,args.device)
+    elif args.benchmark == 'head':
+        headConfigs = [(spec.split(':')[0],int(spec.split(':')[1]) if ':' in spec else 1) for spec in args.heads]
+        benchmarkHeads(headConfigs,args.batch_size,args.iters,args.device,args.dataroot,args.epochs)
+    elif args.benchmark == 'dataset':
+        benchmarkDataset(args.samples,args.batch_size)
+    elif args.benchmark == 'cache':
+        benchmarkCache(args.samples)
+    elif args.benchmark == 'load':
+        benchmarkLoad(args.sources)
+    elif args.benchmark == 'parallel':
+        benchmarkParallelLoad(args.workers,args.sources,args.samples)
+    elif args.benchmark == 'augment':
+        benchmarkAugment(args.batch_size,args.iters,args.device)
+    elif args.benchmark == 'synthetic':
+        benchmarkSyntheticNoise(args.samples,args.batch_size)
+    elif args.benchmark == 'precision':
+        configs = [(spec.split(':')[0],spec.endswith(':nhwc')) for spec in args.configs]
+        benchmarkPrecision(configs,args.batch_size,args.iters,args.device,args.head,args.dataroot,args.epochs)
+    elif args.benchmark == 'freeze':
+        benchmarkFreeze(args.batch_sizes,args.iters,args.device,args.head)
+    elif args.benchmark == 'export':
+        benchmarkExport(args.methods,args.batch_size,args.iters,args.head,args.compile)
+    elif args.benchmark == 'quantize':
+        benchmarkQuantize(args.samples,args.calibration_samples,args.batch_size,args.head,args.backend)
+    elif args.benchmark == 'prune':
+        benchmarkPrune(args.sparsities,args.criterion,args.batch_size,args.iters,args.head,args.dataroot,args.epochs)
+    elif args.benchmark == 'distill':
+        benchmarkDistill(args.widths,args.batch_size,args.iters,args.head,args.dataroot,args.epochs)
+    elif args.benchmark == 'train':
+        configs = [tuple(int(value) for value in spec.split(':')) for spec in args.configs]
+        benchmarkTrain(configs,args.samples,args.head,args.device)
+    elif args.benchmark == 'distributed':
+        benchmarkDistributed(args.processes,args.samples,args.batch_size,args.head,args.epochs)
+    elif args.benchmark == 'checkpoint':
+        def parseStages(spec):
+            if spec in ('none','all'):
+                return () if spec == 'none' else tuple(range(len(EdgeNet.trunkStages)))
+            if '-' in spec:
+                first,last = spec.split('-')
+                return tuple(range(int(first),int(last) + 1))
+            return tuple(int(stage) for stage in spec.split(','))
+        benchmarkCheckpoint([(spec,parseStages(spec)) for spec in args.configs],args.batch_sizes,args.iters,args.head,args.device)
+    elif args.benchmark == 'loader':
+        benchmarkLoader(args.workers,args.samples,args.batch_size,args.epochs,args.prefetch)
+    elif args.benchmark == 'server':
+        benchmarkServer(args.max_batches,args.concurrency,args.requests,args.max_delay_ms/1000.,args.head,args.workers)
+    elif args.benchmark == 'infer':
+        benchmarkInfer(args.prefetch,args.samples,args.batch_size,args.head)
+    elif args.benchmark == 'edgecache':
+        benchmarkEdgeCache(args.samples,args.batch_size,args.epochs,args.head,args.synthetic_noise,args.device)
+    elif args.benchmark == 'color':
+        benchmarkColorModes(args.modes,args.batch_size,args.iters,args.device,args.head,args.dataroot,args.epochs)
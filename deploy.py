@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------------------------------------------
+# Purpose: Inference-only export of a trained EdgeNet
+# Description: freezeEdgeNet folds every BatchNorm into the conv before it, drops Dropout, and turns the Gauss/Sobel
+# front-end into constant filter banks, giving a lean eval-only FrozenEdgeNet that computes the same outputs as the
+# trained model in eval mode (within float rounding). exportEdgeNet saves the frozen model as a TorchScript or
+# torch.export artifact that serving processes load with loadArtifact, without task3 or the EdgeNet class:
+#       python deploy.py --checkpoint edgenet.pt --out edgenet.pt2
+#-------------------------------------------------------------------------------------------------------------------
+import argparse
+import copy
+import torch
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from task3 import EdgeNet
+
+class SkipAdd(torch.nn.Module):
+    #EdgeNet's skip connection x + relu(bn(conv(x))), with the BatchNorm already folded into conv
+    def __init__(self,conv):
+        super(SkipAdd, self).__init__()
+        self.conv = conv
+    def forward(self,x):
+        return torch.add(torch.nn.functional.relu(self.conv(x)),x)
+
+def foldSequential(sequential):
+    #Copies a Conv/BatchNorm/ReLU/MaxPool/Dropout stack with each BatchNorm folded into the preceding conv and
+    #Dropout removed
+    layers = []
+    for layer in sequential:
+        if isinstance(layer,torch.nn.BatchNorm2d):
+            layers[-1] = fuse_conv_bn_eval(layers[-1],layer)
+        elif not isinstance(layer,torch.nn.Dropout):
+            layers.append(copy.deepcopy(layer))
+    return torch.nn.Sequential(*layers)
+
+def foldTrunk(model,stages,branch):
+    #The given trunk stages of the 'Class' or 'R' branch as one Sequential, skip connections folded into SkipAdds
+    layers = []
+    for stage in stages:
+        stageName,skipIdx = model.trunkStages[stage]
+        layers.extend(foldSequential(getattr(model,stageName + 'ConvLayerSmooth' + branch)))
+        if skipIdx:
+            suffix = '' if branch == 'Class' else 'R'
+            conv = getattr(model,'skipConv%d%s' % (skipIdx,suffix))
+            batchNorm = getattr(model,'skipBatchNorm%d%s' % (skipIdx,suffix))
+            layers.append(SkipAdd(fuse_conv_bn_eval(conv,batchNorm)))
+    return torch.nn.Sequential(*layers)
+
+class FrozenEdgeNet(torch.nn.Module):
+    #Eval-only EdgeNet: constant front-end filter banks, shared trunk prefix, per-branch trunks and Dropout-free heads,
+    #always returning (class logits, bbox) in fp32
+    def __init__(self,model):
+        #model must be in eval mode so its BatchNorms use their running statistics
+        super(FrozenEdgeNet, self).__init__()
+        self.separable = model.frontEnd == 'separable'
+        self.headless = model.edgeDetect != 0          #Edge-detection mode returns the trunk feature maps
+        self.channelsLast = model.channelsLast
+        self.colorMode = model.colorMode
+        self.groups = 3 if model.colorMode == 'rgb' else 1      #Input channels the filter bank runs on, one group each
+        self.register_buffer('lumaWeights',model.lumaWeights.detach().clone().float())
+        #Unused banks are empty placeholders so both front-end branches of forward stay scriptable
+        self.register_buffer('filterBank',torch.zeros(0))
+        self.register_buffer('rowBank',torch.zeros(0))
+        self.register_buffer('columnBank',torch.zeros(0))
+        if self.separable:
+            self.padding = model.gaussSize//2
+            self.rowBank = model.edgeRowBank.detach().repeat(self.groups,1,1,1).float()
+            self.columnBank = model.edgeColumnBank.detach().repeat(self.groups,1,1,1).float()
+        else:
+            #The fused 15x15 bank computes exactly what the 'split' front-end does
+            self.padding = model.edgeFilterBank.shape[-1]//2
+            self.filterBank = model.edgeFilterBank.detach().repeat(self.groups,1,1,1).float()
+        numStages = len(model.trunkStages)
+        self.sharedTrunk = foldTrunk(model,range(model.sharedStages),'Class')
+        self.classTrunk = foldTrunk(model,range(model.sharedStages,numStages),'Class')
+        self.rTrunk = foldTrunk(model,range(model.sharedStages,numStages),'R')
+        self.pool = copy.deepcopy(model.averagePoolClass)
+        self.classHead = foldSequential(model.fullConClass)
+        self.rHead = foldSequential(model.fullConR)
+        if self.channelsLast:
+            self.to(memory_format = torch.channels_last)
+    def edgeFilters(self,x):
+        #Same input as EdgeNet.splitMetrics: the red channel, the luminance, or all three channels
+        if self.colorMode == 'luminance':
+            x = torch.nn.functional.conv2d(x,self.lumaWeights)
+        elif self.colorMode == 'red':
+            x = x[:,0:1]
+        if self.separable:
+            x = torch.nn.functional.conv2d(x,self.rowBank,padding = (0,self.padding),groups = self.groups)
+            return torch.nn.functional.conv2d(x,self.columnBank,padding = (self.padding,0),groups = 3*self.groups)
+        return torch.nn.functional.conv2d(x,self.filterBank,padding = self.padding,groups = self.groups)
+    def forward(self,x):
+        return self.forwardFiltered(self.edgeFilters(x))
+    def forwardFiltered(self,x):
+        #Everything after the front-end, for callers that run edgeFilters separately
+        if self.channelsLast:
+            x = x.contiguous(memory_format = torch.channels_last)
+        x = self.sharedTrunk(x)
+        xClass = self.classTrunk(x)
+        xR = self.rTrunk(x)
+        if self.headless:
+            return xClass,xR
+        xClass = self.classHead(torch.flatten(self.pool(xClass),1))
+        xR = self.rHead(torch.flatten(self.pool(xR),1))
+        return xClass,xR
+
+def freezeEdgeNet(model):
+    #Returns a FrozenEdgeNet in eval mode on the model's device. Layers are copied as they are folded, so the source
+    #model keeps its weights and its train/eval mode
+    training = model.training
+    frozen = FrozenEdgeNet(model.eval()).eval()
+    model.train(training)
+    return frozen
+
+exportMethods = ('export','script','trace')
+
+def exportEdgeNet(model,path,method = 'export',batchSize = 8):
+    #Freezes model and saves it as a self-contained artifact: 'export' writes a torch.export program (.pt2), 'script' and
+    #'trace' write TorchScript. All of them keep the batch size dynamic
+    if method not in exportMethods:
+        raise ValueError("method must be one of %s, got %r" % (', '.join(exportMethods),method))
+    frozen = freezeEdgeNet(model)
+    device = next(frozen.parameters()).device
+    example = torch.rand(batchSize,3,32,32,device = device)*255.
+    with torch.no_grad():
+        if method == 'script':
+            torch.jit.save(torch.jit.script(frozen),path)
+        elif method == 'trace':
+            torch.jit.save(torch.jit.trace(frozen,example),path)
+        else:
+            batch = torch.export.Dim('batch',min = 1)
+            program = torch.export.export(frozen,(example,),dynamic_shapes = ({0 : batch},))
+            torch.export.save(program,path)
+    return path
+
+def loadArtifact(path,device = 'cpu'):
+    #Loads an exportEdgeNet artifact as a callable module in eval mode; needs only torch
+    if str(path).endswith('.pt2'):
+        return torch.export.load(path).module().to(device)
+    return torch.jit.load(path,map_location = device).eval()
+
+def addModelArguments(parser):
+    #EdgeNet constructor and checkpoint options shared by the command-line tools
+    parser.add_argument('--checkpoint',help = "EdgeNet state_dict saved with torch.save, or a pruned/distilled model saved "
+                        "with prune.saveEdgeNet (random weights if omitted)")
+    parser.add_argument('--front-end',default = 'fused',choices = ['split','fused','separable'])
+    parser.add_argument('--color-mode',default = 'red',choices = ['red','luminance','rgb'],
+                        help = "Edge filter input: red channel, luminance, or every RGB channel")
+    parser.add_argument('--gauss-size',type = int,default = 9)
+    parser.add_argument('--gauss-sigma',type = float,default = 1.2)
+    parser.add_argument('--shared-stages',type = int,default = 0)
+    parser.add_argument('--head',default = 'vgg',choices = ['vgg','compact'])
+    parser.add_argument('--head-pool',type = int,default = 1)
+    parser.add_argument('--head-width',type = int,default = 512)
+    parser.add_argument('--precision',default = 'fp32',choices = ['fp32','bf16','fp16'])
+    parser.add_argument('--channels-last',action = 'store_true')
+    parser.add_argument('--checkpoint-stages',type = int,nargs = '*',default = [],
+                        help = "Trunk stages (0-7) recomputed in backward instead of storing activations")
+
+def loadEdgeNet(args,device = 'cpu'):
+    #Builds the EdgeNet described by addModelArguments options, in eval mode on device. A checkpoint written by
+    #prune.saveEdgeNet (pruned or distilled) carries its own layer-shaping options, which override the matching ones,
+    #and its trunk widths
+    checkpoint = torch.load(args.checkpoint,map_location = 'cpu',weights_only = True) if args.checkpoint else None
+    options = {'frontEnd' : args.front_end,'colorMode' : args.color_mode,'gaussSize' : args.gauss_size,
+               'gaussSigma' : args.gauss_sigma,'sharedStages' : args.shared_stages,'head' : args.head,
+               'headPool' : args.head_pool,'headWidth' : args.head_width}
+    resized = checkpoint is not None and 'widths' in checkpoint
+    if resized:
+        options.update(checkpoint['architecture'])
+    model = EdgeNet(3,5,4,0,precision = args.precision,channelsLast = args.channels_last,
+                    checkpointStages = args.checkpoint_stages,**options)
+    if resized:
+        #Imported here, prune builds on this module
+        from prune import resizeEdgeNet
+        resizeEdgeNet(model,checkpoint['widths'])
+        checkpoint = checkpoint['stateDict']
+    if checkpoint is not None:
+        model.load_state_dict(checkpoint)
+    return model.to(device).eval()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Export a trained EdgeNet as a TorchScript or torch.export artifact")
+    addModelArguments(parser)
+    parser.add_argument('--method',default = 'export',choices = exportMethods)
+    parser.add_argument('--out',required = True,help = "Artifact path, use a .pt2 suffix with --method export")
+    parser.add_argument('--device',default = 'cpu')
+    args = parser.parse_args()
+    exportEdgeNet(loadEdgeNet(args,args.device),args.out,args.method)
+    print("Saved %s artifact to %s" % (args.method,args.out))
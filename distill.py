@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------------------------------------------
+# Purpose: Knowledge distillation of a trained EdgeNet into a narrower student EdgeNet
+# Description: makeStudent builds an EdgeNet with the same Gauss/Sobel front-end and both outputs but a fraction of
+# the trunk width (and a compact head by default). distillStep trains it against a frozen teacher with
+#       alpha * T^2 * KL(teacher/T || student/T) + (1 - alpha) * CE(student, label)
+#     + beta * MSE(student bbox, teacher bbox) + (1 - beta) * MSE(student bbox, bbox)
+#       python distill.py --checkpoint teacher.pt --dataroot <PurdueShapes5 data dir> --width 0.25 --out student.pt
+#-------------------------------------------------------------------------------------------------------------------
+import argparse
+import time
+import types
+import torch
+from deploy import addModelArguments, loadEdgeNet
+from prune import pruneEdgeNet, saveEdgeNet
+from task3 import EdgeNet, PurdueShapes5DatasetNoise
+from trainer import makeGradScaler, evaluate
+
+def makeStudent(width,head = 'compact',headPool = 1,headWidth = 512,sharedStages = 0,frontEnd = 'fused',**kwargs):
+    #EdgeNet with every trunk width scaled by width (rounded up to a multiple of 8). The layers are sliced out of a
+    #full-width EdgeNet and then re-initialised, so the student starts from the usual init at its own fan-in
+    if not 0. < width <= 1.:
+        raise ValueError("width must be in (0, 1], got %r" % (width,))
+    student = EdgeNet(3,5,4,0,frontEnd = frontEnd,sharedStages = sharedStages,head = head,headPool = headPool,
+                      headWidth = headWidth,**kwargs)
+    pruneEdgeNet(student,1. - width)
+    for module in student.modules():
+        if isinstance(module,(torch.nn.Conv2d,torch.nn.BatchNorm2d,torch.nn.Linear)):
+            module.reset_parameters()
+    if student.channelsLast:
+        student.to(memory_format = torch.channels_last)
+    return student
+
+def frontEndKwargs(teacher):
+    #The teacher's Gauss/Sobel front-end (and precision/memory format) as EdgeNet keyword arguments, so the student sees
+    #exactly the same edge stack
+    return {'frontEnd' : teacher.frontEnd,'gaussSize' : teacher.gaussSize,'gaussSigma' : teacher.gaussSigma,
+            'colorMode' : teacher.colorMode,'precision' : teacher.precision,'channelsLast' : teacher.channelsLast}
+
+def distillationLoss(studentOutputs,teacherOutputs,batch,temperature = 4.,alpha = 0.5,beta = 0.5):
+    #Soft-label KL on the class logits (scaled by T^2 so its gradients match the hard-label loss) and teacher-matching
+    #MSE on the bbox regression, each mixed with the ordinary supervised loss
+    studentClass,studentR = studentOutputs
+    teacherClass,teacherR = teacherOutputs
+    softLoss = torch.nn.functional.kl_div(torch.nn.functional.log_softmax(studentClass.float()/temperature,dim = 1),
+                                          torch.nn.functional.log_softmax(teacherClass.float()/temperature,dim = 1),
+                                          reduction = 'batchmean',log_target = True)*temperature**2
+    hardLoss = torch.nn.functional.cross_entropy(studentClass,batch['label'])
+    teacherBBoxLoss = torch.nn.functional.mse_loss(studentR,teacherR)
+    bboxLoss = torch.nn.functional.mse_loss(studentR,batch['bbox'])
+    return alpha*softLoss + (1. - alpha)*hardLoss + beta*teacherBBoxLoss + (1. - beta)*bboxLoss
+
+def distillStep(student,teacher,optimizer,batch,device = 'cpu',scaler = None,**lossArgs):
+    #trainer.trainStep with the teacher's eval-mode outputs as extra targets
+    batch = {key : value.to(device) for key,value in batch.items()}
+    with torch.no_grad():
+        teacherOutputs = teacher(batch['image'])
+    optimizer.zero_grad()
+    loss = distillationLoss(student(batch['image']),teacherOutputs,batch,**lossArgs)
+    if scaler is None:
+        loss.backward()
+        optimizer.step()
+    else:
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+    return loss
+
+def distillEpochs(student,teacher,trainData,epochs = 1,batchSize = 32,learningRate = 1e-4,device = 'cpu',**lossArgs):
+    #trainer.trainEpochs for the student, with the teacher held in eval mode
+    loader = torch.utils.data.DataLoader(trainData,batch_size = batchSize,shuffle = True)
+    optimizer = torch.optim.SGD(student.parameters(),lr = learningRate,momentum = 0.9)
+    scaler = makeGradScaler(student,device)
+    teacher.eval()
+    for epoch in range(epochs):
+        student.train()
+        for batch in loader:
+            distillStep(student,teacher,optimizer,batch,device,scaler,**lossArgs)
+    return student
+
+def imagesPerSec(model,batchSize = 32,numIters = 5,device = 'cpu'):
+    images = torch.rand(batchSize,3,32,32,device = device)*255.
+    model.eval()
+    with torch.inference_mode():
+        model(images)
+        start = time.perf_counter()
+        for ii in range(numIters):
+            model(images)
+        if torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+    return batchSize*numIters/(time.perf_counter() - start)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Distil a trained EdgeNet (the teacher options) into a narrow student")
+    addModelArguments(parser)
+    parser.add_argument('--dataroot',required = True,help = "PurdueShapes5 data directory (test split), the train split "
+                        "is read from the torch-saved archives in the working directory")
+    parser.add_argument('--width',type = float,default = 0.25,help = "Student trunk width as a fraction of the teacher's")
+    parser.add_argument('--student-head-pool',type = int,default = 2)
+    parser.add_argument('--student-head-width',type = int,default = 256)
+    parser.add_argument('--temperature',type = float,default = 4.)
+    parser.add_argument('--alpha',type = float,default = 0.5,help = "Weight of the soft-label KL against cross-entropy")
+    parser.add_argument('--beta',type = float,default = 0.5,help = "Weight of teacher bbox matching against ground truth")
+    parser.add_argument('--epochs',type = int,default = 10)
+    parser.add_argument('--batch-size',type = int,default = 32)
+    parser.add_argument('--learning-rate',type = float,default = 1e-4)
+    parser.add_argument('--device',default = 'cpu')
+    parser.add_argument('--out',help = "Save the student (loadable with --checkpoint by every tool)")
+    args = parser.parse_args()
+    dls = types.SimpleNamespace(dataroot = args.dataroot)
+    trainData = PurdueShapes5DatasetNoise(dls,'train',None)
+    testData = PurdueShapes5DatasetNoise(dls,'test',None)
+    teacher = loadEdgeNet(args,args.device)
+    student = makeStudent(args.width,headPool = args.student_head_pool,headWidth = args.student_head_width,
+                          sharedStages = args.shared_stages,**frontEndKwargs(teacher)).to(args.device)
+    distillEpochs(student,teacher,trainData,args.epochs,args.batch_size,args.learning_rate,args.device,
+                  temperature = args.temperature,alpha = args.alpha,beta = args.beta)
+    print("model    params M  images/s  accuracy  bbox MSE")
+    for name,model in (('teacher',teacher),('student',student)):
+        print("%-7s  %8.1f  %8.1f  %8.3f  %8.2f" % ((name,sum(param.numel() for param in model.parameters())/1e6,
+              imagesPerSec(model,args.batch_size,device = args.device)) + evaluate(model,testData,device = args.device)))
+    if args.out:
+        saveEdgeNet(student,args.out)
+        print("Saved student to %s" % args.out)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------------------------------------------
+# Purpose: Data-parallel EdgeNet training over several processes (CPU cores or nodes)
+# Description: Every process trains a DistributedDataParallel replica on its DistributedSampler shard of
+# PurdueShapes5DatasetNoise with trainer.train, gradients are all-reduced over gloo, and rank 0 writes the
+# checkpoint (a plain EdgeNet state_dict, loadable with --checkpoint) after every epoch. On one machine it spawns the
+# processes itself; across nodes launch it with torchrun, which sets RANK/WORLD_SIZE/MASTER_ADDR:
+#       python distributed.py --nproc 4 --dataroot <PurdueShapes5 data dir> --out edgenet.pt
+#       torchrun --nnodes 2 --nproc-per-node 8 --rdzv-endpoint <host>:29500 distributed.py --dataroot ... --out ...
+#-------------------------------------------------------------------------------------------------------------------
+import argparse
+import os
+import time
+import types
+import torch
+import torch.distributed as dist
+from deploy import addModelArguments, loadEdgeNet
+from task3 import PurdueShapes5DatasetNoise
+from trainer import train, scaledLearningRate, makeLoader
+
+def worker(localRank,args):
+    #One training process. Spawned workers get their rank from mp.spawn, torchrun workers from the environment
+    rank = int(os.environ.get('RANK',localRank))
+    worldSize = int(os.environ.get('WORLD_SIZE',args.nproc))
+    localWorldSize = int(os.environ.get('LOCAL_WORLD_SIZE',args.nproc))
+    dist.init_process_group(args.backend,rank = rank,world_size = worldSize)
+    if args.device == 'cuda':
+        device = torch.device('cuda',int(os.environ.get('LOCAL_RANK',localRank)))
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cpu')
+        #Split the cores between the processes on this node instead of every process claiming all of them
+        torch.set_num_threads(max(1,(os.cpu_count() or 1)//localWorldSize))
+    torch.manual_seed(args.seed)
+    model = loadEdgeNet(args,device)
+    def localRankFirst(fn):
+        #Local rank 0 of each node runs fn (and writes whatever cache it fills) before the other ranks run it, so they
+        #map a complete cache instead of all building it at once
+        if int(os.environ.get('LOCAL_RANK',localRank)) != 0:
+            dist.barrier()
+        result = fn()
+        if int(os.environ.get('LOCAL_RANK',localRank)) == 0:
+            dist.barrier()
+        return result
+    dls = types.SimpleNamespace(dataroot = args.dataroot)
+    dataset = localRankFirst(lambda: PurdueShapes5DatasetNoise(dls,args.split,None,cache_dir = args.cache_dir))
+    if args.edge_cache:
+        #The checkpoint is an ordinary EdgeNet state_dict either way, the fixed front-end has no weights
+        localRankFirst(lambda: dataset.edgeCache(model,args.edge_cache))
+        model.preFiltered = True
+    if args.sync_batchnorm:
+        model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+    ddpModel = torch.nn.parallel.DistributedDataParallel(model,device_ids = [device.index] if device.type == 'cuda' else None)
+    sampler = torch.utils.data.distributed.DistributedSampler(dataset,num_replicas = worldSize,rank = rank,
+                                                              shuffle = True,seed = args.seed,drop_last = True)
+    loader = makeLoader(dataset,args.batch_size,args.workers,sampler = sampler,pinMemory = device.type == 'cuda')
+    #The global batch is batchSize*accumulationSteps per process times worldSize
+    globalBatch = args.batch_size*args.accumulation_steps*worldSize
+    learningRate = scaledLearningRate(args.learning_rate,globalBatch,args.base_batch_size,args.lr_scaling)
+    def checkpoint(epoch,ddpModel,optimizer):
+        if rank == 0 and args.out:
+            torch.save(model.state_dict(),args.out)
+            print("[epoch %d] saved %s" % (epoch + 1,args.out))
+        dist.barrier()
+    dist.barrier()
+    start = time.perf_counter()
+    train(ddpModel,dataset,args.epochs,args.batch_size,args.accumulation_steps,learningRate,warmupSteps = args.warmup_steps,
+          device = device,logEvery = args.log_every if rank == 0 else 0,loader = loader,onEpochEnd = checkpoint)
+    elapsed = time.perf_counter() - start
+    if rank == 0:
+        numSamples = len(loader)*args.batch_size*worldSize*args.epochs
+        print("processes %d  global batch %d  lr %.2e  samples/s %.1f" % (worldSize,globalBatch,learningRate,numSamples/elapsed))
+    dist.destroy_process_group()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Data-parallel EdgeNet training with DistributedDataParallel")
+    addModelArguments(parser)
+    parser.add_argument('--dataroot',required = True,help = "PurdueShapes5 data directory; the train split reads the "
+                        "torch-saved archives in the working directory, the test split the .gz files in dataroot")
+    parser.add_argument('--split',default = 'train',choices = ['train','test'])
+    parser.add_argument('--cache-dir',help = "Memory-mapped dataset cache, shared by all processes on a node")
+    parser.add_argument('--edge-cache',help = "Precompute the Gauss/Sobel edge stacks into this directory and train on them")
+    parser.add_argument('--nproc',type = int,default = 2,help = "Processes to spawn when not launched by torchrun")
+    parser.add_argument('--backend',default = 'gloo',choices = ['gloo','nccl'])
+    parser.add_argument('--device',default = 'cpu',choices = ['cpu','cuda'])
+    parser.add_argument('--sync-batchnorm',action = 'store_true',help = "Batch statistics over all processes (CUDA only)")
+    parser.add_argument('--epochs',type = int,default = 1)
+    parser.add_argument('--batch-size',type = int,default = 16,help = "Micro-batch per process")
+    parser.add_argument('--accumulation-steps',type = int,default = 1)
+    parser.add_argument('--learning-rate',type = float,default = 1e-4,help = "Learning rate at --base-batch-size")
+    parser.add_argument('--base-batch-size',type = int,default = 4)
+    parser.add_argument('--lr-scaling',default = 'linear',choices = ['linear','sqrt','none'])
+    parser.add_argument('--warmup-steps',type = int,default = 100)
+    parser.add_argument('--workers',type = int,default = 0,help = "DataLoader workers per process")
+    parser.add_argument('--log-every',type = int,default = 50)
+    parser.add_argument('--seed',type = int,default = 0)
+    parser.add_argument('--port',type = int,default = 29500)
+    parser.add_argument('--out',help = "Checkpoint written by rank 0 after every epoch")
+    args = parser.parse_args()
+    if args.sync_batchnorm and args.device != 'cuda':
+        parser.error("--sync-batchnorm needs --device cuda, torch's SyncBatchNorm has no CPU kernels")
+    if 'RANK' in os.environ:
+        worker(int(os.environ.get('LOCAL_RANK',0)),args)
+    else:
+        os.environ.setdefault('MASTER_ADDR','127.0.0.1')
+        os.environ.setdefault('MASTER_PORT',str(args.port))
+        torch.multiprocessing.spawn(worker,args = (args,),nprocs = args.nproc)
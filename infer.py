@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------------------------------------------
+# Purpose: Streaming batch inference of a trained EdgeNet over an image corpus
+# Description: Streams images from a directory tree, PurdueShapes5 .gz pickles / torch-saved .pt archives, or a tar
+# file through a three-stage pipeline connected by bounded queues: a reader thread decodes and batches, a second
+# thread runs the Gauss/Sobel front-end, and the main thread runs the frozen model and appends each batch's
+# predictions (label, confidence, noise level, bbox) to a CSV or Parquet file. At most --prefetch batches wait between
+# stages, so memory stays flat however large the corpus is (a .gz/.pt archive is one pickle and is loaded whole, one
+# archive at a time).
+#       python infer.py --checkpoint edgenet.pt --head compact images/ PurdueShapes5-1000-test.gz --out predictions.csv
+#-------------------------------------------------------------------------------------------------------------------
+import argparse
+import csv
+import io
+import os
+import queue
+import tarfile
+import threading
+import time
+import numpy as np
+import torch
+from deploy import addModelArguments, loadEdgeNet, freezeEdgeNet
+from task3 import testSources, readPurdueShapes5Archive
+
+imageSuffixes = ('.png','.jpg','.jpeg','.bmp','.gif','.tif','.tiff')
+#Noise level (percent) each label of the task3 model stands for
+noiseLevels = {noiseLabel : int(fileName.split('noise-')[1].split('.')[0]) if 'noise-' in fileName else 0
+               for fileName,noiseLabel in testSources}
+columns = ['id','label','confidence','noise_level','xmin','ymin','xmax','ymax']
+
+def decodeImageBytes(data):
+    #Image file bytes to a uint8 (3,32,32) tensor, resized if the image is not 32x32
+    from PIL import Image
+    image = Image.open(io.BytesIO(data)).convert('RGB')
+    if image.size != (32,32):
+        image = image.resize((32,32),Image.BILINEAR)
+    return torch.from_numpy(np.asarray(image).copy()).permute(2,0,1)
+
+def archiveImages(path):
+    #Yields (id, image) for every record of a PurdueShapes5 .gz pickle or torch-saved .pt archive, in index order
+    records = readPurdueShapes5Archive(path)[0]
+    name = os.path.basename(path)
+    for idx in sorted(records):
+        yield '%s:%d' % (name,idx),torch.tensor(np.array(records[idx][:3],dtype = np.float32).reshape(3,32,32))
+    del records
+
+def tarImages(path):
+    #Yields (id, image) for the image members of a tar file, reading it as a stream
+    with tarfile.open(path,'r|*') as archive:
+        for member in archive:
+            if member.isfile() and member.name.lower().endswith(imageSuffixes):
+                yield '%s:%s' % (os.path.basename(path),member.name),decodeImageBytes(archive.extractfile(member).read())
+
+def directoryImages(path):
+    #Yields (id, image) for the image files under a directory, in sorted order
+    for root,dirs,files in os.walk(path):
+        dirs.sort()
+        for fileName in sorted(files):
+            if fileName.lower().endswith(imageSuffixes):
+                with open(os.path.join(root,fileName),'rb') as f:
+                    yield os.path.relpath(os.path.join(root,fileName),path),decodeImageBytes(f.read())
+
+def corpusImages(inputs):
+    #Yields (id, image) over every input: directories, .gz/.pt archives, tar files and single image files
+    for path in inputs:
+        if os.path.isdir(path):
+            yield from directoryImages(path)
+        elif path.endswith('.gz') and not path.endswith('.tar.gz'):
+            yield from archiveImages(path)
+        elif path.endswith('.pt'):
+            yield from archiveImages(path)
+        elif tarfile.is_tarfile(path):
+            yield from tarImages(path)
+        elif path.lower().endswith(imageSuffixes):
+            with open(path,'rb') as f:
+                yield path,decodeImageBytes(f.read())
+        else:
+            raise ValueError("don't know how to read %r" % (path,))
+
+def batched(images,batchSize):
+    #Groups (id, image) pairs into (ids, float image batch)
+    ids,batch = [],[]
+    for imageId,image in images:
+        ids.append(imageId)
+        batch.append(image)
+        if len(batch) == batchSize:
+            yield ids,torch.stack(batch).float()
+            ids,batch = [],[]
+    if batch:
+        yield ids,torch.stack(batch).float()
+
+class Stage(threading.Thread):
+    #Runs fn over the items of source in a daemon thread and hands the results on through a bounded queue; iterating a
+    #Stage yields them in order and re-raises any exception from the thread
+    done = object()
+    def __init__(self,fn,source,depth = 2):
+        super(Stage, self).__init__(daemon = True)
+        self.fn = fn
+        self.source = source
+        self.queue = queue.Queue(maxsize = depth)
+        self.start()
+    def run(self):
+        try:
+            for item in self.source:
+                self.queue.put(self.fn(item))
+        except BaseException as error:
+            self.queue.put(error)
+            return
+        self.queue.put(self.done)
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is self.done:
+                return
+            if isinstance(item,BaseException):
+                raise item
+            yield item
+
+class CSVWriter(object):
+    def __init__(self,path):
+        self.file = open(path,'w',newline = '')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+    def write(self,rows):
+        self.writer.writerows(zip(*(rows[column] for column in columns)))
+        self.file.flush()
+    def close(self):
+        self.file.close()
+
+class ParquetWriter(object):
+    #Appends each batch as a row group; needs pyarrow
+    def __init__(self,path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output needs pyarrow (pip install pyarrow), or write .csv instead")
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([('id',pyarrow.string()),('label',pyarrow.int64()),('confidence',pyarrow.float32()),
+                                      ('noise_level',pyarrow.int64())] +
+                                     [(name,pyarrow.float32()) for name in ('xmin','ymin','xmax','ymax')])
+        self.writer = pyarrow.parquet.ParquetWriter(path,self.schema)
+    def write(self,rows):
+        self.writer.write_table(self.pyarrow.Table.from_pydict(rows,schema = self.schema))
+    def close(self):
+        self.writer.close()
+
+def predictionRows(ids,outputs):
+    #Column lists for one batch of (class logits, bbox) outputs
+    logits,bboxes = outputs
+    confidence,labels = torch.softmax(logits.float(),dim = 1).max(dim = 1)
+    labels = labels.tolist()
+    bboxes = bboxes.float()
+    return {'id' : ids,'label' : labels,'confidence' : confidence.tolist(),
+            'noise_level' : [noiseLevels.get(label,-1) for label in labels],
+            'xmin' : bboxes[:,0].tolist(),'ymin' : bboxes[:,1].tolist(),'xmax' : bboxes[:,2].tolist(),'ymax' : bboxes[:,3].tolist()}
+
+def runInference(model,inputs,out,batchSize = 256,prefetch = 2,pipelined = True):
+    #Streams every image of inputs through model (a FrozenEdgeNet-like module with edgeFilters/forwardFiltered) into
+    #out (.csv or .parquet). pipelined=False runs the stages one after another in this thread. Returns (images written,
+    #seconds)
+    if prefetch < 1:
+        raise ValueError("prefetch must be at least 1, got %r" % (prefetch,))
+    writer = ParquetWriter(out) if out.endswith('.parquet') else CSVWriter(out)
+    device = next(model.parameters()).device
+    def preprocess(batch):
+        ids,images = batch
+        with torch.inference_mode():
+            return ids,model.edgeFilters(images.to(device))
+    numImages = 0
+    start = time.perf_counter()
+    try:
+        batches = batched(corpusImages(inputs),batchSize)
+        if pipelined:
+            batches = Stage(preprocess,Stage(lambda batch: batch,batches,prefetch),prefetch)
+        else:
+            batches = map(preprocess,batches)
+        for ids,filtered in batches:
+            with torch.inference_mode():
+                outputs = model.forwardFiltered(filtered)
+            writer.write(predictionRows(ids,outputs))
+            numImages += len(ids)
+    finally:
+        writer.close()
+    return numImages,time.perf_counter() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Stream images through a trained EdgeNet and write the predictions")
+    addModelArguments(parser)
+    parser.add_argument('inputs',nargs = '+',help = "Image directories, PurdueShapes5 .gz/.pt archives, tar files or images")
+    parser.add_argument('--out',required = True,help = "Predictions file, .csv or .parquet")
+    parser.add_argument('--batch-size',type = int,default = 256)
+    parser.add_argument('--prefetch',type = int,default = 2,help = "Batches queued between pipeline stages")
+    parser.add_argument('--device',default = 'cpu')
+    args = parser.parse_args()
+    model = freezeEdgeNet(loadEdgeNet(args,args.device))
+    numImages,seconds = runInference(model,args.inputs,args.out,args.batch_size,args.prefetch)
+    print("Wrote %d predictions to %s in %.1f s (%.1f images/s)" % (numImages,args.out,seconds,numImages/seconds))
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------------------------------------------
+# Purpose: Structured channel pruning of the EdgeNet trunks
+# Description: pruneEdgeNet ranks the output channels of every trunk conv by their BatchNorm scale (or by their mean
+# activation over a few batches) and physically removes the weakest ones, shrinking the producing conv/BatchNorm and
+# the input side of every layer that reads them: the next conv, both branches' first conv after a shared trunk, the
+# skip conv, and the first Linear of each head. A stage closed by a skip connection adds its output to the skip
+# branch channel by channel, so the stage's last conv and its skip conv form one group and lose the same channels.
+# The pruned model is still an EdgeNet (freeze/export/quantize work unchanged). saveEdgeNet writes it with its widths,
+# and every tool's --checkpoint (deploy.loadEdgeNet) rebuilds it from that file.
+#       python prune.py --checkpoint edgenet.pt --sparsity 0.5 --dataroot <PurdueShapes5 data dir> --out pruned.pt
+#-------------------------------------------------------------------------------------------------------------------
+import argparse
+import types
+import torch
+from deploy import addModelArguments, loadEdgeNet
+from task3 import PurdueShapes5DatasetNoise
+from trainer import trainEpochs, evaluate
+
+def channelGroups(model):
+    #Returns the trunk's channel groups, each {'producers': [(conv, batchNorm)], 'consumers': [conv or head Linear]}:
+    #channels every producer writes together and every consumer reads, so they can only be removed together
+    groups = []
+    def walk(branch,stages,group):
+        for stage in stages:
+            stageName,skipIdx = model.trunkStages[stage]
+            layers = list(getattr(model,stageName + 'ConvLayerSmooth' + branch))
+            for ii,layer in enumerate(layers):
+                if isinstance(layer,torch.nn.Conv2d):
+                    if group is not None:
+                        group['consumers'].append(layer)
+                    group = {'producers' : [(layer,layers[ii + 1])],'consumers' : []}
+                    groups.append(group)
+            if skipIdx:
+                suffix = '' if branch == 'Class' else 'R'
+                conv = getattr(model,'skipConv%d%s' % (skipIdx,suffix))
+                group['consumers'].append(conv)
+                group['producers'].append((conv,getattr(model,'skipBatchNorm%d%s' % (skipIdx,suffix))))
+        return group
+    #The front-end's three edge channels are fixed, so the first conv only starts a group
+    shared = walk('Class',range(model.sharedStages),None)
+    stages = range(model.sharedStages,len(model.trunkStages))
+    walk('Class',stages,shared)['consumers'].append(model.fullConClass[0])
+    walk('R',stages,shared)['consumers'].append(model.fullConR[0])
+    return groups
+
+def bnScores(group):
+    #Channel importance as the summed |gamma| of the group's BatchNorms
+    return sum(batchNorm.weight.detach().abs() for conv,batchNorm in group['producers'])
+
+def activationScores(model,groups,batches):
+    #Channel importance as the summed mean post-ReLU activation of the group's producers over batches
+    totals = {}
+    def hook(module,inputs,output):
+        totals[module] = totals.get(module,0.) + torch.relu(output.detach().float()).mean(dim = (0,2,3))
+    batchNorms = [batchNorm for group in groups for conv,batchNorm in group['producers']]
+    handles = [batchNorm.register_forward_hook(hook) for batchNorm in batchNorms]
+    training = model.training
+    model.eval()
+    with torch.no_grad():
+        for images in batches:
+            model(images)
+    model.train(training)
+    for handle in handles:
+        handle.remove()
+    return [sum(totals[batchNorm] for conv,batchNorm in group['producers']) for group in groups]
+
+def shrink(module,name,keep,dim):
+    #Replaces module.<name> with its slice along dim, keeping a Parameter a Parameter
+    tensor = getattr(module,name)
+    if tensor is None:
+        return
+    sliced = tensor.detach().index_select(dim,keep.to(tensor.device)).clone()
+    setattr(module,name,torch.nn.Parameter(sliced,requires_grad = tensor.requires_grad) if isinstance(tensor,torch.nn.Parameter) else sliced)
+
+def pruneGroup(group,keep):
+    #Keeps only channels keep (sorted indices) of one group, in every producer and consumer
+    numChannels = group['producers'][0][0].out_channels
+    for conv,batchNorm in group['producers']:
+        shrink(conv,'weight',keep,0)
+        shrink(conv,'bias',keep,0)
+        conv.out_channels = len(keep)
+        for name in ('weight','bias','running_mean','running_var'):
+            shrink(batchNorm,name,keep,0)
+        batchNorm.num_features = len(keep)
+    for consumer in group['consumers']:
+        if isinstance(consumer,torch.nn.Linear):
+            #Flattened pooled features are channel-major, each channel owns poolArea consecutive inputs
+            poolArea = consumer.in_features//numChannels
+            columns = (keep.view(-1,1)*poolArea + torch.arange(poolArea)).view(-1)
+            shrink(consumer,'weight',columns,1)
+            consumer.in_features = len(columns)
+        else:
+            shrink(consumer,'weight',keep,1)
+            consumer.in_channels = len(keep)
+
+def pruneEdgeNet(model,sparsity,criterion = 'bn',batches = None,multiple = 8):
+    #Removes a sparsity fraction of the channels of every trunk group in place, keeping the highest scoring ones
+    #(rounded up to a multiple of multiple, for kernel-friendly widths). criterion 'activation' needs batches of images.
+    #Returns model; optimizers built on it before pruning hold stale parameters and must be rebuilt
+    if not 0. <= sparsity < 1.:
+        raise ValueError("sparsity must be in [0, 1), got %r" % (sparsity,))
+    if criterion not in ('bn','activation'):
+        raise ValueError("criterion must be 'bn' or 'activation', got %r" % (criterion,))
+    groups = channelGroups(model)
+    scores = [bnScores(group) for group in groups] if criterion == 'bn' else activationScores(model,groups,batches)
+    with torch.no_grad():
+        for group,score in zip(groups,scores):
+            numChannels = len(score)
+            numKeep = min(numChannels,-(-int(round(numChannels*(1. - sparsity)))//multiple)*multiple)
+            keep = torch.sort(torch.topk(score.cpu(),numKeep).indices).values
+            pruneGroup(group,keep)
+    if model.channelsLast:
+        model.to(memory_format = torch.channels_last)
+    return model
+
+def trunkWidths(model):
+    #Output width of every trunk group, in the order channelGroups lists them
+    return [group['producers'][0][0].out_channels for group in channelGroups(model)]
+
+def resizeEdgeNet(model,widths):
+    #Shrinks every trunk group of a freshly built model to widths (keeping its leading channels), so the weights of a
+    #pruned or distilled model saved with saveEdgeNet fit it. Returns model
+    groups = channelGroups(model)
+    if len(widths) != len(groups):
+        raise ValueError("expected %d trunk widths, got %d" % (len(groups),len(widths)))
+    with torch.no_grad():
+        for group,width in zip(groups,widths):
+            if width != group['producers'][0][0].out_channels:
+                pruneGroup(group,torch.arange(width))
+    if model.channelsLast:
+        model.to(memory_format = torch.channels_last)
+    return model
+
+def saveEdgeNet(model,path):
+    #Checkpoint for models whose trunk widths differ from EdgeNet's: the state_dict plus the widths and the options that
+    #shape the layers. deploy.loadEdgeNet rebuilds the model from it, so pruned and distilled models reach
+    #freeze/export/quantize/serve like any other checkpoint
+    architecture = {'sharedStages' : model.sharedStages,'head' : model.head,'headPool' : model.averagePoolClass.output_size[0],
+                    'headWidth' : model.fullConClass[0].out_features,'colorMode' : model.colorMode,'frontEnd' : model.frontEnd,
+                    'gaussSize' : model.gaussSize,'gaussSigma' : model.gaussSigma}
+    torch.save({'architecture' : architecture,'widths' : trunkWidths(model),'stateDict' : model.state_dict()},path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Prune the EdgeNet trunks to a channel sparsity, fine-tune and evaluate")
+    addModelArguments(parser)
+    parser.add_argument('--dataroot',required = True,help = "PurdueShapes5 data directory (test split), the train split "
+                        "is read from the torch-saved archives in the working directory")
+    parser.add_argument('--sparsity',type = float,default = 0.5)
+    parser.add_argument('--criterion',default = 'bn',choices = ['bn','activation'])
+    parser.add_argument('--epochs',type = int,default = 1,help = "Fine-tuning epochs after pruning")
+    parser.add_argument('--batch-size',type = int,default = 32)
+    parser.add_argument('--learning-rate',type = float,default = 1e-4)
+    parser.add_argument('--device',default = 'cpu')
+    parser.add_argument('--out',help = "Save the pruned, fine-tuned model (loadable with --checkpoint)")
+    args = parser.parse_args()
+    dls = types.SimpleNamespace(dataroot = args.dataroot)
+    trainData = PurdueShapes5DatasetNoise(dls,'train',None)
+    testData = PurdueShapes5DatasetNoise(dls,'test',None)
+    model = loadEdgeNet(args,args.device)
+    print("before pruning: accuracy %.3f, bbox MSE %.2f" % evaluate(model,testData,device = args.device))
+    batches = None
+    if args.criterion == 'activation':
+        order = torch.randperm(len(trainData))[:256]
+        batches = [trainData[order[ii:ii + 64]]['image'].to(args.device) for ii in range(0,len(order),64)]
+    pruneEdgeNet(model,args.sparsity,args.criterion,batches)
+    print("pruned widths: %s" % trunkWidths(model))
+    print("after pruning: accuracy %.3f, bbox MSE %.2f" % evaluate(model,testData,device = args.device))
+    trainEpochs(model,trainData,args.epochs,args.batch_size,args.learning_rate,args.device)
+    print("after fine-tuning: accuracy %.3f, bbox MSE %.2f" % evaluate(model,testData,device = args.device))
+    if args.out:
+        saveEdgeNet(model,args.out)
+        print("Saved pruned model to %s" % args.out)
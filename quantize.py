@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------------------------------------------
+# Purpose: Post-training int8 quantization of EdgeNet for CPU serving
+# Description: quantizeEdgeNet freezes a trained EdgeNet (deploy.freezeEdgeNet), statically quantizes the conv trunks
+# to int8 with activation ranges calibrated on PurdueShapes5DatasetNoise images, and dynamically quantizes the Linear
+# heads. The Gauss/Sobel front-end stays in float. reportQuantization prints size, latency and per-task accuracy of
+# the int8 model against fp32:
+#       python quantize.py --checkpoint edgenet.pt --dataroot <PurdueShapes5 data dir> --out edgenet-int8.ts
+#-------------------------------------------------------------------------------------------------------------------
+import argparse
+import io
+import time
+import types
+import torch
+import torch.ao.quantization as quantization
+from deploy import SkipAdd, FrozenEdgeNet, addModelArguments, loadEdgeNet
+from task3 import PurdueShapes5DatasetNoise
+
+class QuantSkipAdd(torch.nn.Module):
+    #SkipAdd with the conv and ReLU fused and the add done by a FloatFunctional, so both run in int8
+    def __init__(self,skipAdd):
+        super(QuantSkipAdd, self).__init__()
+        self.conv = torch.ao.nn.intrinsic.ConvReLU2d(skipAdd.conv,torch.nn.ReLU())
+        self.add = torch.ao.nn.quantized.FloatFunctional()
+    def forward(self,x):
+        return self.add.add(self.conv(x),x)
+
+def fuseTrunk(trunk):
+    #Copies a frozen trunk with every Conv2d/ReLU pair fused into one ConvReLU2d and SkipAdds made quantizable
+    layers = []
+    for layer in trunk:
+        if isinstance(layer,torch.nn.ReLU) and layers and isinstance(layers[-1],torch.nn.Conv2d):
+            layers[-1] = torch.ao.nn.intrinsic.ConvReLU2d(layers[-1],torch.nn.ReLU())
+        elif isinstance(layer,SkipAdd):
+            layers.append(QuantSkipAdd(layer))
+        else:
+            layers.append(layer)
+    return torch.nn.Sequential(*layers)
+
+class QuantizableEdgeNet(FrozenEdgeNet):
+    #FrozenEdgeNet with quant/dequant stubs around the conv trunks: the edge filters run in float, the trunks and
+    #pooling in int8 after convert(), and the heads take dequantized features
+    def __init__(self,model):
+        super(QuantizableEdgeNet, self).__init__(model)
+        self.channelsLast = False           #Quantized convs pick their own memory format
+        self.sharedTrunk = fuseTrunk(self.sharedTrunk)
+        self.classTrunk = fuseTrunk(self.classTrunk)
+        self.rTrunk = fuseTrunk(self.rTrunk)
+        self.quant = quantization.QuantStub()
+        self.dequantClass = quantization.DeQuantStub()
+        self.dequantR = quantization.DeQuantStub()
+    def forwardFiltered(self,x):
+        x = self.sharedTrunk(self.quant(x))
+        xClass = self.classTrunk(x)
+        xR = self.rTrunk(x)
+        if self.headless:
+            return self.dequantClass(xClass),self.dequantR(xR)
+        xClass = self.classHead(torch.flatten(self.dequantClass(self.pool(xClass)),1))
+        xR = self.rHead(torch.flatten(self.dequantR(self.pool(xR)),1))
+        return xClass,xR
+
+def calibrationBatches(dataset,numSamples = 512,batchSize = 64,seed = 0):
+    #Images of a random numSamples slice of dataset, in batches, for observing activation ranges
+    order = torch.randperm(len(dataset),generator = torch.Generator().manual_seed(seed))[:numSamples]
+    return [dataset[order[ii:ii + batchSize]]['image'] for ii in range(0,len(order),batchSize)]
+
+def quantizeEdgeNet(model,batches,backend = 'x86'):
+    #Returns an int8 copy of model for CPU inference: static int8 trunks calibrated on batches (an iterable of image
+    #tensors), dynamic int8 Linear heads, float edge filters. model itself is not modified
+    torch.backends.quantized.engine = backend
+    training = model.training
+    quantized = QuantizableEdgeNet(model.eval()).eval()
+    model.train(training)
+    quantized.qconfig = quantization.get_default_qconfig(backend)
+    quantized.classHead.qconfig = None          #Heads are dynamically quantized below, not calibrated
+    quantized.rHead.qconfig = None
+    quantization.prepare(quantized,inplace = True)
+    with torch.no_grad():
+        for images in batches:
+            quantized(images)
+    quantization.convert(quantized,inplace = True)
+    quantized.classHead = quantization.quantize_dynamic(quantized.classHead,{torch.nn.Linear},dtype = torch.qint8)
+    quantized.rHead = quantization.quantize_dynamic(quantized.rHead,{torch.nn.Linear},dtype = torch.qint8)
+    return quantized
+
+def serializedMB(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(),buffer)
+    return buffer.tell()/2**20
+
+def evaluateByNoiseLevel(model,testData,batchSize = 64):
+    #Returns (label accuracy, bbox MSE, {noise label: accuracy}, predicted labels) over testData. The dataset's labels
+    #are the noise levels of the source archives, so the per-level accuracies show where quantization error lands
+    predictions = []
+    squaredError = 0.
+    with torch.inference_mode():
+        for batch in testData.batchLoader(batchSize,shuffle = False):
+            outputsClass,outputsR = model(batch['image'])
+            predictions.append(outputsClass.argmax(1))
+            squaredError += torch.nn.functional.mse_loss(outputsR.float(),batch['bbox'],reduction = 'sum').item()
+    predictions = torch.cat(predictions)
+    correct = predictions == testData.labels
+    levelAccuracy = {level : correct[testData.labels == level].float().mean().item() for level in testData.labels.unique().tolist()}
+    return correct.float().mean().item(),squaredError/(4*len(testData)),levelAccuracy,predictions
+
+def reportQuantization(model,quantized,testData,batchSize = 64,numIters = 10):
+    #Prints size, per-batch latency, label accuracy, bbox MSE and per-noise-level accuracy of fp32 against int8
+    images = testData[list(range(min(batchSize,len(testData))))]['image']
+    levels = testData.labels.unique().tolist()
+    print("model  size MB  ms/batch  accuracy  bbox MSE  " + "  ".join("noise %d" % level for level in levels) + "  agree")
+    results = {}
+    for name,net in (('fp32',model.eval()),('int8',quantized)):
+        with torch.inference_mode():
+            net(images)
+            start = time.perf_counter()
+            for ii in range(numIters):
+                net(images)
+            batchSecs = (time.perf_counter() - start)/numIters
+        results[name] = evaluateByNoiseLevel(net,testData,batchSize)
+        accuracy,bboxMSE,levelAccuracy,predictions = results[name]
+        agreement = (predictions == results['fp32'][3]).float().mean().item()
+        print("%-5s  %7.1f  %8.2f  %8.3f  %8.2f  " % (name,serializedMB(net),1000*batchSecs,accuracy,bboxMSE) +
+              "  ".join("%7.3f" % levelAccuracy[level] for level in levels) + "  %5.3f" % agreement)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Post-training int8 quantization of a trained EdgeNet")
+    addModelArguments(parser)
+    parser.add_argument('--dataroot',required = True,help = "PurdueShapes5 data directory (test split), the train split "
+                        "is read from the torch-saved archives in the working directory")
+    parser.add_argument('--calibration-samples',type = int,default = 512)
+    parser.add_argument('--batch-size',type = int,default = 64)
+    parser.add_argument('--backend',default = 'x86',choices = ['x86','fbgemm','qnnpack','onednn'])
+    parser.add_argument('--out',help = "Save the int8 model as TorchScript")
+    args = parser.parse_args()
+    dls = types.SimpleNamespace(dataroot = args.dataroot)
+    model = loadEdgeNet(args)
+    batches = calibrationBatches(PurdueShapes5DatasetNoise(dls,'train',None),args.calibration_samples,args.batch_size)
+    quantized = quantizeEdgeNet(model,batches,args.backend)
+    reportQuantization(model,quantized,PurdueShapes5DatasetNoise(dls,'test',None),args.batch_size)
+    if args.out:
+        torch.jit.save(torch.jit.script(quantized),args.out)
+        print("Saved int8 model to %s" % args.out)
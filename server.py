@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------------------------------------------
+# Purpose: Micro-batching HTTP inference server for EdgeNet, and a load generator for it
+# Description: The model is loaded once (an exportEdgeNet artifact, or a checkpoint frozen with freezeEdgeNet).
+# Requests carrying one image are queued by an asyncio front-end; a batcher groups whatever is queued into batches of
+# up to --max-batch images, waiting at most --max-delay-ms for a batch to fill, and runs them on a pool of inference
+# threads (torch releases the GIL). Serves over TCP or a Unix socket:
+#       POST /predict   body: 3x32x32 uint8 (3072 bytes) or float32 (12288 bytes) CHW pixels, or JSON {"image": ...}
+#                       reply: {"label": int, "logits": [...], "bbox": [xmin, ymin, xmax, ymax]}
+#       GET  /stats     request/batch counters, throughput and p50/p99 latency in ms
+#       python server.py serve --checkpoint edgenet.pt --port 8080 --max-batch 32 --max-delay-ms 5
+#       python server.py load --port 8080 --concurrency 64 --requests 2000
+#-------------------------------------------------------------------------------------------------------------------
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import time
+import numpy as np
+import torch
+from deploy import addModelArguments, loadEdgeNet, freezeEdgeNet, loadArtifact
+
+imageShape = (3,32,32)
+
+def decodeImage(body,contentType):
+    #One request body to a float (3,32,32) tensor with [0,255] pixels
+    if contentType.startswith('application/json'):
+        return torch.tensor(json.loads(body)['image'],dtype = torch.float).view(imageShape)
+    if len(body) == 3*32*32:
+        return torch.frombuffer(bytearray(body),dtype = torch.uint8).view(imageShape).float()
+    if len(body) == 4*3*32*32:
+        return torch.frombuffer(bytearray(body),dtype = torch.float32).view(imageShape)
+    raise ValueError("expected 3072 uint8 or 12288 float32 bytes of CHW pixels, got %d bytes" % len(body))
+
+class MicroBatcher(object):
+    #Collects single-image requests into batches: a batch is dispatched as soon as it has maxBatch images or its first
+    #image has waited maxDelay seconds, and up to numWorkers batches run concurrently
+    def __init__(self,model,maxBatch = 32,maxDelay = 0.005,numWorkers = 1,windowSize = 10000):
+        self.model = model
+        self.maxBatch = maxBatch
+        self.maxDelay = maxDelay
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers = numWorkers)
+        self.slots = asyncio.Semaphore(numWorkers)
+        self.queue = asyncio.Queue()
+        self.latencies = collections.deque(maxlen = windowSize)        #Seconds from arrival to reply, recent requests
+        self.numRequests = 0
+        self.numBatches = 0
+        self.startTime = time.perf_counter()
+    async def predict(self,image):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image,future,time.perf_counter()))
+        return await future
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            #Wait for a free worker first, so requests keep batching up while every worker is busy
+            await self.slots.acquire()
+            pending = [await self.queue.get()]
+            deadline = pending[0][2] + self.maxDelay
+            while len(pending) < self.maxBatch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0 and self.queue.empty():
+                    break
+                try:
+                    pending.append(self.queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(self.queue.get(),timeout))
+                except (asyncio.TimeoutError,asyncio.QueueEmpty):
+                    break
+            task = loop.run_in_executor(self.pool,self.infer,torch.stack([image for image,future,arrival in pending]))
+            task.add_done_callback(lambda task,pending = pending: self.reply(task,pending))
+    def infer(self,images):
+        with torch.inference_mode():
+            logits,bboxes = self.model(images)
+        return logits.float().tolist(),bboxes.float().tolist()
+    def reply(self,task,pending):
+        self.slots.release()
+        now = time.perf_counter()
+        self.numBatches += 1
+        for ii,(image,future,arrival) in enumerate(pending):
+            if future.cancelled():
+                continue
+            if task.exception() is not None:
+                future.set_exception(task.exception())
+                continue
+            logits,bboxes = task.result()
+            future.set_result({'label' : int(np.argmax(logits[ii])),'logits' : logits[ii],'bbox' : bboxes[ii]})
+            self.latencies.append(now - arrival)
+            self.numRequests += 1
+    def stats(self):
+        latencies = 1000.*np.array(self.latencies) if self.latencies else np.zeros(1)
+        elapsed = time.perf_counter() - self.startTime
+        return {'requests' : self.numRequests,'batches' : self.numBatches,
+                'mean_batch_size' : self.numRequests/max(1,self.numBatches),
+                'requests_per_sec' : self.numRequests/elapsed,'p50_ms' : float(np.percentile(latencies,50)),
+                'p99_ms' : float(np.percentile(latencies,99))}
+
+async def readRequest(reader):
+    #Returns (method, path, headers, body) of the next HTTP/1.1 request, or None when the client has closed. Raises
+    #ValueError for a malformed request line, header or Content-Length
+    requestLine = await reader.readline()
+    if not requestLine.strip():
+        return None
+    parts = requestLine.decode('latin-1').split()
+    if len(parts) != 3:
+        raise ValueError("malformed request line %r" % requestLine.decode('latin-1').strip())
+    method,path,version = parts
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n',b'\n',b''):
+            break
+        if b':' not in line:
+            raise ValueError("malformed header line %r" % line.decode('latin-1').strip())
+        name,value = line.decode('latin-1').split(':',1)
+        headers[name.strip().lower()] = value.strip()
+    length = headers.get('content-length','0')
+    if not length.isdigit():
+        raise ValueError("invalid Content-Length %r" % length)
+    body = await reader.readexactly(int(length))
+    return method,path,headers,body
+
+def httpResponse(status,payload,close = False):
+    body = json.dumps(payload).encode()
+    reasons = {200 : 'OK',400 : 'Bad Request',404 : 'Not Found',500 : 'Internal Server Error'}
+    head = "HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n" % (
+           status,reasons[status],len(body),'close' if close else 'keep-alive')
+    return head.encode() + body
+
+def makeHandler(batcher):
+    async def handle(reader,writer):
+        #One keep-alive connection: requests are answered in order until the client closes
+        try:
+            while True:
+                try:
+                    request = await readRequest(reader)
+                except ValueError as error:
+                    #The stream position is unknown after a bad request, so answer it and drop the connection
+                    writer.write(httpResponse(400,{'error' : str(error)},close = True))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method,path,headers,body = request
+                close = headers.get('connection','').lower() == 'close'
+                if method == 'POST' and path == '/predict':
+                    try:
+                        image = decodeImage(body,headers.get('content-type',''))
+                    except (ValueError,TypeError,RuntimeError,KeyError) as error:
+                        response = httpResponse(400,{'error' : str(error)},close)
+                    else:
+                        try:
+                            response = httpResponse(200,await batcher.predict(image),close)
+                        except Exception as error:
+                            response = httpResponse(500,{'error' : str(error)},close)
+                elif method == 'GET' and path == '/stats':
+                    response = httpResponse(200,batcher.stats(),close)
+                else:
+                    response = httpResponse(404,{'error' : "unknown endpoint %s %s" % (method,path)},close)
+                writer.write(response)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError,asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    return handle
+
+async def startServer(model,host = '127.0.0.1',port = 8080,unixSocket = None,maxBatch = 32,maxDelay = 0.005,numWorkers = 1):
+    #Starts the batcher and the HTTP front-end on the running loop; returns (server, batcher, batcher task)
+    batcher = MicroBatcher(model,maxBatch,maxDelay,numWorkers)
+    batcherTask = asyncio.ensure_future(batcher.run())
+    if unixSocket:
+        server = await asyncio.start_unix_server(makeHandler(batcher),path = unixSocket)
+    else:
+        server = await asyncio.start_server(makeHandler(batcher),host,port)
+    return server,batcher,batcherTask
+
+async def openConnection(host,port,unixSocket):
+    if unixSocket:
+        return await asyncio.open_unix_connection(unixSocket)
+    return await asyncio.open_connection(host,port)
+
+async def postImage(reader,writer,payload):
+    writer.write(b"POST /predict HTTP/1.1\r\nHost: edgenet\r\nContent-Type: application/octet-stream\r\n"
+                 b"Content-Length: %d\r\n\r\n" % len(payload) + payload)
+    await writer.drain()
+    statusLine = await reader.readline()
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n',b''):
+            break
+        if line.lower().startswith(b'content-length:'):
+            length = int(line.split(b':')[1])
+    body = await reader.readexactly(length)
+    if b' 200 ' not in statusLine:
+        raise RuntimeError("server replied %s: %s" % (statusLine.decode().strip(),body.decode()))
+    return json.loads(body)
+
+async def runLoadGenerator(host = '127.0.0.1',port = 8080,unixSocket = None,concurrency = 32,numRequests = 1000,seed = 0):
+    #Closed-loop load: concurrency clients, each on its own keep-alive connection, send random uint8 images back to back
+    #until numRequests have been answered. Returns client-side (requests/sec, p50 ms, p99 ms)
+    rng = np.random.RandomState(seed)
+    payloads = [rng.randint(0,256,imageShape).astype(np.uint8).tobytes() for ii in range(64)]
+    latencies = []
+    remaining = [numRequests]
+    async def client(clientIdx):
+        reader,writer = await openConnection(host,port,unixSocket)
+        try:
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                start = time.perf_counter()
+                await postImage(reader,writer,payloads[(clientIdx + len(latencies)) % len(payloads)])
+                latencies.append(time.perf_counter() - start)
+        finally:
+            writer.close()
+    start = time.perf_counter()
+    await asyncio.gather(*[client(ii) for ii in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies = 1000.*np.array(latencies)
+    return len(latencies)/elapsed,float(np.percentile(latencies,50)),float(np.percentile(latencies,99))
+
+def loadServingModel(args):
+    #The exported artifact when given, else the checkpoint's EdgeNet frozen for inference
+    if args.artifact:
+        return loadArtifact(args.artifact)
+    return freezeEdgeNet(loadEdgeNet(args))
+
+async def serve(args):
+    model = loadServingModel(args)
+    server,batcher,batcherTask = await startServer(model,args.host,args.port,args.unix_socket,args.max_batch,
+                                                   args.max_delay_ms/1000.,args.workers)
+    print("Serving on %s" % (args.unix_socket or "http://%s:%d" % (args.host,args.port)))
+    async with server:
+        await server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "EdgeNet micro-batching inference server and load generator")
+    subparsers = parser.add_subparsers(dest = 'command',required = True)
+    serveParser = subparsers.add_parser('serve',help = "Run the inference server")
+    addModelArguments(serveParser)
+    serveParser.add_argument('--artifact',help = "exportEdgeNet artifact (.pt2 or TorchScript), instead of --checkpoint")
+    serveParser.add_argument('--max-batch',type = int,default = 32)
+    serveParser.add_argument('--max-delay-ms',type = float,default = 5.,help = "Longest a request waits for its batch to fill")
+    serveParser.add_argument('--workers',type = int,default = 1,help = "Inference threads (batches run concurrently)")
+    loadParser = subparsers.add_parser('load',help = "Closed-loop load generator against a running server")
+    loadParser.add_argument('--concurrency',type = int,default = 32)
+    loadParser.add_argument('--requests',type = int,default = 1000)
+    for subparser in (serveParser,loadParser):
+        subparser.add_argument('--host',default = '127.0.0.1')
+        subparser.add_argument('--port',type = int,default = 8080)
+        subparser.add_argument('--unix-socket',help = "Unix socket path, instead of TCP host/port")
+    args = parser.parse_args()
+    if args.command == 'serve':
+        asyncio.run(serve(args))
+    else:
+        requestsPerSec,p50,p99 = asyncio.run(runLoadGenerator(args.host,args.port,args.unix_socket,args.concurrency,args.requests))
+        print("%.1f requests/s  p50 %.1f ms  p99 %.1f ms" % (requestsPerSec,p50,p99))
@@ -39,28 +39,63 @@ import torchvision
 import random
 import numpy
 import numpy as np
+import contextlib
 import torch
+import torch.utils.checkpoint
 import os, sys
 import pdb
 from scipy.ndimage.filters import gaussian_filter
 import gzip
 import pickle
+import json
+import hashlib
+import concurrent.futures
 class EdgeNet(torch.nn.Module):
     #     #Class draws influence from VGG16 (K. Simonyan and A. Zisserman) but is quite distinct from it.
 #     #Models information and noise resolution in the central auditory system
-    def __init__(self,inChannels,numOutputs,numRegOutputs,edgeDetect = 1):
+    #Trunk stages in forward order, paired with the skip connection that closes each stage (0 for none)
+    trunkStages = (('first',0),('second',1),('third',2),('fourth',0),('fifth',3),('sixth',0),('seventh',4),('eigth',0))
+    autocastDtypes = {'bf16' : torch.bfloat16,'fp16' : torch.float16}
+    def __init__(self,inChannels,numOutputs,numRegOutputs,edgeDetect = 1,frontEnd = 'fused',gaussSize = 9,gaussSigma = 1.2,sharedStages = 0,
+                 head = 'vgg',headPool = 1,headWidth = 512,precision = 'fp32',channelsLast = False,checkpointStages = (),
+                 preFiltered = False,colorMode = 'red'):
         super(EdgeNet, self).__init__()
         self.inChannels = inChannels           #Image dimensionality subject to preprocessing
         self.numOutputs = numOutputs         #Output classification dimensionality. 
         self.numRegOutputs = numRegOutputs
         self.edgeDetect = edgeDetect
-        self.sobelKernelX = torch.tensor([[1.,0.,-1.],[2.,0.,-2.],[1.,0.,-1.]])
-        self.sobelKernelX = self.sobelKernelX.view(1,1,3,3).repeat(1,1,1,1)  #How to use custom kernels in pytorch idea was derived from: https://discuss.pytorch.org/t/setting-custom-kernel-for-cnn-in-pytorch/27176
-        self.sobelKernelY = torch.tensor([[1.,2.,1.],[0.,0.,0.],[-1.,-2.,-1.]])
-        self.sobelKernelY = self.sobelKernelY.view(1,1,3,3).repeat(1,1,1,1)
+        if frontEnd not in ('split','fused','separable'):
+            raise ValueError("frontEnd must be 'split', 'fused' or 'separable', got %r" % (frontEnd,))
+        if gaussSize < 3 or gaussSize % 2 == 0:
+            raise ValueError("gaussSize must be an odd number >= 3, got %r" % (gaussSize,))
+        self.frontEnd = frontEnd                #'split' runs three convs and concatenates, 'fused' runs one 3-output conv
+        self.gaussSize = gaussSize              #'separable' uses an analytic (gaussSize,gaussSigma) Gaussian as row/column passes
+        self.gaussSigma = gaussSigma
+        if not 0 <= sharedStages <= len(self.trunkStages):
+            raise ValueError("sharedStages must be between 0 and %d, got %r" % (len(self.trunkStages),sharedStages))
+        self.sharedStages = sharedStages        #First N trunk stages run once and feed both the Class and R branches
+        if head not in ('vgg','compact'):
+            raise ValueError("head must be 'vgg' or 'compact', got %r" % (head,))
+        self.head = head                        #'vgg' is the 1024*7*7->4096 head, 'compact' pools to headPool x headPool into a small MLP
+        if precision not in ('fp32','bf16','fp16'):
+            raise ValueError("precision must be 'fp32', 'bf16' or 'fp16', got %r" % (precision,))
+        self.precision = precision              #'bf16'/'fp16' autocast the trunks and heads, the edge front-end and outputs stay fp32
+        self.channelsLast = channelsLast        #Run the conv trunks in channels-last (NHWC) memory format
+        checkpointStages = tuple(sorted(set(checkpointStages)))
+        if any(stage not in range(len(self.trunkStages)) for stage in checkpointStages):
+            raise ValueError("checkpointStages must be trunk stage indices 0-%d, got %r" % (len(self.trunkStages) - 1,checkpointStages))
+        self.checkpointStages = checkpointStages    #Trunk stages whose activations are recomputed in backward instead of stored
+        self.preFiltered = preFiltered          #forward takes the edgeFilters stack (e.g. from a dataset edge cache), not images
+        if colorMode not in ('red','luminance','rgb'):
+            raise ValueError("colorMode must be 'red', 'luminance' or 'rgb', got %r" % (colorMode,))
+        self.colorMode = colorMode              #Edge filters see the red channel, the luminance, or each RGB channel (9 edge maps)
+        self.numEdgeChannels = 9 if colorMode == 'rgb' else 3
+        sobelKernelX = torch.tensor([[1.,0.,-1.],[2.,0.,-2.],[1.,0.,-1.]])
+        sobelKernelX = sobelKernelX.view(1,1,3,3).repeat(1,1,1,1)  #How to use custom kernels in pytorch idea was derived from: https://discuss.pytorch.org/t/setting-custom-kernel-for-cnn-in-pytorch/27176
+        sobelKernelY = torch.tensor([[1.,2.,1.],[0.,0.,0.],[-1.,-2.,-1.]])
+        sobelKernelY = sobelKernelY.view(1,1,3,3).repeat(1,1,1,1)
         #Gauss Kernel Generated by me in Matlab and transfered here
-        self.device = torch.device("cuda:0")
-        self.gaussKernel = torch.tensor([[0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0],
+        gaussKernel = torch.tensor([[0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0],
         [0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0],
         [0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0],
         [0,	0,	0,	0,	0,	0.000106542709594868,	0.000301935253041011,	0.000427277986095659,	0.000301935253041011,	0.000106542709594868,	0,	0,	0,	0,	0],
@@ -75,19 +110,32 @@ class EdgeNet(torch.nn.Module):
         [0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0],
         [0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0],
         [0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0]])
-        self.gaussFilter = self.gaussKernel.view(1,1,15,15).repeat(1,1,1,1)
-        self.gaussFilterNoGPU = self.gaussFilter
-        self.gaussFilter = self.gaussFilter.to(self.device)
-        self.sobelKernelX = self.sobelKernelX.to(self.device)
-        self.sobelKernelY = self.sobelKernelY.to(self.device)
-        self.grayTransforms = torchvision.transforms.Compose(
-            [torchvision.transforms.Grayscale(num_output_channels=3)]
-        )
-        self.averagePoolClass = torch.nn.AdaptiveAvgPool2d((7, 7))
-        self.averagePoolR = torch.nn.AdaptiveAvgPool2d((7, 7))
+        #Fixed filters are non-persistent buffers: they follow model.to(...) onto any device and stay out of checkpoints
+        self.register_buffer('gaussFilter',gaussKernel.view(1,1,15,15).repeat(1,1,1,1),persistent = False)
+        self.register_buffer('sobelKernelX',sobelKernelX,persistent = False)
+        self.register_buffer('sobelKernelY',sobelKernelY,persistent = False)
+        #Fused filter bank: Gauss, SobelX, SobelY stacked as output channels, Sobels zero-padded into the 15x15 footprint
+        edgeFilterBank = torch.zeros(3,1,15,15)
+        edgeFilterBank[0] = gaussKernel
+        edgeFilterBank[1,0,6:9,6:9] = sobelKernelX[0,0]
+        edgeFilterBank[2,0,6:9,6:9] = sobelKernelY[0,0]
+        self.register_buffer('edgeFilterBank',edgeFilterBank,persistent = False)
+        #Separable filter bank: every filter factors into column x row, SobelX = [1,2,1]'[1,0,-1] and SobelY = [1,0,-1]'[1,2,1]
+        gauss1d = self.makeGaussKernel1d(gaussSize,gaussSigma)
+        smooth1d = torch.zeros(gaussSize)
+        smooth1d[gaussSize//2-1:gaussSize//2+2] = torch.tensor([1.,2.,1.])
+        diff1d = torch.zeros(gaussSize)
+        diff1d[gaussSize//2-1:gaussSize//2+2] = torch.tensor([1.,0.,-1.])
+        self.register_buffer('edgeRowBank',torch.stack((gauss1d,diff1d,smooth1d)).view(3,1,1,gaussSize),persistent = False)
+        self.register_buffer('edgeColumnBank',torch.stack((gauss1d,smooth1d,diff1d)).view(3,1,gaussSize,1),persistent = False)
+        #ITU-R BT.601 luma weights as a 1x1 conv: the grayscale image is one weighted reduction over the RGB channels
+        self.register_buffer('lumaWeights',torch.tensor([0.299,0.587,0.114]).view(1,3,1,1),persistent = False)
+        headPoolSize = (7, 7) if head == 'vgg' else (headPool, headPool)
+        self.averagePoolClass = torch.nn.AdaptiveAvgPool2d(headPoolSize)
+        self.averagePoolR = torch.nn.AdaptiveAvgPool2d(headPoolSize)
         #Now define the network
         self.firstConvLayerSmoothClass = torch.nn.Sequential(
-            torch.nn.Conv2d(3,64,kernel_size = 3, padding = 1),
+            torch.nn.Conv2d(self.numEdgeChannels,64,kernel_size = 3, padding = 1),
             torch.nn.BatchNorm2d(64),
             torch.nn.ReLU(inplace = True)
         )
@@ -156,15 +204,18 @@ class EdgeNet(torch.nn.Module):
             torch.nn.BatchNorm2d(1024),
             torch.nn.ReLU(inplace = True),
         )
-        self.fullConClass = torch.nn.Sequential(
-            torch.nn.Linear(1024*7*7,4096),
-            torch.nn.ReLU(inplace = True),
-            torch.nn.Dropout(),
-            torch.nn.Linear(4096,1000),
-            torch.nn.ReLU(inplace = True),
-            torch.nn.Dropout(),
-            torch.nn.Linear(1000,numOutputs)
-        )
+        if head == 'vgg':
+            self.fullConClass = torch.nn.Sequential(
+                torch.nn.Linear(1024*7*7,4096),
+                torch.nn.ReLU(inplace = True),
+                torch.nn.Dropout(),
+                torch.nn.Linear(4096,1000),
+                torch.nn.ReLU(inplace = True),
+                torch.nn.Dropout(),
+                torch.nn.Linear(1000,numOutputs)
+            )
+        else:
+            self.fullConClass = self.makeCompactHead(1024*headPool*headPool,headWidth,numOutputs)
         self.skipBatchNorm1 = torch.nn.BatchNorm2d(128)
         self.skipConv1 = torch.nn.Conv2d(128,128,kernel_size = 3,padding = 1)
         self.skipBatchNorm2 = torch.nn.BatchNorm2d(256)
@@ -183,7 +234,7 @@ class EdgeNet(torch.nn.Module):
         self.skipConv4R = torch.nn.Conv2d(1024,1024,kernel_size = 3,padding = 1)
 
         self.firstConvLayerSmoothR = torch.nn.Sequential(
-            torch.nn.Conv2d(3,64,kernel_size = 3, padding = 1),
+            torch.nn.Conv2d(self.numEdgeChannels,64,kernel_size = 3, padding = 1),
             torch.nn.BatchNorm2d(64),
             torch.nn.ReLU(inplace = True)
         )
@@ -252,231 +303,500 @@ class EdgeNet(torch.nn.Module):
             torch.nn.BatchNorm2d(1024),
             torch.nn.ReLU(inplace = True),
         )
-        self.fullConR = torch.nn.Sequential(
-            torch.nn.Linear(1024*7*7,4096),
-            torch.nn.ReLU(inplace = True),
-            torch.nn.Dropout(),
-            torch.nn.Linear(4096,1024),
-            torch.nn.ReLU(inplace = True),
-            torch.nn.Dropout(),
-            torch.nn.Linear(1024,512),
+        if head == 'vgg':
+            self.fullConR = torch.nn.Sequential(
+                torch.nn.Linear(1024*7*7,4096),
+                torch.nn.ReLU(inplace = True),
+                torch.nn.Dropout(),
+                torch.nn.Linear(4096,1024),
+                torch.nn.ReLU(inplace = True),
+                torch.nn.Dropout(),
+                torch.nn.Linear(1024,512),
+                torch.nn.ReLU(inplace = True),
+                torch.nn.Dropout(),
+                torch.nn.Linear(512,4)
+            )
+        else:
+            self.fullConR = self.makeCompactHead(1024*headPool*headPool,headWidth,numRegOutputs)
+        #Shared stages only exist in the Class trunk, drop their R twins so they cost no parameters or optimizer state
+        for stageName,skipIdx in self.trunkStages[:sharedStages]:
+            delattr(self,stageName + 'ConvLayerSmoothR')
+            if skipIdx:
+                delattr(self,'skipConv%dR' % skipIdx)
+                delattr(self,'skipBatchNorm%dR' % skipIdx)
+        if channelsLast:
+            self.to(memory_format = torch.channels_last)
+    def splitMetrics(self,x):
+        #The image the edge filters run on: the red channel ('red', the original pseudo-grayscale), the luminance
+        #('luminance') or all three channels ('rgb')
+        if self.colorMode == 'luminance':
+            return torch.nn.functional.conv2d(x,self.lumaWeights)
+        if self.colorMode == 'rgb':
+            return x
+        return x[:,0:1]
+    @staticmethod
+    def makeCompactHead(inFeatures,width,outFeatures):
+        #Small MLP on the pooled trunk output, replaces the ~200M parameter VGG head
+        return torch.nn.Sequential(
+            torch.nn.Linear(inFeatures,width),
             torch.nn.ReLU(inplace = True),
             torch.nn.Dropout(),
-            torch.nn.Linear(512,4)
+            torch.nn.Linear(width,outFeatures)
         )
-    def splitMetrics(self,x):
-        x = torch.split(x,1,1)     #Get individual RGB to due a pseudo-grayscale for edge detection
-        x0 = x[0]
-        x1 = x[0]
-        x2 = x[0]     #Will recombine after networks run in parallel
-        
-        return x0,x1,x2 
-        # toTransform = x
-        # imgVals = torchvision.transforms.functional.to_pil_image(toTransform[0])
-        # grayScaleVals = torchvision.transforms.functional.to_grayscale(imgVals,3)
-        # x[0] = torchvision.transforms.functional.to_tensor(grayScaleVals)
+    @staticmethod
+    def makeGaussKernel1d(size,sigma):
+        #Normalized 1-D Gaussian, its outer product with itself is the 2-D blur kernel
+        taps = torch.arange(size,dtype=torch.float) - (size - 1)/2.
+        kernel = torch.exp(-taps**2/(2.*sigma**2))
+        return kernel/kernel.sum()
+    def edgeFilters(self,x):
+        #Returns the 3-channel Gauss/SobelX/SobelY edge stack consumed by both trunks
+        x = self.splitMetrics(x)
+        channels = x.shape[1]       #3 in 'rgb' mode: each input channel is its own group and gets all three filters
+        if self.frontEnd == 'separable':
+            #Row pass produces all three channels, grouped column pass finishes each one: 2*gaussSize MACs per pixel per filter
+            pad = self.gaussSize//2
+            x = torch.nn.functional.conv2d(x,self.edgeRowBank.repeat(channels,1,1,1),bias=None,padding=(0,pad),groups=channels)
+            return torch.nn.functional.conv2d(x,self.edgeColumnBank.repeat(channels,1,1,1),bias=None,padding=(pad,0),groups=3*channels)
+        if self.frontEnd == 'fused':
+            #All three filters see the same channel, so a single 3-output conv (per channel group) produces the stack in one launch
+            return torch.nn.functional.conv2d(x,self.edgeFilterBank.repeat(channels,1,1,1),bias=None,padding=7,groups=channels)
+        #Using F.conv2d for custom kernels was derived from: https://discuss.pytorch.org/t/setting-custom-kernel-for-cnn-in-pytorch/27176
+        x0 = torch.nn.functional.conv2d(x,self.gaussFilter.repeat(channels,1,1,1),bias=None, padding=7, groups=channels)     #Blurring Step with Gaussian Kernals.
+        x1 = torch.nn.functional.conv2d(x,self.sobelKernelX.repeat(channels,1,1,1),bias=None,padding = 1,groups=channels)
+        x2 = torch.nn.functional.conv2d(x,self.sobelKernelY.repeat(channels,1,1,1),bias=None,padding=1,groups=channels)
+        return torch.stack((x0,x1,x2),dim=2).flatten(1,2)      #(Gauss, SobelX, SobelY) per input channel, as the fused bank orders them
+    def edgeConfig(self):
+        #Everything edgeFilters' output depends on, so a cache of it can tell whether it was built for this front-end.
+        #'split' and 'fused' compute the same stack with the fixed Matlab Gaussian
+        if self.frontEnd == 'separable':
+            return {'frontEnd' : 'separable','gaussSize' : self.gaussSize,'gaussSigma' : self.gaussSigma,'colorMode' : self.colorMode}
+        return {'frontEnd' : 'fused','colorMode' : self.colorMode}
+    def trunkStage(self,x,stage,branch):
+        #Runs one trunk stage of the 'Class' or 'R' branch, followed by its skip connection if it has one. A checkpointed
+        #stage keeps only its input for backward and reruns itself there
+        if stage in self.checkpointStages and self.training and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(self.runTrunkStage,x,stage,branch,use_reentrant = False,
+                                                     context_fn = lambda: (contextlib.nullcontext(),self.recomputeContext()))
+        return self.runTrunkStage(x,stage,branch)
+    @contextlib.contextmanager
+    def recomputeContext(self):
+        #The rerun of a checkpointed stage must run the same ops as the original forward but not count the batch a second
+        #time in the BatchNorm running statistics, so it runs with momentum 0 and the batch counters are put back after
+        batchNorms = [module for module in self.modules() if isinstance(module,torch.nn.BatchNorm2d) and module.track_running_stats]
+        saved = [(batchNorm.momentum,batchNorm.num_batches_tracked.clone()) for batchNorm in batchNorms]
+        for batchNorm in batchNorms:
+            batchNorm.momentum = 0.
+        try:
+            yield
+        finally:
+            for batchNorm,(momentum,numBatches) in zip(batchNorms,saved):
+                batchNorm.momentum = momentum
+                batchNorm.num_batches_tracked.copy_(numBatches)
+    def runTrunkStage(self,x,stage,branch):
+        stageName,skipIdx = self.trunkStages[stage]
+        x = getattr(self,stageName + 'ConvLayerSmooth' + branch)(x)
+        if skipIdx:
+            suffix = '' if branch == 'Class' else 'R'
+            addLayer = x
+            x = torch.nn.functional.relu(getattr(self,'skipBatchNorm%d%s' % (skipIdx,suffix))(getattr(self,'skipConv%d%s' % (skipIdx,suffix))(x)))
+            x = torch.add(x,addLayer)
+        return x
     def forward(self,x):
-        x0,x1,x2 = self.splitMetrics(x)
-        #Weird issue with conv2d, temp fix for now.
-        x0 = x0.to(self.device)
-        x1 = x1.to(self.device)
-        x2 = x2.to(self.device)
-        if x0.type() != torch.cuda.FloatTensor:
-            #Using F.conv2d for custom kernels was derived from: https://discuss.pytorch.org/t/setting-custom-kernel-for-cnn-in-pytorch/27176
-            x0Class = torch.nn.functional.conv2d(x0,self.gaussFilter,bias=None, padding=7 )     #Blurring Step with Gaussian Kernals.
-            x1Class = torch.nn.functional.conv2d(x1,self.sobelKernelX,bias=None,padding = 1)
-            x2Class = torch.nn.functional.conv2d(x2,self.sobelKernelY,bias=None,padding=1)
-            x0R = x0Class
-            x1R = x1Class
-            x2R = x2Class
-        else:
-            x0Class = torch.nn.functional.conv2d(x0,self.gaussFilter,bias=None, padding=7 ) 
-            x1Class = torch.nn.functional.conv2d(x1,self.sobelKernelX,bias=None,padding = 1)
-            x2Class = torch.nn.functional.conv2d(x2,self.sobelKernelY,bias=None,padding=1)
-            x0R = x0Class
-            x1R = x1Class
-            x2R = x2Class
-        x0Class = torch.cat((x0Class,x1Class,x2Class),dim=1)
-        x0R = torch.cat((x0R,x1R,x2R),dim=1)
-        x0Class = self.firstConvLayerSmoothClass(x0Class)
-        x0Class = self.secondConvLayerSmoothClass(x0Class)
-        addLayer1 = x0Class
-        x0Class = torch.nn.functional.relu(self.skipBatchNorm1(self.skipConv1(x0Class)))
-        x0Class = torch.add(x0Class,addLayer1)
-        x0Class = self.thirdConvLayerSmoothClass(x0Class)
-        addLayer = x0Class
-        x0Class = torch.nn.functional.relu(self.skipBatchNorm2(self.skipConv2(x0Class)))
-        x0Class = torch.add(x0Class,addLayer)
-        x0Class = self.fourthConvLayerSmoothClass(x0Class)
-        x0Class = self.fifthConvLayerSmoothClass(x0Class)
-        addLayer = x0Class
-        x0Class = torch.nn.functional.relu(self.skipBatchNorm3(self.skipConv3(x0Class)))
-        x0Class = torch.add(x0Class,addLayer)
-        x0Class = self.sixthConvLayerSmoothClass(x0Class)
-        x0Class = self.seventhConvLayerSmoothClass(x0Class)
-        addLayer = x0Class
-        x0Class = torch.nn.functional.relu(self.skipBatchNorm4(self.skipConv4(x0Class)))
-        x0Class = torch.add(x0Class,addLayer)
-        x0Class = self.eigthConvLayerSmoothClass(x0Class)
-
-        #x0R = torch.nn.functional.conv2d(x0R,self.gaussFilter,bias=None, padding=1 ) 
-        x0R = self.firstConvLayerSmoothR(x0R)
-        x0R = self.secondConvLayerSmoothR(x0R)
-        addLayer = x0R
-        x0R = torch.nn.functional.relu(self.skipBatchNorm1R(self.skipConv1R(x0R)))
-        x0R = torch.add(x0R,addLayer)
-        x0R = self.thirdConvLayerSmoothR(x0R)
-        addLayer = x0R
-        x0R = torch.nn.functional.relu(self.skipBatchNorm2R(self.skipConv2R(x0R)))
-        x0R = torch.add(x0R,addLayer)
-        x0R = self.fourthConvLayerSmoothR(x0R)
-        x0R = self.fifthConvLayerSmoothR(x0R)
-        addLayer = x0R
-        x0R = torch.nn.functional.relu(self.skipBatchNorm3R(self.skipConv3R(x0R)))
-        x0R = torch.add(x0R,addLayer)
-        x0R = self.sixthConvLayerSmoothR(x0R)
-        x0R = self.seventhConvLayerSmoothR(x0R)
-        addLayer = x0R
-        x0R = torch.nn.functional.relu(self.skipBatchNorm4R(self.skipConv4R(x0R)))
-        x0R = torch.add(x0R,addLayer)
-        x0R = self.eigthConvLayerSmoothR(x0R)
-
-        if self.edgeDetect == 0:
-            x0Class = self.averagePoolClass(x0Class)
-            xsizes = x0Class.size()
-            x0Class = x0Class.view(-1,xsizes[1]*xsizes[2]*xsizes[3])
-            x0Class = torch.flatten(x0Class,1)          #Prepare for Linear Auditory Cortex Layers
-            x0Class = self.fullConClass(x0Class)
-            x0R = self.averagePoolClass(x0R)
-            xsizes = x0R.size()
-            x0R = x0R.view(-1,xsizes[1]*xsizes[2]*xsizes[3])
-            x0R = torch.flatten(x0R,1)          #Prepare for Linear Auditory Cortex Layers
-            x0R = self.fullConR(x0R)
-            return x0Class,x0R
+        x0Class = x if self.preFiltered else self.edgeFilters(x)       #Inputs are expected on the same device as the model
+        if self.channelsLast:
+            x0Class = x0Class.contiguous(memory_format = torch.channels_last)
+        if self.precision == 'fp32':
+            return self.forwardTrunks(x0Class)
+        with torch.autocast(device_type = x0Class.device.type,dtype = self.autocastDtypes[self.precision]):
+            outputs = self.forwardTrunks(x0Class)
+        return tuple(output.float() for output in outputs)
+    def forwardTrunks(self,x0Class):
+        for stage in range(self.sharedStages):
+            x0Class = self.trunkStage(x0Class,stage,'Class')
+        x0R = x0Class
+        for stage in range(self.sharedStages,len(self.trunkStages)):
+            x0Class = self.trunkStage(x0Class,stage,'Class')
+            x0R = self.trunkStage(x0R,stage,'R')
+        if self.edgeDetect != 0:
+            return x0Class,x0R          #Edge-detection mode: the trunk feature maps of both branches, no heads
+        x0Class = self.averagePoolClass(x0Class)
+        x0Class = torch.flatten(x0Class,1)          #Prepare for Linear Auditory Cortex Layers
+        x0Class = self.fullConClass(x0Class)
+        x0R = self.averagePoolClass(x0R)
+        x0R = torch.flatten(x0R,1)          #Prepare for Linear Auditory Cortex Layers
+        x0R = self.fullConR(x0R)
+        return x0Class,x0R
+def packPurdueShapes5(samples):
+    #Decodes PurdueShapes5 records [R, G, B, bbox, label] into contiguous tensors: images (N,3,32,32), stored as uint8
+    #when the pixels are integers in [0,255], bboxes (N,4) float and labels (N,) int64
+    samples = samples.values() if isinstance(samples, dict) else samples
+    samples = list(samples)
+    images = np.array([sample[:3] for sample in samples], dtype=np.float32).reshape(-1,3,32,32)
+    if images.min() >= 0 and images.max() <= 255 and np.array_equal(images, np.round(images)):
+        images = images.astype(np.uint8)
+    bboxes = np.array([sample[3] for sample in samples], dtype=np.float32).reshape(-1,4)
+    labels = np.array([sample[4] for sample in samples], dtype=np.int64)
+    return torch.from_numpy(images), torch.from_numpy(bboxes), torch.from_numpy(labels)
+#Default (archive, noise label) sources of each split. Train archives are the DLStudio torch-saved copies in the working
+#directory, test archives are the gzipped pickles in dl_studio.dataroot
+trainSources = [("torch-saved-PurdueShapes5-10000-dataset.pt", 0), ("torch-saved-PurdueShapes5-10000-dataset-noise-20.pt", 1),
+                ("torch-saved-PurdueShapes5-10000-dataset-noise-50.pt", 2), ("torch-saved-PurdueShapes5-10000-dataset-noise-80.pt", 3)]
+testSources = [("PurdueShapes5-1000-test-noise-80.gz", 3), ("PurdueShapes5-1000-test-noise-50.gz", 2),
+               ("PurdueShapes5-1000-test-noise-20.gz", 1), ("PurdueShapes5-1000-test.gz", 0)]
+labelMapArchive = "torch-saved-PurdueShapes5-label-map.pt"      #torch-saved archives keep their label map in this file
+cacheVersion = 1        #Bump when the cache layout or the decoding in packPurdueShapes5 changes
+def fileSha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+def sourceFingerprint(path):
+    stat = os.stat(path)
+    return {'path' : os.path.abspath(path), 'size' : stat.st_size, 'mtime_ns' : stat.st_mtime_ns, 'sha1' : fileSha1(path)}
+def cacheIsValid(manifest, sources):
+    #Size or path changes invalidate outright. Only sources whose mtime moved are re-hashed, so a valid cache costs a stat
+    #per archive; a touched-but-identical archive keeps its cache and has its new mtime recorded in the manifest
+    if manifest.get('version') != cacheVersion or len(manifest['sources']) != len(sources):
+        return False
+    for fingerprint, path in zip(manifest['sources'], sources):
+        stat = os.stat(path)
+        if fingerprint['path'] != os.path.abspath(path) or fingerprint['size'] != stat.st_size:
+            return False
+        if fingerprint['mtime_ns'] != stat.st_mtime_ns:
+            if fingerprint['sha1'] != fileSha1(path):
+                return False
+            fingerprint['mtime_ns'] = stat.st_mtime_ns
+    return True
+def writeManifest(cacheDir, manifest):
+    #Temporary files are named per process, so processes filling the same cache never write or rename each other's
+    tmpPath = os.path.join(cacheDir, 'manifest.%d.tmp.json' % os.getpid())
+    with open(tmpPath, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmpPath, os.path.join(cacheDir, 'manifest.json'))
+def writePurdueShapes5Cache(cacheDir, sources, images, bboxes, labels, label_map):
+    #One-time conversion of decoded records into flat .npy arrays plus a manifest of the source files they came from.
+    #The manifest is written last, so an interrupted conversion is never mistaken for a valid cache
+    os.makedirs(cacheDir, exist_ok=True)
+    for name, tensor in (('images', images), ('bboxes', bboxes), ('labels', labels)):
+        tmpPath = os.path.join(cacheDir, '%s.%d.tmp.npy' % (name, os.getpid()))
+        np.save(tmpPath, tensor.numpy())
+        os.replace(tmpPath, os.path.join(cacheDir, name + '.npy'))
+    writeManifest(cacheDir, {'version' : cacheVersion, 'sources' : [sourceFingerprint(path) for path in sources],
+                             'label_map' : label_map})
+def loadPurdueShapes5Cache(cacheDir, sources):
+    #Returns (images, bboxes, labels, label_map) memory-mapped from cacheDir, or None if the cache is missing or stale.
+    #Copy-on-write maps give writable tensors whose pages stay shared with every DataLoader worker through the page cache
+    manifestPath = os.path.join(cacheDir, 'manifest.json')
+    if not os.path.exists(manifestPath) or not all(os.path.exists(path) for path in sources):
+        return None
+    with open(manifestPath) as f:
+        manifest = json.load(f)
+    mtimes = [fingerprint['mtime_ns'] for fingerprint in manifest['sources']]
+    if not cacheIsValid(manifest, sources):
+        return None
+    if mtimes != [fingerprint['mtime_ns'] for fingerprint in manifest['sources']]:
+        writeManifest(cacheDir, manifest)
+    images, bboxes, labels = (torch.from_numpy(np.load(os.path.join(cacheDir, name + '.npy'), mmap_mode='c'))
+                              for name in ('images', 'bboxes', 'labels'))
+    return images, bboxes, labels, manifest['label_map']
+def loadEdgeCache(cacheDir, key, sources):
+    #Returns the edge stacks memory-mapped from cacheDir, or None if they are missing, were built for a different key
+    #(front-end, noise rendering, dataset size) or their source archives changed since
+    manifestPath = os.path.join(cacheDir, 'manifest.json')
+    if not os.path.exists(manifestPath) or not all(os.path.exists(path) for path in sources):
+        return None
+    with open(manifestPath) as f:
+        manifest = json.load(f)
+    if manifest.get('key') != key or not cacheIsValid(manifest, sources):
+        return None
+    return torch.from_numpy(np.load(os.path.join(cacheDir, 'edges.npy'), mmap_mode='c'))
+def writeEdgeCache(cacheDir, key, sources, numSamples, computeBatch, batchSize=256):
+    #Fills cacheDir/edges.npy batch by batch through a memory map, so the (numSamples, 3, 32, 32) float32 stack never has
+    #to fit in memory. computeBatch(start, stop) returns the edge stacks of samples start..stop-1
+    os.makedirs(cacheDir, exist_ok=True)
+    edges = None
+    tmpPath = os.path.join(cacheDir, 'edges.%d.tmp.npy' % os.getpid())
+    for start in range(0, numSamples, batchSize):
+        batch = computeBatch(start, min(start + batchSize, numSamples))
+        if edges is None:
+            edges = np.lib.format.open_memmap(tmpPath, mode='w+', dtype=np.float32,
+                                              shape=(numSamples,) + tuple(batch.shape[1:]))
+        edges[start:start + len(batch)] = batch.numpy()
+    edges.flush()
+    del edges
+    os.replace(tmpPath, os.path.join(cacheDir, 'edges.npy'))
+    writeManifest(cacheDir, {'version' : cacheVersion, 'sources' : [sourceFingerprint(path) for path in sources], 'key' : key})
+def readPurdueShapes5Archive(path):
+    #Returns (records, label_map) from a DLStudio gzipped pickle, or from a torch-saved copy plus its label map file
+    if path.endswith('.pt'):
+        #These are our own DLStudio-saved lists of lists, which the weights_only unpickler decodes about 10x slower
+        return (torch.load(path, weights_only=False),
+                torch.load(os.path.join(os.path.dirname(path), labelMapArchive), weights_only=False))
+    with gzip.open(path, 'rb') as f:
+        dataset = f.read()
+    if sys.version_info[0] == 3:
+        return pickle.loads(dataset, encoding='latin1')
+    else:
+        return pickle.loads(dataset)
+class PurdueShapes5Source(object):
+    #One PurdueShapes5 archive and the noise label its samples get. load() decodes it into packed tensors, or with a
+    #cache_dir memory-maps them from a per-archive cache that is rebuilt when the archive (or its label map) changes
+    def __init__(self, path, noiseLabel, cache_dir=None):
+        self.path = path
+        self.noiseLabel = noiseLabel
+        self.cacheDir = None
+        if cache_dir is not None:
+            #The path hash keeps same-named archives from different directories in separate cache entries
+            self.cacheDir = os.path.join(cache_dir, os.path.basename(path) + '-' + hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:8])
+        self.files = [path, os.path.join(os.path.dirname(path), labelMapArchive)] if path.endswith('.pt') else [path]
+    def load(self):
+        #Returns (images, bboxes, label_map)
+        if self.cacheDir is not None:
+            cached = loadPurdueShapes5Cache(self.cacheDir, self.files)
+            if cached is not None:
+                return cached[0], cached[1], cached[3]
+        records, label_map = readPurdueShapes5Archive(self.path)
+        images, bboxes, labels = packPurdueShapes5(records)
+        if self.cacheDir is not None:
+            writePurdueShapes5Cache(self.cacheDir, self.files, images, bboxes, labels, label_map)
+        return images, bboxes, label_map
+class BatchAugment(object):
+    #Augments whole collated batches {'image' : (B,3,H,W), 'bbox' : (B,4), ...} in a handful of tensor ops, on whatever
+    #device the batch is on, so the cost is per batch rather than per image. Bboxes are [x_min, y_min, x_max, y_max]
+    #in pixels and follow the flips and shifts. Single samples (3,H,W) are accepted too, so it also works as a dataset
+    #transform on either access path.
+    #   hflip, vflip, gray: per-sample probability of a horizontal flip, vertical flip, luminance grayscale
+    #   maxShift: per-sample translation drawn from [-maxShift, maxShift] pixels in x and y, vacated pixels are zero
+    #   noiseLevels: additive Gaussian noise, each sample gets a std drawn from this list (0 for clean), clamped to [0,255]
+    def __init__(self, hflip=0.5, vflip=0., maxShift=0, noiseLevels=(), gray=0.):
+        self.hflip = hflip
+        self.vflip = vflip
+        self.maxShift = maxShift
+        self.noiseLevels = list(noiseLevels)
+        self.gray = gray
+    def __call__(self, sample):
+        images, bboxes = sample['image'], sample['bbox']
+        single = images.dim() == 3
+        if single:
+            images, bboxes = images.unsqueeze(0), bboxes.unsqueeze(0)
+        images, bboxes = images.float(), bboxes.float()
+        batchSize, numChannels, height, width = images.shape
+        device = images.device
+        if self.hflip > 0:
+            flip = torch.rand(batchSize, device=device) < self.hflip
+            images = torch.where(flip.view(-1,1,1,1), images.flip(3), images)
+            flipped = torch.stack((width - 1 - bboxes[:,2], bboxes[:,1], width - 1 - bboxes[:,0], bboxes[:,3]), dim=1)
+            bboxes = torch.where(flip.view(-1,1), flipped, bboxes)
+        if self.vflip > 0:
+            flip = torch.rand(batchSize, device=device) < self.vflip
+            images = torch.where(flip.view(-1,1,1,1), images.flip(2), images)
+            flipped = torch.stack((bboxes[:,0], height - 1 - bboxes[:,3], bboxes[:,2], height - 1 - bboxes[:,1]), dim=1)
+            bboxes = torch.where(flip.view(-1,1), flipped, bboxes)
+        if self.maxShift > 0:
+            #One gather over a per-sample shifted index grid, out-of-image source pixels are masked to zero
+            dx = torch.randint(-self.maxShift, self.maxShift + 1, (batchSize,1,1), device=device)
+            dy = torch.randint(-self.maxShift, self.maxShift + 1, (batchSize,1,1), device=device)
+            rows = torch.arange(height, device=device).view(1,-1,1) - dy
+            cols = torch.arange(width, device=device).view(1,1,-1) - dx
+            inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+            batchIdx = torch.arange(batchSize, device=device).view(-1,1,1)
+            images = images[batchIdx, :, rows.clamp(0, height - 1), cols.clamp(0, width - 1)]       #(B,H,W,C)
+            images = (images*inside.unsqueeze(3)).permute(0,3,1,2).contiguous()
+            shift = torch.cat((dx, dy, dx, dy), dim=2).view(-1,4).float()
+            limits = torch.tensor([width - 1, height - 1, width - 1, height - 1], device=device, dtype=torch.float)
+            bboxes = torch.minimum((bboxes + shift).clamp(min=0), limits)
+        if self.gray > 0:
+            gray = torch.rand(batchSize, device=device) < self.gray
+            weights = torch.tensor([0.299, 0.587, 0.114], device=device).view(1,3,1,1)
+            luminance = (images*weights).sum(1, keepdim=True).expand(-1, numChannels, -1, -1)
+            images = torch.where(gray.view(-1,1,1,1), luminance, images)
+        if self.noiseLevels:
+            levels = torch.tensor(self.noiseLevels, device=device, dtype=torch.float)
+            std = levels[torch.randint(len(self.noiseLevels), (batchSize,), device=device)]
+            images = (images + torch.randn_like(images)*std.view(-1,1,1,1)).clamp(0., 255.)
+        if single:
+            images, bboxes = images[0], bboxes[0]
+        sample = dict(sample)
+        sample['image'], sample['bbox'] = images, bboxes
+        return sample
+def logicalShiftRight(x, bits):
+    #torch's >> is arithmetic on int64, mask off the sign extension
+    return (x >> bits) & ((1 << (64 - bits)) - 1)
+def mix64(x):
+    #SplitMix64 finalizer on int64 tensors (multiplications wrap), maps counters to well-mixed 64-bit hashes
+    x = x + (0x9e3779b97f4a7c15 - (1 << 64))
+    x = (x ^ logicalShiftRight(x, 30)) * (0xbf58476d1ce4e5b9 - (1 << 64))
+    x = (x ^ logicalShiftRight(x, 27)) * (0x94d049bb133111eb - (1 << 64))
+    return x ^ logicalShiftRight(x, 31)
+def syntheticNoise(cleanIdx, levelIdx, seed, shape):
+    #Standard normal noise of the per-sample shape, a pure function of (clean index, noise level, seed): every pixel's
+    #value comes from hashing its own counter, so any batch of indices is rendered in one vectorised pass, in any order,
+    #on any worker, and always gives the same image
+    numel = int(np.prod(shape))
+    keys = mix64((torch.as_tensor(seed, dtype=torch.int64)*1000003 + levelIdx.long())*(1 << 32) + cleanIdx.long())
+    counters = keys.view(-1,1)*(2*numel) + torch.arange(2*numel, dtype=torch.int64, device=keys.device)
+    uniform = (logicalShiftRight(mix64(counters), 11).double() + 1.)/float(1 << 53)     #(0,1], two per pixel
+    normal = torch.sqrt(-2.*torch.log(uniform[:,0::2]))*torch.cos(2.*np.pi*uniform[:,1::2])    #Box-Muller
+    return normal.float().view((-1,) + tuple(shape))
+def decodeSource(source):
+    #Process-pool task. Cached sources are written to their cache and re-mapped by the parent, so nothing large crosses
+    #the process boundary; uncached tensors are returned through torch's shared-memory pickling, which copies each
+    #store once into a shared segment and hands the parent a handle to it instead of copying it through the pipe
+    stores = source.load()
+    return None if source.cacheDir is not None else stores
+def loadSources(sources, numWorkers=1):
+    #Decodes every source, concurrently in a process pool when numWorkers > 1, and returns their stores in order
+    if numWorkers <= 1 or len(sources) <= 1:
+        return [source.load() for source in sources]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(numWorkers, len(sources))) as pool:
+        results = list(pool.map(decodeSource, sources))
+    return [stores if stores is not None else source.load() for stores, source in zip(results, sources)]
 class PurdueShapes5DatasetNoise(torch.utils.data.Dataset):
     #This is a modification of the PurdueShapes5Data set from DLStudio designed and written by Dr. Kak. Augmentations were made
     #to load in all data at once, and assigned noise labels to each noisy dataset.
-            def __init__(self, dl_studio, train_or_test, dataset_file, transform=None):
+            def __init__(self, dl_studio, train_or_test, dataset_file, transform=None, cache_dir=None, sources=None, lazy=False,
+                         decode_workers=1, synthetic_noise=None, noise_seed=0):
                 super(PurdueShapes5DatasetNoise, self).__init__()
                 #self.dataset_file = dataset_file
-                if train_or_test == 'train':
-                    if os.path.exists("torch-saved-PurdueShapes5-10000-dataset.pt") and \
-                              os.path.exists("torch-saved-PurdueShapes5-label-map.pt"):
+                #sources is a list of (archive path, noise label) pairs, defaulting to the four noise levels of the split.
+                #Each archive is decoded once with bulk array ops (memory-mapped from cache_dir/<archive> when set). By default
+                #the sources are concatenated into one contiguous store; lazy=True keeps one store per source and indexes
+                #across them, so an extra noise level adds only its own (mapped) arrays instead of another full copy.
+                #decode_workers > 1 decodes the sources concurrently in a process pool and always keeps one store per source,
+                #as lazy=True does: each worker copies its store once into shared memory, which this process maps as is, where
+                #concatenating them would make a second full copy.
+                #synthetic_noise, a list of noise levels in percent of full scale (e.g. [0,20,50,80]), keeps only the clean
+                #sources and renders sample k*N+i as clean image i plus Gaussian noise of std synthetic_noise[k]% of 255,
+                #labelled k. The noise is a deterministic function of (i, k, noise_seed) generated per batch
+                if sources is None:
+                    if train_or_test == 'train':
                         print("\nLoading training data from the torch-saved archive")
-                        
-                        self.dataset = [[0 for i in range(4)] for j in range(40000)]
-                        self.dataset0 = torch.load("torch-saved-PurdueShapes5-10000-dataset.pt")
-                        for ck in range(10000):
-                            self.dataset0[ck][4] = 0               #Here we will artificially set our labels to noise levels
-                        for ii in range(10000):
-                            for jj in range(4):
-                                self.dataset[ii][jj] = self.dataset0[ii][jj]          
-                        self.dataset1 = torch.load("torch-saved-PurdueShapes5-10000-dataset-noise-20.pt")
-                        for ck in range(10000):
-                            self.dataset1[ck][4] = 1               #Here we will artificially set our labels to noise levels
-                        
-                        for ii in range(10000):
-                            for jj in range(4):
-                                self.dataset[10000+ii][jj] = self.dataset1[ii][jj]
-                        
-                        self.dataset2 = torch.load("torch-saved-PurdueShapes5-10000-dataset-noise-50.pt")
-                        for ck in range(10000):
-                            self.dataset2[ck][4] = 2               #Here we will artificially set our labels to noise levels
-                        for ii in range(10000):
-                            for jj in range(4):
-                                self.dataset[20000+ii][jj] = self.dataset2[ii][jj]
-                        
-                        self.dataset3 = torch.load("torch-saved-PurdueShapes5-10000-dataset-noise-80.pt")
-                        for ck in range(10000):
-                            self.dataset3[ck][4] = 3               #Here we will artificially set our labels to noise levels
-                        for ii in range(10000):
-                            for jj in range(4):
-                                self.dataset[30000+ii][jj] = self.dataset3[ii][jj]
-                        
-                        self.label_map = torch.load("torch-saved-PurdueShapes5-label-map.pt")
-                        
-                        # reverse the key-value pairs in the label dictionary:
-                        self.class_labels = dict(map(reversed, self.label_map.items()))
-
-                        self.transform = transform
-                    
-                else:
-                    root_dir = dl_studio.dataroot
-                    dataset_file = "PurdueShapes5-1000-test-noise-80.gz"
-                    f = gzip.open(root_dir + dataset_file, 'rb')
-                    dataset0 = f.read()
-                    if sys.version_info[0] == 3:
-                        self.dataset0, self.label_map = pickle.loads(dataset0, encoding='latin1')
-                    else:
-                        self.dataset0, self.label_map = pickle.loads(dataset0)
-                    self.dataset = [[0 for i in range(4)] for j in range(4000)]
-                    for ck in range(1000):
-                            self.dataset0[ck][4] = 3               #Here we will artificially set our labels to noise levels
-                    for ii in range(1000):
-                        for jj in range(4):
-                            self.dataset[ii][jj] = self.dataset0[ii][jj]
-                    dataset_file = "PurdueShapes5-1000-test-noise-50.gz"
-                    f = gzip.open(root_dir + dataset_file, 'rb')
-                    dataset1 = f.read()
-                    if sys.version_info[0] == 3:
-                        self.dataset1, self.label_map = pickle.loads(dataset1, encoding='latin1')
+                        sources = trainSources
                     else:
-                        self.dataset1, self.label_map = pickle.loads(dataset1)
-                    for ck in range(1000):
-                            self.dataset1[ck][4] = 2               #Here we will artificially set our labels to noise levels
-                    for ii in range(1000):
-                        for jj in range(4):
-                            self.dataset[1000+ii][jj] = self.dataset1[ii][jj]
-                    dataset_file = "PurdueShapes5-1000-test-noise-20.gz"
-                    f = gzip.open(root_dir + dataset_file, 'rb')
-                    dataset2 = f.read()
-                    if sys.version_info[0] == 3:
-                        self.dataset2, self.label_map = pickle.loads(dataset2, encoding='latin1')
-                    else:
-                        self.dataset2, self.label_map = pickle.loads(dataset2)
-                    for ck in range(1000):
-                            self.dataset2[ck][4] = 1               #Here we will artificially set our labels to noise levels
-                    for ii in range(1000):
-                        for jj in range(4):
-                            self.dataset[2000+ii][jj] = self.dataset2[ii][jj]
-                    dataset_file = "PurdueShapes5-1000-test.gz"
-                    f = gzip.open(root_dir + dataset_file, 'rb')
-                    dataset3 = f.read()
-                    if sys.version_info[0] == 3:
-                        self.dataset3, self.label_map = pickle.loads(dataset3, encoding='latin1')
-                    else:
-                        self.dataset3, self.label_map = pickle.loads(dataset3)
-                    for ck in range(1000):
-                            self.dataset3[ck][4] = 0               #Here we will artificially set our labels to noise levels
-                    for ii in range(1000):
-                        for jj in range(4):
-                                self.dataset[3000+ii][jj] = self.dataset3[ii][jj]
-                    # reverse the key-value pairs in the label dictionary:
-                    self.class_labels = dict(map(reversed, self.label_map.items()))
-                    self.transform = transform
+                        sources = [(dl_studio.dataroot + dataset_file, noiseLabel) for dataset_file, noiseLabel in testSources]
+                if synthetic_noise is not None:
+                    #Pre-noised archives would be noised a second time and relabelled, so only the clean ones are kept
+                    sources = [(path, noiseLabel) for path, noiseLabel in sources if noiseLabel == 0]
+                    if not sources:
+                        raise ValueError("synthetic_noise needs at least one clean source (noise label 0)")
+                self.sources = [PurdueShapes5Source(path, noiseLabel, cache_dir) for path, noiseLabel in sources]
+                self.lazy = lazy or (decode_workers > 1 and len(self.sources) > 1)
+                self.transform = transform
+                stores = loadSources(self.sources, decode_workers)
+                self.label_map = stores[0][2]
+                # reverse the key-value pairs in the label dictionary:
+                self.class_labels = dict(map(reversed, self.label_map.items()))
+                sizes = [len(images) for images, bboxes, label_map in stores]
+                self.offsets = np.cumsum([0] + sizes)
+                #Here we will artificially set our labels to noise levels
+                self.labels = torch.cat([torch.full((size,), source.noiseLabel, dtype=torch.int64)
+                                         for size, source in zip(sizes, self.sources)])
+                self.edges = None
+                self.noiseLevels = None if synthetic_noise is None else list(synthetic_noise)
+                self.noiseSeed = noise_seed
+                if synthetic_noise is not None:
+                    self.numClean = int(self.offsets[-1])
+                    self.labels = torch.arange(len(self.noiseLevels)).repeat_interleave(self.numClean)
+                if self.lazy:
+                    self.sourceImages = [images for images, bboxes, label_map in stores]
+                    #packPurdueShapes5 keeps each source uint8 or float32 on its own, so batches take the promoted dtype,
+                    #the one torch.cat gives the eager store
+                    self.imageDtype = self.sourceImages[0].dtype
+                    for images in self.sourceImages[1:]:
+                        self.imageDtype = torch.promote_types(self.imageDtype, images.dtype)
+                    self.sourceBboxes = [bboxes for images, bboxes, label_map in stores]
+                else:
+                    self.images = torch.cat([images for images, bboxes, label_map in stores])
+                    self.bboxes = torch.cat([bboxes for images, bboxes, label_map in stores])
             def __len__(self):
-                return len(self.dataset)
-
+                return len(self.labels)
+            def gather(self, idx):
+                #Lazy-mode lookup: maps global indices to (source, local index) and gathers per source
+                if isinstance(idx, (int, np.integer)):
+                    sourceIdx = np.searchsorted(self.offsets, idx, side='right') - 1
+                    localIdx = idx - self.offsets[sourceIdx]
+                    return self.sourceImages[sourceIdx][localIdx].to(self.imageDtype), self.sourceBboxes[sourceIdx][localIdx]
+                idx = np.asarray(idx)
+                sourceIdx = np.searchsorted(self.offsets, idx, side='right') - 1
+                images = torch.empty((len(idx),) + self.sourceImages[0].shape[1:], dtype=self.imageDtype)
+                bboxes = torch.empty(len(idx), 4)
+                for ii in np.unique(sourceIdx):
+                    mask = torch.from_numpy(sourceIdx == ii)
+                    localIdx = torch.from_numpy(idx[mask.numpy()] - self.offsets[ii])
+                    images[mask] = self.sourceImages[ii][localIdx].to(self.imageDtype)
+                    bboxes[mask] = self.sourceBboxes[ii][localIdx]
+                return images, bboxes
             def __getitem__(self, idx):
-                r = np.array( self.dataset[idx][0] )
-                g = np.array( self.dataset[idx][1] )
-                b = np.array( self.dataset[idx][2] )
-                R,G,B = r.reshape(32,32), g.reshape(32,32), b.reshape(32,32)
-                im_tensor = torch.zeros(3,32,32, dtype=torch.float)
-                im_tensor[0,:,:] = torch.from_numpy(R)
-                im_tensor[1,:,:] = torch.from_numpy(G)
-                im_tensor[2,:,:] = torch.from_numpy(B)
-                bb_tensor = torch.tensor(self.dataset[idx][3], dtype=torch.float)
-                #if dataset
-                try:
-                    sample = {'image' : im_tensor, 
-                            'bbox' : bb_tensor,
-                            'label' : self.dataset[idx][4] }
-                except:
-                    print(idx)
+                #idx may be a single index or a list/tensor of indices, in which case the whole batch is one gather
+                labels = self.labels[idx]
+                if self.edges is not None:
+                    return {'image' : self.edges[idx], 'bbox' : self.bboxesAt(idx), 'label' : labels}
+                cleanIdx = idx
+                if self.noiseLevels is not None:
+                    cleanIdx = idx % self.numClean if isinstance(idx, (int, np.integer)) else torch.as_tensor(idx) % self.numClean
+                if self.lazy:
+                    images, bboxes = self.gather(cleanIdx)
+                else:
+                    images, bboxes = self.images[cleanIdx], self.bboxes[cleanIdx]
+                images = images.float()
+                if self.noiseLevels is not None:
+                    std = torch.tensor(self.noiseLevels, dtype=torch.float)[labels]*2.55
+                    noise = syntheticNoise(torch.as_tensor(cleanIdx).view(-1), labels.view(-1), self.noiseSeed, images.shape[-3:])
+                    images = (images + noise.view(images.shape)*std.view(std.shape + (1,1,1))).clamp(0., 255.)
+                sample = {'image' : images,
+                          'bbox' : bboxes,
+                          'label' : labels }
                 if self.transform:
                      sample = self.transform(sample)
-                return sample  
+                return sample
+            def bboxesAt(self, idx):
+                cleanIdx = idx
+                if self.noiseLevels is not None:
+                    cleanIdx = idx % self.numClean if isinstance(idx, (int, np.integer)) else torch.as_tensor(idx) % self.numClean
+                return self.gather(cleanIdx)[1] if self.lazy else self.bboxes[cleanIdx]
+            def edgeCache(self, model, cache_dir, batch_size=256):
+                #Computes model.edgeFilters of every image once and from then on serves that 3-channel edge stack as 'image',
+                #for an EdgeNet built with preFiltered=True. The stacks live in a memory-mapped .npy under cache_dir, keyed
+                #by the front-end (model.edgeConfig()), the sources and the synthetic noise levels and seed, so later runs map
+                #it instead of recomputing. A random transform would be frozen into the cache, so none may be set
+                if self.transform is not None:
+                    raise ValueError("edgeCache needs a dataset without a transform, augment the edge stacks in the loop instead")
+                paths = [path for source in self.sources for path in source.files]
+                key = {'edges' : model.edgeConfig(), 'sources' : [[os.path.abspath(source.path), source.noiseLabel] for source in self.sources],
+                       'synthetic_noise' : self.noiseLevels, 'noise_seed' : self.noiseSeed, 'length' : len(self)}
+                cacheDir = os.path.join(cache_dir, 'edges-' + hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:12])
+                self.edges = loadEdgeCache(cacheDir, key, paths)
+                if self.edges is None:
+                    device = next(model.buffers()).device
+                    def computeBatch(start, stop):
+                        with torch.inference_mode():
+                            return model.edgeFilters(self[torch.arange(start, stop)]['image'].to(device)).float().cpu()
+                    writeEdgeCache(cacheDir, key, paths, len(self), computeBatch, batch_size)
+                    self.edges = loadEdgeCache(cacheDir, key, paths)
+                return self
+            def shareMemory(self):
+                #Moves the decoded stores into shared memory, so DataLoader workers map the same pages whether they are
+                #forked or spawned (spawned workers receive handles instead of pickled copies). Stores memory-mapped from
+                #cache_dir are already file-backed and shared, and are left alone
+                if self.lazy:
+                    for ii, source in enumerate(self.sources):
+                        if source.cacheDir is None:
+                            self.sourceImages[ii].share_memory_()
+                            self.sourceBboxes[ii].share_memory_()
+                else:
+                    self.images.share_memory_()
+                    self.bboxes.share_memory_()
+                self.labels.share_memory_()
+                return self
+            def batchLoader(self, batch_size, shuffle=True, drop_last=False, sampler=None, **kwargs):
+                #DataLoader that hands __getitem__ whole index batches from a BatchSampler instead of collating single samples.
+                #sampler replaces the random/sequential index order, e.g. with a DistributedSampler shard
+                if sampler is None:
+                    sampler = torch.utils.data.RandomSampler(self) if shuffle else torch.utils.data.SequentialSampler(self)
+                batchSampler = torch.utils.data.BatchSampler(sampler, batch_size, drop_last)
+                return torch.utils.data.DataLoader(self, sampler=batchSampler, batch_size=None, **kwargs)
      #Begin Noisy_object_detection_and_localization from DLStudio. Slight adjustments made for my model and running of the homework. All rights and priveledges belong to Dr. Kak
  
 if __name__ == '__main__':
@@ -489,7 +809,10 @@ if __name__ == '__main__':
     torch.backends.cudnn.deterministic=True
     torch.backends.cudnn.benchmarks=False
     os.environ['PYTHONHASHSEED'] = str(seed)
-    device = torch.device("cuda:0")
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    if device.type == 'cpu':
+        #CPU inference/training mode. Thread count can be pinned with EDGENET_NUM_THREADS, defaults to all cores
+        torch.set_num_threads(int(os.environ.get('EDGENET_NUM_THREADS',os.cpu_count())))
     def applyGaussSmooth(kernalSize,Variance,data):
         gMean = (kernalSize-1.)/2.     #Get float mean
         ##  watch -d -n 0.5 nvidia-smi
@@ -507,7 +830,7 @@ if __name__ == '__main__':
                     classes = ('rectangle','triangle','disk','oval','star'),
                     debug_train = 1,
                     debug_test = 1,
-                    use_gpu = True,
+                    use_gpu = torch.cuda.is_available(),
                 )
 
 
@@ -535,7 +858,13 @@ if __name__ == '__main__':
     model = EdgeNet(3,5,4,0)#detector.LOADnet2(skip_connections=True, depth=32)
     model = model.to(device)          #On Windows, DLStudio does not send model to device till second pass of forward. No idea why
     dls.show_network_summary(model)
-    detector.run_code_for_training_with_CrossEntropy_and_MSE_Losses(model)
+    #In-repo trainer instead of DLStudio's batch_size loop: micro-batches of 16 accumulated to an effective batch of 64,
+    #DLStudio's learning rate scaled linearly to that batch with a short warmup
+    from trainer import train, scaledLearningRate
+    train(model,dataserver_train,epochs = dls.epochs,batchSize = 16,accumulationSteps = 4,
+          learningRate = scaledLearningRate(dls.learning_rate,64,dls.batch_size),warmupSteps = 100,device = device)
+    torch.save(model.state_dict(),dls.path_saved_model)       #DLStudio's testing loads the trained weights from here
+    #detector.run_code_for_training_with_CrossEntropy_and_MSE_Losses(model)
     #detector.run_code_for_training_with_CrossEntropy_and_BCE_Losses(model)
 
     import pymsgbox
@@ -39,7 +39,9 @@
 #from cortexNet1 import cortexNet
 import random
 import numpy
+import contextlib
 import torch
+import torch.utils.checkpoint
 import os, sys
 import pdb
 import torchvision
@@ -47,19 +49,49 @@ from scipy.ndimage.filters import gaussian_filter
 class EdgeNet(torch.nn.Module):
     #     #Class draws influence from VGG16 (K. Simonyan and A. Zisserman) but is quite distinct from it.
 #     #Models information and noise resolution in the central auditory system
-    def __init__(self,inChannels,numOutputs,numRegOutputs,edgeDetect = 1):
+    #Trunk stages in forward order, paired with the skip connection that closes each stage (0 for none)
+    trunkStages = (('first',0),('second',1),('third',2),('fourth',0),('fifth',3),('sixth',0),('seventh',4),('eigth',0))
+    autocastDtypes = {'bf16' : torch.bfloat16,'fp16' : torch.float16}
+    def __init__(self,inChannels,numOutputs,numRegOutputs,edgeDetect = 1,frontEnd = 'fused',gaussSize = 9,gaussSigma = 1.2,sharedStages = 0,
+                 head = 'vgg',headPool = 1,headWidth = 512,precision = 'fp32',channelsLast = False,checkpointStages = (),
+                 preFiltered = False,colorMode = 'red'):
         super(EdgeNet, self).__init__()
         self.inChannels = inChannels           #Image dimensionality subject to preprocessing
         self.numOutputs = numOutputs         #Output classification dimensionality. 
         self.numRegOutputs = numRegOutputs
         self.edgeDetect = edgeDetect
-        self.sobelKernelX = torch.tensor([[1.,0.,-1.],[2.,0.,-2.],[1.,0.,-1.]])
-        self.sobelKernelX = self.sobelKernelX.view(1,1,3,3).repeat(1,1,1,1) #How to use custom kernels in pytorch was found at the following PyTorch forum answer: https://discuss.pytorch.org/t/setting-custom-kernel-for-cnn-in-pytorch/27176
-        self.sobelKernelY = torch.tensor([[1.,2.,1.],[0.,0.,0.],[-1.,-2.,-1.]])
-        self.sobelKernelY = self.sobelKernelY.view(1,1,3,3).repeat(1,1,1,1)
+        if frontEnd not in ('split','fused','separable'):
+            raise ValueError("frontEnd must be 'split', 'fused' or 'separable', got %r" % (frontEnd,))
+        if gaussSize < 3 or gaussSize % 2 == 0:
+            raise ValueError("gaussSize must be an odd number >= 3, got %r" % (gaussSize,))
+        self.frontEnd = frontEnd                #'split' runs three convs and concatenates, 'fused' runs one 3-output conv
+        self.gaussSize = gaussSize              #'separable' uses an analytic (gaussSize,gaussSigma) Gaussian as row/column passes
+        self.gaussSigma = gaussSigma
+        if not 0 <= sharedStages <= len(self.trunkStages):
+            raise ValueError("sharedStages must be between 0 and %d, got %r" % (len(self.trunkStages),sharedStages))
+        self.sharedStages = sharedStages        #First N trunk stages run once and feed both the Class and R branches
+        if head not in ('vgg','compact'):
+            raise ValueError("head must be 'vgg' or 'compact', got %r" % (head,))
+        self.head = head                        #'vgg' is the 1024*7*7->4096 head, 'compact' pools to headPool x headPool into a small MLP
+        if precision not in ('fp32','bf16','fp16'):
+            raise ValueError("precision must be 'fp32', 'bf16' or 'fp16', got %r" % (precision,))
+        self.precision = precision              #'bf16'/'fp16' autocast the trunks and heads, the edge front-end and outputs stay fp32
+        self.channelsLast = channelsLast        #Run the conv trunks in channels-last (NHWC) memory format
+        checkpointStages = tuple(sorted(set(checkpointStages)))
+        if any(stage not in range(len(self.trunkStages)) for stage in checkpointStages):
+            raise ValueError("checkpointStages must be trunk stage indices 0-%d, got %r" % (len(self.trunkStages) - 1,checkpointStages))
+        self.checkpointStages = checkpointStages    #Trunk stages whose activations are recomputed in backward instead of stored
+        self.preFiltered = preFiltered          #forward takes the edgeFilters stack (e.g. from a dataset edge cache), not images
+        if colorMode not in ('red','luminance','rgb'):
+            raise ValueError("colorMode must be 'red', 'luminance' or 'rgb', got %r" % (colorMode,))
+        self.colorMode = colorMode              #Edge filters see the red channel, the luminance, or each RGB channel (9 edge maps)
+        self.numEdgeChannels = 9 if colorMode == 'rgb' else 3
+        sobelKernelX = torch.tensor([[1.,0.,-1.],[2.,0.,-2.],[1.,0.,-1.]])
+        sobelKernelX = sobelKernelX.view(1,1,3,3).repeat(1,1,1,1) #How to use custom kernels in pytorch was found at the following PyTorch forum answer: https://discuss.pytorch.org/t/setting-custom-kernel-for-cnn-in-pytorch/27176
+        sobelKernelY = torch.tensor([[1.,2.,1.],[0.,0.,0.],[-1.,-2.,-1.]])
+        sobelKernelY = sobelKernelY.view(1,1,3,3).repeat(1,1,1,1)
         #Gauss Kernel Generated by me in Matlab and transfered here
-        self.device = torch.device("cuda:0")
-        self.gaussKernel = torch.tensor([[0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0],
+        gaussKernel = torch.tensor([[0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0],
         [0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0],
         [0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0],
         [0,	0,	0,	0,	0,	0.000106542709594868,	0.000301935253041011,	0.000427277986095659,	0.000301935253041011,	0.000106542709594868,	0,	0,	0,	0,	0],
@@ -74,19 +106,32 @@ class EdgeNet(torch.nn.Module):
         [0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0],
         [0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0],
         [0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0,	0]])
-        self.gaussFilter = self.gaussKernel.view(1,1,15,15).repeat(1,1,1,1)
-        self.gaussFilterNoGPU = self.gaussFilter
-        self.gaussFilter = self.gaussFilter.to(self.device)
-        self.sobelKernelX = self.sobelKernelX.to(self.device)
-        self.sobelKernelY = self.sobelKernelY.to(self.device)
-        self.grayTransforms = torchvision.transforms.Compose(
-            [torchvision.transforms.Grayscale(num_output_channels=3)]
-        )
-        self.averagePoolClass = torch.nn.AdaptiveAvgPool2d((7, 7))
-        self.averagePoolR = torch.nn.AdaptiveAvgPool2d((7, 7))
+        #Fixed filters are non-persistent buffers: they follow model.to(...) onto any device and stay out of checkpoints
+        self.register_buffer('gaussFilter',gaussKernel.view(1,1,15,15).repeat(1,1,1,1),persistent = False)
+        self.register_buffer('sobelKernelX',sobelKernelX,persistent = False)
+        self.register_buffer('sobelKernelY',sobelKernelY,persistent = False)
+        #Fused filter bank: Gauss, SobelX, SobelY stacked as output channels, Sobels zero-padded into the 15x15 footprint
+        edgeFilterBank = torch.zeros(3,1,15,15)
+        edgeFilterBank[0] = gaussKernel
+        edgeFilterBank[1,0,6:9,6:9] = sobelKernelX[0,0]
+        edgeFilterBank[2,0,6:9,6:9] = sobelKernelY[0,0]
+        self.register_buffer('edgeFilterBank',edgeFilterBank,persistent = False)
+        #Separable filter bank: every filter factors into column x row, SobelX = [1,2,1]'[1,0,-1] and SobelY = [1,0,-1]'[1,2,1]
+        gauss1d = self.makeGaussKernel1d(gaussSize,gaussSigma)
+        smooth1d = torch.zeros(gaussSize)
+        smooth1d[gaussSize//2-1:gaussSize//2+2] = torch.tensor([1.,2.,1.])
+        diff1d = torch.zeros(gaussSize)
+        diff1d[gaussSize//2-1:gaussSize//2+2] = torch.tensor([1.,0.,-1.])
+        self.register_buffer('edgeRowBank',torch.stack((gauss1d,diff1d,smooth1d)).view(3,1,1,gaussSize),persistent = False)
+        self.register_buffer('edgeColumnBank',torch.stack((gauss1d,smooth1d,diff1d)).view(3,1,gaussSize,1),persistent = False)
+        #ITU-R BT.601 luma weights as a 1x1 conv: the grayscale image is one weighted reduction over the RGB channels
+        self.register_buffer('lumaWeights',torch.tensor([0.299,0.587,0.114]).view(1,3,1,1),persistent = False)
+        headPoolSize = (7, 7) if head == 'vgg' else (headPool, headPool)
+        self.averagePoolClass = torch.nn.AdaptiveAvgPool2d(headPoolSize)
+        self.averagePoolR = torch.nn.AdaptiveAvgPool2d(headPoolSize)
         #Now define the network
         self.firstConvLayerSmoothClass = torch.nn.Sequential(
-            torch.nn.Conv2d(3,64,kernel_size = 3, padding = 1),
+            torch.nn.Conv2d(self.numEdgeChannels,64,kernel_size = 3, padding = 1),
             torch.nn.BatchNorm2d(64),
             torch.nn.ReLU(inplace = True)
         )
@@ -155,15 +200,18 @@ class EdgeNet(torch.nn.Module):
             torch.nn.BatchNorm2d(1024),
             torch.nn.ReLU(inplace = True),
         )
-        self.fullConClass = torch.nn.Sequential(
-            torch.nn.Linear(1024*7*7,4096),
-            torch.nn.ReLU(inplace = True),
-            torch.nn.Dropout(),
-            torch.nn.Linear(4096,1000),
-            torch.nn.ReLU(inplace = True),
-            torch.nn.Dropout(),
-            torch.nn.Linear(1000,numOutputs)
-        )
+        if head == 'vgg':
+            self.fullConClass = torch.nn.Sequential(
+                torch.nn.Linear(1024*7*7,4096),
+                torch.nn.ReLU(inplace = True),
+                torch.nn.Dropout(),
+                torch.nn.Linear(4096,1000),
+                torch.nn.ReLU(inplace = True),
+                torch.nn.Dropout(),
+                torch.nn.Linear(1000,numOutputs)
+            )
+        else:
+            self.fullConClass = self.makeCompactHead(1024*headPool*headPool,headWidth,numOutputs)
         self.skipBatchNorm1 = torch.nn.BatchNorm2d(128)
         self.skipConv1 = torch.nn.Conv2d(128,128,kernel_size = 3,padding = 1)
         self.skipBatchNorm2 = torch.nn.BatchNorm2d(256)
@@ -182,7 +230,7 @@ class EdgeNet(torch.nn.Module):
         self.skipConv4R = torch.nn.Conv2d(1024,1024,kernel_size = 3,padding = 1)
 
         self.firstConvLayerSmoothR = torch.nn.Sequential(
-            torch.nn.Conv2d(3,64,kernel_size = 3, padding = 1),
+            torch.nn.Conv2d(self.numEdgeChannels,64,kernel_size = 3, padding = 1),
             torch.nn.BatchNorm2d(64),
             torch.nn.ReLU(inplace = True)
         )
@@ -251,107 +299,130 @@ class EdgeNet(torch.nn.Module):
             torch.nn.BatchNorm2d(1024),
             torch.nn.ReLU(inplace = True),
         )
-        self.fullConR = torch.nn.Sequential(
-            torch.nn.Linear(1024*7*7,4096),
-            torch.nn.ReLU(inplace = True),
-            torch.nn.Dropout(),
-            torch.nn.Linear(4096,512),
+        if head == 'vgg':
+            self.fullConR = torch.nn.Sequential(
+                torch.nn.Linear(1024*7*7,4096),
+                torch.nn.ReLU(inplace = True),
+                torch.nn.Dropout(),
+                torch.nn.Linear(4096,512),
+                torch.nn.ReLU(inplace = True),
+                torch.nn.Dropout(),
+                #torch.nn.Linear(1024,512),
+                #torch.nn.ReLU(inplace = True),
+                #torch.nn.Dropout(),
+                torch.nn.Linear(512,4)
+            )
+        else:
+            self.fullConR = self.makeCompactHead(1024*headPool*headPool,headWidth,numRegOutputs)
+        #Shared stages only exist in the Class trunk, drop their R twins so they cost no parameters or optimizer state
+        for stageName,skipIdx in self.trunkStages[:sharedStages]:
+            delattr(self,stageName + 'ConvLayerSmoothR')
+            if skipIdx:
+                delattr(self,'skipConv%dR' % skipIdx)
+                delattr(self,'skipBatchNorm%dR' % skipIdx)
+        if channelsLast:
+            self.to(memory_format = torch.channels_last)
+    def splitMetrics(self,x):
+        #The image the edge filters run on: the red channel ('red', the original pseudo-grayscale), the luminance
+        #('luminance') or all three channels ('rgb')
+        if self.colorMode == 'luminance':
+            return torch.nn.functional.conv2d(x,self.lumaWeights)
+        if self.colorMode == 'rgb':
+            return x
+        return x[:,0:1]
+    @staticmethod
+    def makeCompactHead(inFeatures,width,outFeatures):
+        #Small MLP on the pooled trunk output, replaces the ~200M parameter VGG head
+        return torch.nn.Sequential(
+            torch.nn.Linear(inFeatures,width),
             torch.nn.ReLU(inplace = True),
             torch.nn.Dropout(),
-            #torch.nn.Linear(1024,512),
-            #torch.nn.ReLU(inplace = True),
-            #torch.nn.Dropout(),
-            torch.nn.Linear(512,4)
+            torch.nn.Linear(width,outFeatures)
         )
-    def splitMetrics(self,x):
-        x = torch.split(x,1,1)     #Get individual RGB to due a pseudo-grayscale for edge detection
-        x0 = x[0]
-        x1 = x[0]
-        x2 = x[0]     #Will recombine after networks run in parallel
-        
-        return x0,x1,x2 
-        # toTransform = x
-        # imgVals = torchvision.transforms.functional.to_pil_image(toTransform[0])
-        # grayScaleVals = torchvision.transforms.functional.to_grayscale(imgVals,3)
-        # x[0] = torchvision.transforms.functional.to_tensor(grayScaleVals)
+    @staticmethod
+    def makeGaussKernel1d(size,sigma):
+        #Normalized 1-D Gaussian, its outer product with itself is the 2-D blur kernel
+        taps = torch.arange(size,dtype=torch.float) - (size - 1)/2.
+        kernel = torch.exp(-taps**2/(2.*sigma**2))
+        return kernel/kernel.sum()
+    def edgeFilters(self,x):
+        #Returns the 3-channel Gauss/SobelX/SobelY edge stack consumed by both trunks
+        x = self.splitMetrics(x)
+        channels = x.shape[1]       #3 in 'rgb' mode: each input channel is its own group and gets all three filters
+        if self.frontEnd == 'separable':
+            #Row pass produces all three channels, grouped column pass finishes each one: 2*gaussSize MACs per pixel per filter
+            pad = self.gaussSize//2
+            x = torch.nn.functional.conv2d(x,self.edgeRowBank.repeat(channels,1,1,1),bias=None,padding=(0,pad),groups=channels)
+            return torch.nn.functional.conv2d(x,self.edgeColumnBank.repeat(channels,1,1,1),bias=None,padding=(pad,0),groups=3*channels)
+        if self.frontEnd == 'fused':
+            #All three filters see the same channel, so a single 3-output conv (per channel group) produces the stack in one launch
+            return torch.nn.functional.conv2d(x,self.edgeFilterBank.repeat(channels,1,1,1),bias=None,padding=7,groups=channels)
+        #Use of F.conv2d instead of nn.Conv2d was found: https://discuss.pytorch.org/t/setting-custom-kernel-for-cnn-in-pytorch/27176
+        x0 = torch.nn.functional.conv2d(x,self.gaussFilter.repeat(channels,1,1,1),bias=None, padding=7, groups=channels)     #Blurring Step with Gaussian Kernals.
+        x1 = torch.nn.functional.conv2d(x,self.sobelKernelX.repeat(channels,1,1,1),bias=None,padding = 1,groups=channels)
+        x2 = torch.nn.functional.conv2d(x,self.sobelKernelY.repeat(channels,1,1,1),bias=None,padding=1,groups=channels)
+        return torch.stack((x0,x1,x2),dim=2).flatten(1,2)      #(Gauss, SobelX, SobelY) per input channel, as the fused bank orders them
+    def edgeConfig(self):
+        #Everything edgeFilters' output depends on, so a cache of it can tell whether it was built for this front-end.
+        #'split' and 'fused' compute the same stack with the fixed Matlab Gaussian
+        if self.frontEnd == 'separable':
+            return {'frontEnd' : 'separable','gaussSize' : self.gaussSize,'gaussSigma' : self.gaussSigma,'colorMode' : self.colorMode}
+        return {'frontEnd' : 'fused','colorMode' : self.colorMode}
+    def trunkStage(self,x,stage,branch):
+        #Runs one trunk stage of the 'Class' or 'R' branch, followed by its skip connection if it has one. A checkpointed
+        #stage keeps only its input for backward and reruns itself there
+        if stage in self.checkpointStages and self.training and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(self.runTrunkStage,x,stage,branch,use_reentrant = False,
+                                                     context_fn = lambda: (contextlib.nullcontext(),self.recomputeContext()))
+        return self.runTrunkStage(x,stage,branch)
+    @contextlib.contextmanager
+    def recomputeContext(self):
+        #The rerun of a checkpointed stage must run the same ops as the original forward but not count the batch a second
+        #time in the BatchNorm running statistics, so it runs with momentum 0 and the batch counters are put back after
+        batchNorms = [module for module in self.modules() if isinstance(module,torch.nn.BatchNorm2d) and module.track_running_stats]
+        saved = [(batchNorm.momentum,batchNorm.num_batches_tracked.clone()) for batchNorm in batchNorms]
+        for batchNorm in batchNorms:
+            batchNorm.momentum = 0.
+        try:
+            yield
+        finally:
+            for batchNorm,(momentum,numBatches) in zip(batchNorms,saved):
+                batchNorm.momentum = momentum
+                batchNorm.num_batches_tracked.copy_(numBatches)
+    def runTrunkStage(self,x,stage,branch):
+        stageName,skipIdx = self.trunkStages[stage]
+        x = getattr(self,stageName + 'ConvLayerSmooth' + branch)(x)
+        if skipIdx:
+            suffix = '' if branch == 'Class' else 'R'
+            addLayer = x
+            x = torch.nn.functional.relu(getattr(self,'skipBatchNorm%d%s' % (skipIdx,suffix))(getattr(self,'skipConv%d%s' % (skipIdx,suffix))(x)))
+            x = torch.add(x,addLayer)
+        return x
     def forward(self,x):
-        x0,x1,x2 = self.splitMetrics(x)
-        #Weird issue with conv2d, temp fix for now.
-        x0 = x0.to(self.device)
-        x1 = x1.to(self.device)
-        x2 = x2.to(self.device)
-        if x0.type() != torch.cuda.FloatTensor:
-            #Use of F.conv2d instead of nn.Conv2d was found: https://discuss.pytorch.org/t/setting-custom-kernel-for-cnn-in-pytorch/27176
-            x0Class = torch.nn.functional.conv2d(x0,self.gaussFilter,bias=None, padding=7 )     #Blurring Step with Gaussian Kernals.
-            x1Class = torch.nn.functional.conv2d(x1,self.sobelKernelX,bias=None,padding = 1)
-            x2Class = torch.nn.functional.conv2d(x2,self.sobelKernelY,bias=None,padding=1)
-            x0R = x0Class
-            x1R = x1Class
-            x2R = x2Class
-        else:
-            x0Class = torch.nn.functional.conv2d(x0,self.gaussFilter,bias=None, padding=7 ) 
-            x1Class = torch.nn.functional.conv2d(x1,self.sobelKernelX,bias=None,padding = 1)
-            x2Class = torch.nn.functional.conv2d(x2,self.sobelKernelY,bias=None,padding=1)
-            x0R = x0Class
-            x1R = x1Class
-            x2R = x2Class
-        x0Class = torch.cat((x0Class,x1Class,x2Class),dim=1)
-        x0R = torch.cat((x0R,x1R,x2R),dim=1)
-        x0Class = self.firstConvLayerSmoothClass(x0Class)
-        x0Class = self.secondConvLayerSmoothClass(x0Class)
-        addLayer1 = x0Class
-        x0Class = torch.nn.functional.relu(self.skipBatchNorm1(self.skipConv1(x0Class)))
-        x0Class = torch.add(x0Class,addLayer1)
-        x0Class = self.thirdConvLayerSmoothClass(x0Class)
-        addLayer = x0Class
-        x0Class = torch.nn.functional.relu(self.skipBatchNorm2(self.skipConv2(x0Class)))
-        x0Class = torch.add(x0Class,addLayer)
-        x0Class = self.fourthConvLayerSmoothClass(x0Class)
-        x0Class = self.fifthConvLayerSmoothClass(x0Class)
-        addLayer = x0Class
-        x0Class = torch.nn.functional.relu(self.skipBatchNorm3(self.skipConv3(x0Class)))
-        x0Class = torch.add(x0Class,addLayer)
-        x0Class = self.sixthConvLayerSmoothClass(x0Class)
-        x0Class = self.seventhConvLayerSmoothClass(x0Class)
-        addLayer = x0Class
-        x0Class = torch.nn.functional.relu(self.skipBatchNorm4(self.skipConv4(x0Class)))
-        x0Class = torch.add(x0Class,addLayer)
-        x0Class = self.eigthConvLayerSmoothClass(x0Class)
-
-        #x0R = torch.nn.functional.conv2d(x0R,self.gaussFilter,bias=None, padding=1 ) 
-        x0R = self.firstConvLayerSmoothR(x0R)
-        x0R = self.secondConvLayerSmoothR(x0R)
-        addLayer = x0R
-        x0R = torch.nn.functional.relu(self.skipBatchNorm1R(self.skipConv1R(x0R)))
-        x0R = torch.add(x0R,addLayer)
-        x0R = self.thirdConvLayerSmoothR(x0R)
-        addLayer = x0R
-        x0R = torch.nn.functional.relu(self.skipBatchNorm2R(self.skipConv2R(x0R)))
-        x0R = torch.add(x0R,addLayer)
-        x0R = self.fourthConvLayerSmoothR(x0R)
-        x0R = self.fifthConvLayerSmoothR(x0R)
-        addLayer = x0R
-        x0R = torch.nn.functional.relu(self.skipBatchNorm3R(self.skipConv3R(x0R)))
-        x0R = torch.add(x0R,addLayer)
-        x0R = self.sixthConvLayerSmoothR(x0R)
-        x0R = self.seventhConvLayerSmoothR(x0R)
-        addLayer = x0R
-        x0R = torch.nn.functional.relu(self.skipBatchNorm4R(self.skipConv4R(x0R)))
-        x0R = torch.add(x0R,addLayer)
-        x0R = self.eigthConvLayerSmoothR(x0R)
-
-        if self.edgeDetect == 0:
-            x0Class = self.averagePoolClass(x0Class)
-            xsizes = x0Class.size()
-            x0Class = x0Class.view(-1,xsizes[1]*xsizes[2]*xsizes[3])
-            x0Class = torch.flatten(x0Class,1)          #Prepare for Linear Auditory Cortex Layers
-            x0Class = self.fullConClass(x0Class)
-            x0R = self.averagePoolClass(x0R)
-            xsizes = x0R.size()
-            x0R = x0R.view(-1,xsizes[1]*xsizes[2]*xsizes[3])
-            x0R = torch.flatten(x0R,1)          #Prepare for Linear Auditory Cortex Layers
-            x0R = self.fullConR(x0R)
-            return x0Class,x0R
+        x0Class = x if self.preFiltered else self.edgeFilters(x)       #Inputs are expected on the same device as the model
+        if self.channelsLast:
+            x0Class = x0Class.contiguous(memory_format = torch.channels_last)
+        if self.precision == 'fp32':
+            return self.forwardTrunks(x0Class)
+        with torch.autocast(device_type = x0Class.device.type,dtype = self.autocastDtypes[self.precision]):
+            outputs = self.forwardTrunks(x0Class)
+        return tuple(output.float() for output in outputs)
+    def forwardTrunks(self,x0Class):
+        for stage in range(self.sharedStages):
+            x0Class = self.trunkStage(x0Class,stage,'Class')
+        x0R = x0Class
+        for stage in range(self.sharedStages,len(self.trunkStages)):
+            x0Class = self.trunkStage(x0Class,stage,'Class')
+            x0R = self.trunkStage(x0R,stage,'R')
+        if self.edgeDetect != 0:
+            return x0Class,x0R          #Edge-detection mode: the trunk feature maps of both branches, no heads
+        x0Class = self.averagePoolClass(x0Class)
+        x0Class = torch.flatten(x0Class,1)          #Prepare for Linear Auditory Cortex Layers
+        x0Class = self.fullConClass(x0Class)
+        x0R = self.averagePoolClass(x0R)
+        x0R = torch.flatten(x0R,1)          #Prepare for Linear Auditory Cortex Layers
+        x0R = self.fullConR(x0R)
+        return x0Class,x0R
 
 
 if __name__ == '__main__':
@@ -364,7 +435,10 @@ if __name__ == '__main__':
     torch.backends.cudnn.deterministic=True
     torch.backends.cudnn.benchmarks=False
     os.environ['PYTHONHASHSEED'] = str(seed)
-    device = torch.device("cuda:0")
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    if device.type == 'cpu':
+        #CPU inference/training mode. Thread count can be pinned with EDGENET_NUM_THREADS, defaults to all cores
+        torch.set_num_threads(int(os.environ.get('EDGENET_NUM_THREADS',os.cpu_count())))
     def applyGaussSmooth(kernalSize,Variance,data):
         gMean = (kernalSize-1.)/2.     #Get float mean
         ##  watch -d -n 0.5 nvidia-smi
@@ -382,7 +456,7 @@ if __name__ == '__main__':
                     classes = ('rectangle','triangle','disk','oval','star'),
                     debug_train = 1,
                     debug_test = 1,
-                    use_gpu = True,
+                    use_gpu = torch.cuda.is_available(),
                 )
 
 
@@ -410,7 +484,13 @@ if __name__ == '__main__':
     model = EdgeNet(3,5,4,0)#detector.LOADnet2(skip_connections=True, depth=32)
     model = model.to(device)          #On Windows, DLStudio does not send model to device till second pass of forward. No idea why
     dls.show_network_summary(model)
-    detector.run_code_for_training_with_CrossEntropy_and_MSE_Losses(model)
+    #In-repo trainer instead of DLStudio's batch_size loop: micro-batches of 16 accumulated to an effective batch of 64,
+    #DLStudio's learning rate scaled linearly to that batch with a short warmup
+    from trainer import train, scaledLearningRate
+    train(model,dataserver_train,epochs = dls.epochs,batchSize = 16,accumulationSteps = 4,
+          learningRate = scaledLearningRate(dls.learning_rate,64,dls.batch_size),warmupSteps = 100,device = device)
+    torch.save(model.state_dict(),dls.path_saved_model)       #DLStudio's testing loads the trained weights from here
+    #detector.run_code_for_training_with_CrossEntropy_and_MSE_Losses(model)
     #detector.run_code_for_training_with_CrossEntropy_and_BCE_Losses(model)
 
     #import pymsgbox
@@ -0,0 +1,5 @@
+import os
+import sys
+
+#The modules are top-level scripts, not a package: import them the way the scripts do, from the repo root
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,54 @@
+#-------------------------------------------------------------------------------------------------------------------
+# Purpose: Numerical equivalence of the EdgeNet edge front-ends
+# Description: The 'separable' front-end replaces the 15x15 Matlab Gaussian with an analytic 9-tap sigma 1.2 Gaussian
+# applied as row and column passes, and factors both Sobels. The Sobels must match the 'fused' bank up to float
+# rounding. The Gaussian can only differ by the kernel difference: the Matlab matrix has its corners cropped to zero
+# and one row shifted by a column, 2.22e-3 at most per tap. A linear filter's output then moves by at most the summed
+# |kernel difference| times the largest input pixel, which is the bound the blur channels are held to.
+#       python -m pytest -q tests
+#-------------------------------------------------------------------------------------------------------------------
+import pytest
+import torch
+from task3 import EdgeNet
+
+kernelTolerance = 2.5e-3        #Largest allowed |analytic - Matlab| tap, measured 2.22e-3
+
+def gaussKernels(model):
+    #(Matlab 15x15 kernel, analytic separable kernel zero-padded to the same footprint)
+    matlabKernel = model.gaussFilter[0,0]
+    gauss1d = model.makeGaussKernel1d(model.gaussSize,model.gaussSigma)
+    offset = (matlabKernel.shape[0] - model.gaussSize)//2
+    analyticKernel = torch.zeros_like(matlabKernel)
+    analyticKernel[offset:offset + model.gaussSize,offset:offset + model.gaussSize] = torch.outer(gauss1d,gauss1d)
+    return matlabKernel,analyticKernel
+
+def test_analytic_gauss_matches_matlab_kernel():
+    matlabKernel,analyticKernel = gaussKernels(EdgeNet(3,5,4,0,head = 'compact',frontEnd = 'separable'))
+    assert (analyticKernel - matlabKernel).abs().max().item() <= kernelTolerance
+    assert analyticKernel.sum().item() == pytest.approx(1.,abs = 1e-6)
+
+@pytest.mark.parametrize('colorMode',['red','luminance','rgb'])
+def test_separable_matches_fused_edge_stack(colorMode):
+    fused = EdgeNet(3,5,4,0,head = 'compact',frontEnd = 'fused',colorMode = colorMode).eval()
+    separable = EdgeNet(3,5,4,0,head = 'compact',frontEnd = 'separable',colorMode = colorMode).eval()
+    images = torch.rand(16,3,32,32,generator = torch.Generator().manual_seed(0))*255.
+    with torch.inference_mode():
+        reference = fused.edgeFilters(images)
+        output = separable.edgeFilters(images)
+        filterInput = fused.splitMetrics(images)
+    assert output.shape == reference.shape == (16,fused.numEdgeChannels,32,32)
+    #Channels are (Gauss, SobelX, SobelY) per filtered input channel
+    matlabKernel,analyticKernel = gaussKernels(separable)
+    gaussBound = (analyticKernel - matlabKernel).abs().sum().item()*filterInput.abs().max().item()
+    assert (output[:,0::3] - reference[:,0::3]).abs().max().item() <= gaussBound*(1. + 1e-4)
+    sobelScale = reference[:,1::3].abs().max().item() + reference[:,2::3].abs().max().item()
+    torch.testing.assert_close(output[:,1::3],reference[:,1::3],rtol = 0.,atol = 1e-6*sobelScale)
+    torch.testing.assert_close(output[:,2::3],reference[:,2::3],rtol = 0.,atol = 1e-6*sobelScale)
+
+def test_split_matches_fused_edge_stack():
+    model = EdgeNet(3,5,4,0,head = 'compact',frontEnd = 'split').eval()
+    images = torch.rand(16,3,32,32,generator = torch.Generator().manual_seed(0))*255.
+    with torch.inference_mode():
+        reference = model.edgeFilters(images)
+        model.frontEnd = 'fused'
+        torch.testing.assert_close(model.edgeFilters(images),reference,rtol = 1e-5,atol = 1e-3)
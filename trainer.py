@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------------------------------------------
+# Purpose: In-repo training steps for EdgeNet
+# Description: The same CrossEntropy (labels) + MSE (bbox) pair of losses DLStudio's DetectAndLocalize trainer uses,
+# with loss scaling for models built with precision = 'fp16', and the matching evaluation. train() adds gradient
+# accumulation, loss weighting, LR warmup and samples/sec logging for large effective batches.
+#-------------------------------------------------------------------------------------------------------------------
+import contextlib
+import time
+import torch
+
+def makeGradScaler(model,device = 'cpu'):
+    #fp16 gradients underflow without loss scaling; bf16 has fp32's exponent range and fp32 needs none, so the scaler
+    #is a pass-through for those
+    model = getattr(model,'module',model)        #Unwrap DistributedDataParallel
+    return torch.amp.GradScaler(torch.device(device).type,enabled = getattr(model,'precision','fp32') == 'fp16')
+
+def computeLoss(model,batch,device = 'cpu',classWeight = 1.,mseWeight = 1.):
+    #Weighted CrossEntropy on the labels plus MSE on the bboxes for one batch
+    outputsClass,outputsR = model(batch['image'].to(device))
+    return classWeight*torch.nn.functional.cross_entropy(outputsClass,batch['label'].to(device)) + \
+           mseWeight*torch.nn.functional.mse_loss(outputsR,batch['bbox'].to(device))
+
+def trainStep(model,optimizer,batch,device = 'cpu',scaler = None,classWeight = 1.,mseWeight = 1.):
+    optimizer.zero_grad()
+    loss = computeLoss(model,batch,device,classWeight,mseWeight)
+    if scaler is None:
+        loss.backward()
+        optimizer.step()
+    else:
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+    return loss
+
+def scaledLearningRate(baseLearningRate,batchSize,baseBatchSize = 1,rule = 'linear'):
+    #Learning rate for batchSize given one tuned at baseBatchSize: 'linear' scales with the batch ratio (Goyal et al.),
+    #'sqrt' with its square root, which is gentler for momentum SGD at very large ratios
+    if rule not in ('linear','sqrt','none'):
+        raise ValueError("rule must be 'linear', 'sqrt' or 'none', got %r" % (rule,))
+    ratio = batchSize/baseBatchSize
+    return baseLearningRate*(ratio if rule == 'linear' else ratio**0.5 if rule == 'sqrt' else 1.)
+
+def makeLoader(trainData,batchSize,numWorkers = 0,shuffle = True,sampler = None,prefetchFactor = 2,persistentWorkers = True,
+               pinMemory = None,context = None):
+    #Loader factory. PurdueShapes5DatasetNoise hands out whole batches from one gather, anything else goes through a
+    #plain DataLoader. With workers, the dataset's stores are first moved to shared memory so no worker copies them,
+    #each worker keeps prefetchFactor batches in flight, and persistentWorkers keeps the workers (and their mapped
+    #pages) alive across epochs. pinMemory (default: when CUDA is available) makes host-to-GPU copies asynchronous.
+    #context picks the worker start method ('fork', 'spawn', 'forkserver')
+    if pinMemory is None:
+        pinMemory = torch.cuda.is_available()
+    kwargs = {'num_workers' : numWorkers,'pin_memory' : pinMemory}
+    if numWorkers > 0:
+        if hasattr(trainData,'shareMemory'):
+            trainData.shareMemory()
+        kwargs.update(prefetch_factor = prefetchFactor,persistent_workers = persistentWorkers,multiprocessing_context = context)
+    if hasattr(trainData,'batchLoader'):
+        return trainData.batchLoader(batchSize,shuffle = shuffle,sampler = sampler,**kwargs)
+    return torch.utils.data.DataLoader(trainData,batch_size = batchSize,shuffle = shuffle if sampler is None else False,
+                                       sampler = sampler,**kwargs)
+
+def setLoaderEpoch(loader,epoch):
+    #A DistributedSampler (directly or under a BatchSampler) only reshuffles its shard when told the epoch
+    sampler = getattr(loader,'sampler',None)
+    sampler = getattr(sampler,'sampler',sampler)
+    if hasattr(sampler,'set_epoch'):
+        sampler.set_epoch(epoch)
+
+def train(model,trainData,epochs = 1,batchSize = 32,accumulationSteps = 1,learningRate = 1e-4,momentum = 0.9,
+          warmupSteps = 0,classWeight = 1.,mseWeight = 1.,device = 'cpu',numWorkers = 0,logEvery = 50,loader = None,
+          onEpochEnd = None):
+    #SGD over trainData in micro-batches of batchSize, stepping the optimizer every accumulationSteps micro-batches, so
+    #the effective batch is batchSize*accumulationSteps at the memory cost of batchSize (an epoch's trailing partial group
+    #steps on the mean of its micro-batches). The learning rate ramps up
+    #linearly over the first warmupSteps optimizer steps. Every logEvery optimizer steps (0 for never) prints the mean
+    #loss, learning rate and samples/sec since the last log. loader replaces the default one (e.g. with a sharded sampler).
+    #A DistributedDataParallel model only all-reduces gradients on the micro-batch that steps. onEpochEnd(epoch, model,
+    #optimizer) is called after every epoch, e.g. to checkpoint. Returns the list of logged (step, loss, lr, samples/sec)
+    if accumulationSteps < 1:
+        raise ValueError("accumulationSteps must be >= 1, got %r" % (accumulationSteps,))
+    loader = makeLoader(trainData,batchSize,numWorkers) if loader is None else loader
+    optimizer = torch.optim.SGD(model.parameters(),lr = learningRate,momentum = momentum)
+    scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer,lambda step: min(1.,(step + 1)/warmupSteps) if warmupSteps else 1.)
+    scaler = makeGradScaler(model,device)
+    history = []
+    step = 0
+    lossSum,numSamples,numBatches = 0.,0,0
+    start = time.perf_counter()
+    for epoch in range(epochs):
+        model.train()
+        setLoaderEpoch(loader,epoch)
+        optimizer.zero_grad()
+        for ii,batch in enumerate(loader):
+            stepping = (ii + 1) % accumulationSteps == 0 or ii + 1 == len(loader)
+            #An epoch that ends mid-group steps on fewer micro-batches, which are averaged over their own count
+            groupStart = ii - ii % accumulationSteps
+            groupSize = min(accumulationSteps,len(loader) - groupStart)
+            noSync = model.no_sync() if hasattr(model,'no_sync') and not stepping else contextlib.nullcontext()
+            with noSync:
+                loss = computeLoss(model,batch,device,classWeight,mseWeight)
+                scaler.scale(loss/groupSize).backward()
+            lossSum += loss.item()
+            numSamples += len(batch['label'])
+            numBatches += 1
+            if not stepping:
+                continue
+            stepLearningRate = optimizer.param_groups[0]['lr']
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad()
+            scheduler.step()
+            step += 1
+            if logEvery and step % logEvery == 0:
+                if torch.cuda.is_initialized():
+                    torch.cuda.synchronize()
+                samplesPerSec = numSamples/(time.perf_counter() - start)
+                history.append((step,lossSum/numBatches,stepLearningRate,samplesPerSec))
+                print("[epoch %d step %d] loss %.4f  lr %.2e  %.1f samples/s" % ((epoch + 1,) + history[-1]))
+                lossSum,numSamples,numBatches = 0.,0,0
+                start = time.perf_counter()
+        if onEpochEnd is not None:
+            onEpochEnd(epoch,model,optimizer)
+    return history
+
+def trainEpochs(model,trainData,epochs = 1,batchSize = 32,learningRate = 1e-4,device = 'cpu'):
+    #Plain SGD with DLStudio's momentum, used for short training and fine-tuning runs
+    train(model,trainData,epochs,batchSize,learningRate = learningRate,device = device,logEvery = 0)
+    return model
+
+def evaluate(model,testData,batchSize = 64,device = 'cpu'):
+    #Returns (label accuracy, bbox MSE) over testData
+    loader = torch.utils.data.DataLoader(testData,batch_size = batchSize)
+    model.eval()
+    numCorrect = 0
+    squaredError = 0.
+    with torch.inference_mode():
+        for batch in loader:
+            outputsClass,outputsR = model(batch['image'].to(device))
+            numCorrect += (outputsClass.argmax(1).cpu() == batch['label']).sum().item()
+            squaredError += torch.nn.functional.mse_loss(outputsR.float().cpu(),batch['bbox'],reduction = 'sum').item()
+    return numCorrect/len(testData),squaredError/(4*len(testData))